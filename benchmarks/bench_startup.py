@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark CLI startup time of loon.
+
+Each subcommand is run in a fresh interpreter several times and the
+median wall time is reported. It also checks that lightweight subcommands
+do not import ssh2 and do not read the host file.
+
+Usage:
+    python benchmarks/bench_startup.py [-n 10] [--max-ms 150]
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+from subprocess import run, PIPE
+from time import perf_counter
+
+here = os.path.dirname(os.path.realpath(__file__))
+src_dir = os.path.join(os.path.dirname(here), 'src')
+data_dir = os.path.join(src_dir, 'loon', 'data')
+
+# Run main() and report which heavy modules got imported and whether
+# the host file has been touched
+PROBE = """
+import sys, json, os
+import loon
+loon.__host_file__ = os.path.join({tmpdir!r}, 'host.json')
+import loon.classes
+opened = []
+_open = open
+def spy(file, *args, **kwargs):
+    opened.append(str(file))
+    return _open(file, *args, **kwargs)
+import builtins
+builtins.open = spy
+from loon.skeleton import main
+try:
+    main({args!r})
+except SystemExit:
+    pass
+sys.stdout = sys.__stdout__
+print(json.dumps({{'ssh2': 'ssh2' in sys.modules,
+                   'hostfile': any(i.endswith('host.json') for i in opened)}}))
+"""
+
+LIGHT_COMMANDS = {
+    'batch': ['batch', '--dry', '-f',
+              os.path.join(data_dir, 'samplefile.csv'), 'echo {0}'],
+    'gen': ['gen', '--dry', '-t',
+            os.path.join(data_dir, 'pbs-template.pbs'), '-s',
+            os.path.join(data_dir, 'samplefile.csv'), '-m',
+            os.path.join(data_dir, 'mapping.csv'), '-o', tempfile.gettempdir()],
+    'pbstemp': ['pbstemp', '--dry'],
+    'list': ['list'],
+}
+
+
+def timeit(cmd, n, env):
+    res = []
+    for _ in range(n):
+        now = perf_counter()
+        run(cmd, stdout=PIPE, stderr=PIPE, env=env)
+        res.append((perf_counter() - now) * 1000)
+    return statistics.median(res)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark loon startup")
+    parser.add_argument('-n', type=int, default=10, help="Repeat times")
+    parser.add_argument('--max-ms',
+                        type=float,
+                        default=None,
+                        help="Fail if any subcommand is slower than this")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([src_dir, env.get('PYTHONPATH', '')])
+    tmpdir = tempfile.mkdtemp()
+    failed = False
+
+    baseline = timeit([sys.executable, '-c', 'pass'], args.n, env)
+    print("%-10s %10s %10s %6s %9s" %
+          ('command', 'total(ms)', 'loon(ms)', 'ssh2', 'hostfile'))
+    for name, cmd in LIGHT_COMMANDS.items():
+        total = timeit([sys.executable, '-m', 'loon.skeleton'] + cmd, args.n,
+                       env)
+        probe = run([
+            sys.executable, '-c',
+            PROBE.format(tmpdir=tmpdir, args=cmd)
+        ],
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    env=env,
+                    universal_newlines=True)
+        info = json.loads(probe.stdout.strip().split('\n')[-1])
+        print("%-10s %10.1f %10.1f %6s %9s" %
+              (name, total, total - baseline, info['ssh2'], info['hostfile']))
+        if info['ssh2']:
+            failed = True
+        if name != 'list' and info['hostfile']:
+            failed = True
+        if args.max_ms is not None and total - baseline > args.max_ms:
+            failed = True
+
+    if failed:
+        print("Error: startup benchmark failed!")
+        sys.exit(1)
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of loon.
+
+Local cases (template rendering, batch dispatch, directory walking,
+CLI startup) always run. Remote cases (connection, command round trips,
+transfers, PBS submission) run against a throwaway local sshd (see `sshd.py`) with
+fake `qsub`/`qstat`, they are skipped if sshd is not available.
+
+Results are compared with a stored baseline. `baseline.json` holds the
+local cases measured with --quick on the machine recorded under
+'_machine'. Save one on your reference machine first:
+
+    python benchmarks/run.py --save-baseline
+    # ... change code ...
+    python benchmarks/run.py --check
+
+Usage:
+    python benchmarks/run.py [-n 5] [--quick] [--only CASE ...]
+                             [--baseline FILE] [--save-baseline]
+                             [--tolerance 0.2] [--check] [--output FILE]
+"""
+
+import os
+import sys
+import json
+import platform
+import argparse
+import tempfile
+import statistics
+import contextlib
+from time import perf_counter
+
+here = os.path.dirname(os.path.realpath(__file__))
+src_dir = os.path.join(os.path.dirname(here), 'src')
+sys.path.insert(0, here)
+sys.path.insert(0, src_dir)
+
+from sshd import LocalSSHD, find_sshd    # noqa: E402
+
+CASES = []
+
+
+def case(name, unit, higher_is_better=True, remote=False):
+    """Register a benchmark case
+
+    The decorated function gets a context dict and returns the
+    measured value.
+    """
+    def wrapper(f):
+        CASES.append({
+            'name': name,
+            'unit': unit,
+            'higher_is_better': higher_is_better,
+            'remote': remote,
+            'func': f
+        })
+        return f
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silence stdout of both Python code and child processes"""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        # Keep a real file object, subprocess needs its fileno
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+
+def scaled(ctx, n):
+    return max(1, int(ctx['scale'] * n))
+
+
+def median_time(f, n):
+    res = []
+    for _ in range(n):
+        now = perf_counter()
+        f()
+        res.append(perf_counter() - now)
+    return statistics.median(res)
+
+
+def make_tree(root, nfile, size):
+    os.makedirs(root)
+    block = os.urandom(size)
+    for i in range(nfile):
+        sub = os.path.join(root, 'd%02d' % (i % 20))
+        if not os.path.isdir(sub):
+            os.makedirs(sub)
+        with open(os.path.join(sub, 'f%06d' % i), 'wb') as f:
+            f.write(block)
+    return nfile * size
+
+
+# Local cases
+@case('gen_pbs', 'files/s')
+def bench_gen_pbs(ctx):
+    from loon.classes import PBS
+    import logging
+    nsample = scaled(ctx, 2000)
+    workdir = tempfile.mkdtemp(dir=ctx['tmpdir'])
+    pbs = PBS()
+    samplefile = os.path.join(workdir, 'samples.csv')
+    with open(samplefile, 'w') as f:
+        for i in range(nsample):
+            print("sample%06d,sample%06d-01" % (i, i), file=f)
+    outdir = os.path.join(workdir, 'out')
+    with quiet():
+        taken = median_time(
+            lambda: pbs.gen_pbs(pbs.pbs_template, samplefile, pbs.mapfile,
+                                outdir, logging.getLogger('bench')), ctx['n'])
+    return nsample / taken
+
+
+@case('batch', 'cmds/s')
+def bench_batch(ctx):
+    from loon.tool import batch
+    import logging
+    ncmd = scaled(ctx, 200)
+    inputfile = os.path.join(ctx['tmpdir'], 'batch.csv')
+    with open(inputfile, 'w') as f:
+        for i in range(ncmd):
+            print("%d" % i, file=f)
+
+    def f():
+        try:
+            batch(inputfile, 'true {0}', _logger=logging.getLogger('bench'))
+        except SystemExit:
+            pass
+
+    with quiet():
+        taken = median_time(f, ctx['n'])
+    return ncmd / taken
+
+
+@case('walk', 'files/s')
+def bench_walk(ctx):
+    from loon.utils import get_filelist
+    nfile = scaled(ctx, 20000)
+    root = os.path.join(ctx['tmpdir'], 'walk')
+    make_tree(root, nfile, 0)
+    taken = median_time(lambda: get_filelist(root), ctx['n'])
+    return nfile / taken
+
+
+def startup_case(command):
+    """Register a case timing CLI startup of a lightweight subcommand"""
+    def bench(ctx):
+        from bench_startup import timeit, LIGHT_COMMANDS
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [src_dir, env.get('PYTHONPATH', '')])
+        base = timeit([sys.executable, '-c', 'pass'], ctx['n'], env)
+        total = timeit([sys.executable, '-m', 'loon.skeleton'] +
+                       LIGHT_COMMANDS[command], ctx['n'], env)
+        return total - base
+
+    name = 'startup' if command == 'batch' else 'startup_' + command
+    return case(name, 'ms', higher_is_better=False)(bench)
+
+
+for command in ('batch', 'gen', 'pbstemp'):
+    startup_case(command)
+
+
+# Remote cases
+@case('connect', 'ms', higher_is_better=False, remote=True)
+def bench_connect(ctx):
+    from loon.connection import open_session
+
+    def f():
+        s, sock = open_session(ctx['server'].host, interactive=False)
+        s.disconnect()
+        sock.close()
+
+    return median_time(f, ctx['n']) * 1000
+
+
+@case('roundtrip', 'ms', higher_is_better=False, remote=True)
+def bench_roundtrip(ctx):
+    host = ctx['host']
+    host.connect(open_channel=False)
+    session = host.session
+
+    def f():
+        host.channel = session.open_session()
+        host.execute('true')
+        host.get_result(print_info=False)
+        host.channel.close()
+
+    return median_time(f, ctx['n'] * 4) * 1000
+
+
+@case('cmd', 'ms', higher_is_better=False, remote=True)
+def bench_cmd(ctx):
+    host = ctx['host']
+    with quiet():
+        return median_time(lambda: host.cmd('true'), ctx['n']) * 1000
+
+
+def bench_transfer(ctx, nfile, size, direction, use_sftp=False):
+    import logging
+    host = ctx['host']
+    _logger = logging.getLogger('bench')
+    name = '%s-%d-%d%s' % (direction, nfile, size, '-sftp' if use_sftp else '')
+    local = os.path.join(ctx['tmpdir'], name)
+    nbytes = make_tree(local, nfile, size)
+    remote = os.path.join(ctx['remote_dir'], name)
+    os.makedirs(remote)
+    if direction == 'upload':
+        f = lambda: host.upload([local], remote, _logger, use_sftp=use_sftp)
+    else:
+        host.upload([local], remote, _logger)
+        dest = os.path.join(ctx['tmpdir'], name + '-download')
+        src = os.path.join(remote, name)
+        f = lambda: host.download([src], dest, _logger, use_sftp=use_sftp)
+    with quiet():
+        taken = median_time(f, ctx['n'])
+    return nbytes / 1e6 / taken
+
+
+@case('upload_small', 'MB/s', remote=True)
+def bench_upload_small(ctx):
+    return bench_transfer(ctx, scaled(ctx, 500), 4096, 'upload')
+
+
+@case('upload_large', 'MB/s', remote=True)
+def bench_upload_large(ctx):
+    return bench_transfer(ctx, 1, scaled(ctx, 64 * 1024 * 1024), 'upload')
+
+
+@case('download_small', 'MB/s', remote=True)
+def bench_download_small(ctx):
+    return bench_transfer(ctx, scaled(ctx, 500), 4096, 'download')
+
+
+@case('download_large', 'MB/s', remote=True)
+def bench_download_large(ctx):
+    return bench_transfer(ctx, 1, scaled(ctx, 64 * 1024 * 1024),
+                          'download')
+
+
+@case('upload_large_sftp', 'MB/s', remote=True)
+def bench_upload_large_sftp(ctx):
+    return bench_transfer(ctx, 1, scaled(ctx, 64 * 1024 * 1024), 'upload',
+                          use_sftp=True)
+
+
+@case('download_large_sftp', 'MB/s', remote=True)
+def bench_download_large_sftp(ctx):
+    return bench_transfer(ctx, 1, scaled(ctx, 64 * 1024 * 1024), 'download',
+                          use_sftp=True)
+
+
+@case('pbssub', 'jobs/s', remote=True)
+def bench_pbssub(ctx):
+    from loon.classes import PBS
+    import logging
+    njob = scaled(ctx, 50)
+    workdir = os.path.join(ctx['remote_dir'], 'pbssub')
+    os.makedirs(workdir)
+    for i in range(njob):
+        with open(os.path.join(workdir, 'job%04d.pbs' % i), 'w') as f:
+            print("echo %d" % i, file=f)
+    pbs = PBS()
+    before = len(ctx['server'].jobs())
+    with quiet():
+        taken = median_time(
+            lambda: pbs.sub(ctx['host'], [workdir + '/*.pbs'], True, workdir,
+                            logging.getLogger('bench')), ctx['n'])
+    if len(ctx['server'].jobs()) - before != njob * ctx['n']:
+        raise RuntimeError("fake qsub does not receive all jobs")
+    return njob / taken
+
+
+def compare(results, baseline, tolerance):
+    """Print results with baseline and return names of regressed cases"""
+    regressed = []
+    print("%-20s %12s %-8s %12s %9s" %
+          ('case', 'value', 'unit', 'baseline', 'change'))
+    for c in CASES:
+        name = c['name']
+        if name not in results:
+            continue
+        value = results[name]['value']
+        if name in baseline:
+            base = baseline[name]['value']
+            change = (value - base) / base if base else 0
+            worse = -change if c['higher_is_better'] else change
+            flag = ''
+            if worse > tolerance:
+                flag = ' <- regression'
+                regressed.append(name)
+            print("%-20s %12.2f %-8s %12.2f %+8.1f%%%s" %
+                  (name, value, c['unit'], base, change * 100, flag))
+        else:
+            print("%-20s %12.2f %-8s %12s %9s" %
+                  (name, value, c['unit'], '-', '-'))
+    return regressed
+
+
+def machine_info(quick):
+    """Describe the machine and inputs results are measured with"""
+    return {
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'quick': quick
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark loon")
+    parser.add_argument('-n', type=int, default=5, help="Repeat times")
+    parser.add_argument('--quick',
+                        help="Use small inputs",
+                        action='store_true')
+    parser.add_argument('--only',
+                        nargs='+',
+                        help="Cases to run",
+                        choices=[c['name'] for c in CASES])
+    parser.add_argument('--baseline',
+                        default=os.path.join(here, 'baseline.json'),
+                        help="Baseline file")
+    parser.add_argument('--save-baseline',
+                        dest='save_baseline',
+                        help="Save results as the new baseline",
+                        action='store_true')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.2,
+                        help="Allowed relative regression, default is 0.2")
+    parser.add_argument('--check',
+                        help="Exit with code 1 if any case regressed",
+                        action='store_true')
+    parser.add_argument('--output', help="Save results to a JSON file")
+    args = parser.parse_args()
+
+    cases = [c for c in CASES if args.only is None or c['name'] in args.only]
+    tmpdir = tempfile.mkdtemp(prefix='loon-bench-data-')
+    ctx = {'n': args.n, 'scale': 0.1 if args.quick else 1, 'tmpdir': tmpdir}
+    results = {}
+
+    def run_cases(cases):
+        for c in cases:
+            print("=> Running %s ..." % c['name'], file=sys.stderr)
+            value = c['func'](ctx)
+            results[c['name']] = {'value': value, 'unit': c['unit']}
+
+    with contextlib.ExitStack() as stack:
+        remote_cases = [c for c in cases if c['remote']]
+        if len(remote_cases) > 0:
+            if find_sshd() is None:
+                print("Warning: sshd is not found, skip remote cases.",
+                      file=sys.stderr)
+            else:
+                server = stack.enter_context(LocalSSHD())
+                # loon reads keys from HOME and calls scp from PATH
+                os.environ.update(server.env)
+                from loon.classes import Host
+                host = Host(hostfile=os.path.join(tmpdir, 'host.json'))
+                with quiet():
+                    host.add(*server.host)
+                ctx['server'] = server
+                ctx['host'] = host
+                ctx['remote_dir'] = tempfile.mkdtemp(dir=server.tmpdir)
+                run_cases(remote_cases)
+        run_cases([c for c in cases if not c['remote']])
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    machine = baseline.pop('_machine', None)
+    if machine is not None:
+        print("=> Baseline from %s, Python %s, %s CPU(s)%s" %
+              (machine['platform'], machine['python'], machine['cpus'],
+               ', quick' if machine['quick'] else ''),
+              file=sys.stderr)
+        if machine['quick'] != args.quick:
+            print("Warning: baseline is measured %s --quick, "
+                  "values are not comparable." %
+                  ('with' if machine['quick'] else 'without'),
+                  file=sys.stderr)
+    regressed = compare(results, baseline, args.tolerance)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        baseline.update(results)
+        baseline['_machine'] = machine_info(args.quick)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2)
+        print("=> Baseline saved to %s" % args.baseline)
+    if args.check and len(regressed) > 0:
+        print("Error: %d case(s) regressed: %s" %
+              (len(regressed), ', '.join(regressed)))
+        sys.exit(1)
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+A throwaway OpenSSH server on 127.0.0.1 for benchmarks.
+
+It runs as the current user with its own host key, client key and
+authorized_keys in a temporary directory. Fake `qsub` and `qstat` are
+put on PATH of remote commands, and wrappers of `scp`/`rsync`/`ssh`
+are put on local PATH so that loon's external transfers reach this
+server without touching the real ssh configuration.
+"""
+
+import os
+import sys
+import stat
+import time
+import shutil
+import socket
+import getpass
+import tempfile
+from subprocess import Popen, run, DEVNULL
+
+FAKE_QSUB = """#!/bin/sh
+# Fake qsub: record the script and print a job id
+dir=$(dirname "$0")
+n=$(wc -l < "$dir/jobs" 2>/dev/null || echo 0)
+n=$((n + 1))
+echo "$n.fakepbs $(pwd)/$1" >> "$dir/jobs"
+echo "$n.fakepbs"
+"""
+
+FAKE_QSTAT = """#!/bin/sh
+# Fake qstat: print recorded jobs as completed
+dir=$(dirname "$0")
+if [ -n "$1" ]; then
+    grep "^$1 " "$dir/jobs" | awk '{print $1, "C"}'
+else
+    awk '{print $1, "C"}' "$dir/jobs" 2>/dev/null
+fi
+"""
+
+WRAPPER = """#!/bin/sh
+exec {real} -F {config} "$@"
+"""
+
+RSYNC_WRAPPER = """#!/bin/sh
+exec {real} -e "ssh -F {config}" "$@"
+"""
+
+
+def find_sshd():
+    """Find the sshd executable, return `None` if not found"""
+    for path in [shutil.which('sshd'), '/usr/sbin/sshd', '/usr/local/sbin/sshd']:
+        if path is not None and os.path.isfile(path):
+            return path
+    return None
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def write_script(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return
+
+
+class LocalSSHD:
+    """
+    Context manager running a local sshd
+
+    After entering, `home` is a fake home directory containing
+    `.ssh/id_rsa`, `host` is a loon host list and `env` is the
+    environment to use for loon (HOME and PATH are set).
+    """
+    def __init__(self):
+        self.sshd = find_sshd()
+        if self.sshd is None:
+            raise RuntimeError("sshd is not found")
+        self.proc = None
+        return
+
+    def __enter__(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='loon-bench-')
+        self.home = os.path.join(self.tmpdir, 'home')
+        ssh_dir = os.path.join(self.home, '.ssh')
+        self.remote_bin = os.path.join(self.tmpdir, 'remote-bin')
+        self.local_bin = os.path.join(self.tmpdir, 'local-bin')
+        for d in [ssh_dir, self.remote_bin, self.local_bin]:
+            os.makedirs(d)
+
+        key = os.path.join(ssh_dir, 'id_rsa')
+        host_key = os.path.join(self.tmpdir, 'host_key')
+        for k in [key, host_key]:
+            run([
+                'ssh-keygen', '-q', '-t', 'rsa', '-b', '2048', '-m', 'PEM',
+                '-N', '', '-f', k
+            ],
+                check=True)
+        shutil.copyfile(key + '.pub',
+                        os.path.join(self.tmpdir, 'authorized_keys'))
+
+        write_script(os.path.join(self.remote_bin, 'qsub'), FAKE_QSUB)
+        write_script(os.path.join(self.remote_bin, 'qstat'), FAKE_QSTAT)
+
+        self.port = free_port()
+        config = os.path.join(self.tmpdir, 'sshd_config')
+        with open(config, 'w') as f:
+            f.write("\n".join([
+                "Port %d" % self.port,
+                "ListenAddress 127.0.0.1",
+                "HostKey %s" % host_key,
+                "PidFile %s" % os.path.join(self.tmpdir, 'sshd.pid'),
+                "AuthorizedKeysFile %s" %
+                os.path.join(self.tmpdir, 'authorized_keys'),
+                "StrictModes no",
+                "UsePAM no",
+                "PasswordAuthentication no",
+                "PubkeyAuthentication yes",
+                "MaxSessions 100",
+                "MaxStartups 100",
+                "SetEnv PATH=%s:/usr/local/bin:/usr/bin:/bin" %
+                self.remote_bin,
+                "Subsystem sftp internal-sftp",
+                ""
+            ]))
+
+        # Client config used by scp/rsync wrappers
+        client_config = os.path.join(self.tmpdir, 'ssh_config')
+        with open(client_config, 'w') as f:
+            f.write("\n".join([
+                "Host *",
+                "  IdentityFile %s" % key,
+                "  StrictHostKeyChecking no",
+                "  UserKnownHostsFile /dev/null",
+                "  LogLevel ERROR",
+                ""
+            ]))
+        for prog in ['ssh', 'scp']:
+            real = shutil.which(prog)
+            if real is not None:
+                write_script(os.path.join(self.local_bin, prog),
+                             WRAPPER.format(real=real, config=client_config))
+        if shutil.which('rsync') is not None:
+            write_script(
+                os.path.join(self.local_bin, 'rsync'),
+                RSYNC_WRAPPER.format(real=shutil.which('rsync'),
+                                     config=client_config))
+
+        self.proc = Popen([self.sshd, '-D', '-e', '-f', config],
+                          stdout=DEVNULL,
+                          stderr=DEVNULL)
+        self._wait()
+
+        self.env = dict(os.environ)
+        self.env['HOME'] = self.home
+        self.env['PATH'] = os.pathsep.join(
+            [self.local_bin, self.env.get('PATH', '')])
+        self.host = ['bench', getpass.getuser(), '127.0.0.1', self.port]
+        return self
+
+    def _wait(self, timeout=10):
+        end = time.time() + timeout
+        while time.time() < end:
+            if self.proc.poll() is not None:
+                raise RuntimeError("sshd exited with code %d" %
+                                   self.proc.returncode)
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 0.2).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("sshd does not start in %ss" % timeout)
+
+    def jobs(self):
+        """Return lines recorded by the fake qsub"""
+        path = os.path.join(self.remote_bin, 'jobs')
+        if not os.path.isfile(path):
+            return []
+        with open(path) as f:
+            return f.read().splitlines()
+
+    def __exit__(self, *args):
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.wait()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        return False
+
+
+if __name__ == "__main__":
+    # Start a server and wait, useful for manual tests
+    with LocalSSHD() as server:
+        print("sshd is listening on 127.0.0.1:%d" % server.port)
+        print("HOME=%s PATH=%s" % (server.home, server.env['PATH']))
+        try:
+            server.proc.wait()
+        except KeyboardInterrupt:
+            sys.exit(0)
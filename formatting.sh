@@ -4,4 +4,14 @@ yapf -ir src/loon/__init__.py -vv
 yapf -ir src/loon/skeleton.py -vv
 yapf -ir src/loon/classes.py -vv
 yapf -ir src/loon/utils.py -vv
-yapf -ir src/loon/tool.py -vv
\ No newline at end of file
+yapf -ir src/loon/tool.py -vv
+yapf -ir src/loon/connection.py -vv
+yapf -ir src/loon/metrics.py -vv
+yapf -ir src/loon/remote.py -vv
+yapf -ir src/loon/shell.py -vv
+yapf -ir src/loon/profiling.py -vv
+yapf -ir src/loon/transfer.py -vv
+yapf -ir src/loon/hashindex.py -vv
+yapf -ir src/loon/watch.py -vv
+yapf -ir src/loon/multihost.py -vv
+yapf -ir src/loon/deploy.py -vv
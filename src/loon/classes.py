@@ -4,26 +4,55 @@
 import sys
 import os
 import json
+import time
 import socket
-import glob
 import re
 import io
-from getpass import getpass
+import fnmatch
 from subprocess import run, PIPE
-from datetime import datetime
+from time import perf_counter
 from shutil import copyfile
-from ssh2.session import Session
 if __package__ == '' or __package__ is None:    # Use for test
     from __init__ import __host_file__
-    from utils import create_parentdir, isfile, isdir, pretty_table, get_filelist, read_csv
+    from utils import create_parentdir, isfile, isdir, pretty_table, expand_paths, walk_files, get_size, has_magic, read_csv, read_inventory, parse_size, is_excluded
+    from connection import open_session, open_channel as new_channel, probe, retry, KEEPALIVE_INTERVAL
+    from metrics import metrics
 else:
     from loon import __host_file__
-    from loon.utils import create_parentdir, isfile, isdir, pretty_table, get_filelist, read_csv
+    from loon.utils import create_parentdir, isfile, isdir, pretty_table, expand_paths, walk_files, get_size, has_magic, read_csv, read_inventory, parse_size, is_excluded
+    from loon.connection import open_session, open_channel as new_channel, probe, retry, KEEPALIVE_INTERVAL
+    from loon.metrics import metrics
 
 this_file = os.path.realpath(__file__)
 this_dir = os.path.dirname(this_file)
 data_dir = os.path.join(this_dir, 'data')
 
+def _parse_bool(x):
+    return x.lower() in ('yes', 'true', '1', 'on')
+
+
+# Options which can be set for each host with `config`,
+# mapped to functions parsing their values
+HOST_OPTIONS = {
+    'jump': str,
+    'keepalive': int,
+    'kex': str,
+    'ciphers': str,
+    'macs': str,
+    'compression': _parse_bool,
+    'sockbuf': lambda x: 'auto' if x == 'auto' else parse_size(x),
+    'bandwidth': int,
+    'nodelay': _parse_bool,
+    'window': parse_size
+}
+
+# Candidate methods tried by `tune`, fast ones on common hardware
+TUNE_CIPHERS = [
+    'aes128-gcm@openssh.com', 'aes256-gcm@openssh.com',
+    'chacha20-poly1305@openssh.com', 'aes128-ctr', 'aes256-ctr'
+]
+TUNE_MACS = ['hmac-sha2-256-etm@openssh.com', 'hmac-sha2-256', 'hmac-sha1']
+
 
 class Host:
     """
@@ -39,11 +68,14 @@ class Host:
         if not isfile(self.hostfile):
             self.active_host = []
             self.available_hosts = []
+            self.options = {}
         else:
             with open(self.hostfile, 'r') as f:
                 hosts = json.load(f)
             self.active_host = hosts['active']
             self.available_hosts = hosts['available']
+            # Per-host options keyed by alias, e.g. jump hosts
+            self.options = hosts.get('options', {})
 
         if any(isinstance(i, list) for i in self.active_host):
             print(
@@ -53,9 +85,12 @@ class Host:
         # Python code to remove duplicate elements
         def RemoveDups(duplicate):
             final_list = []
+            seen = set()
             flag = False
             for num in duplicate:
-                if num not in final_list:
+                key = tuple(num)
+                if key not in seen:
+                    seen.add(key)
                     final_list.append(num)
                 else:
                     flag = True
@@ -74,14 +109,20 @@ class Host:
         # if len(self.active_host)==0 or len(self.available_hosts)==0:
         #     raise ValueError("Cannot save to file due to null host.")
         hosts = {'active': self.active_host, 'available': self.available_hosts}
+        if len(self.options) > 0:
+            hosts['options'] = self.options
         if not isfile(self.hostfile):
             # Create parent dir if hostfile does not exist
             create_parentdir(self.hostfile)
-        with open(self.hostfile, 'w') as f:
+        # Write to a temporary file first so that the host file
+        # is never left half-written
+        tmpfile = self.hostfile + '.tmp'
+        with open(tmpfile, 'w') as f:
             json.dump(hosts, f)
+        os.replace(tmpfile, self.hostfile)
         return
 
-    def add(self, name, username, host, port=22, dry_run=False):
+    def add(self, name, username, host, port=22, jump=None, dry_run=False):
         """Add a remote host
         
         Args:
@@ -89,6 +130,7 @@ class Host:
             username: hostname, a string
             host: host ip address, a string
             port: host ip port, an integer
+            jump: a string containing comma separated aliases of jump hosts
             dry_run: if `True`, dry run the code
 
         Returns:
@@ -104,6 +146,8 @@ class Host:
             print("=> Input host exists. Will not change.")
             return
         else:
+            if jump:
+                self.options[name] = {'jump': self.parse_jump(name, jump)}
             self.available_hosts.append(info)
             if len(self.active_host) == 0:
                 self.active_host = info
@@ -111,6 +155,96 @@ class Host:
             print("=> Added successfully!")
         return
 
+    def import_hosts(self, file_path, fmt=None, dry_run=False):
+        """Import remote hosts from an inventory file in one transaction
+
+        All hosts are validated and deduplicated in a single pass, then
+        the host file is written once. Nothing is saved if any host
+        is invalid.
+
+        Args:
+            file_path: a string representing the path to ssh config, CSV or YAML file
+            fmt: inventory format ('ssh', 'csv' or 'yaml'), guessed from file extension if `None`
+            dry_run: if `True`, dry run the code
+
+        Returns:
+            a list of newly added hosts
+        """
+        if not isfile(os.path.expanduser(file_path)):
+            print("Error: file %s does not exist" % file_path)
+            sys.exit(1)
+        try:
+            inventory = read_inventory(file_path, fmt=fmt)
+        except (ImportError, ValueError) as e:
+            print("Error: %s" % e)
+            sys.exit(1)
+
+        seen = set(tuple(h) for h in self.available_hosts)
+        aliases = dict((h[0], tuple(h)) for h in self.available_hosts)
+        new_hosts = []
+        errors = []
+        n_dup = 0
+        jumps = {}
+        for index, row in enumerate(inventory):
+            row = list(row) + [None] * (5 - len(row))
+            name, username, host, port, jump = row[:5]
+            if not username or not host:
+                errors.append("entry %d: username and host are both required" %
+                              (index + 1))
+                continue
+            try:
+                port = int(port) if port not in (None, '') else 22
+            except ValueError:
+                errors.append("entry %d: bad port %s" % (index + 1, port))
+                continue
+            info = [name if name else username, username, host, port]
+            key = tuple(info)
+            if key in seen:
+                n_dup += 1
+                continue
+            if info[0] in aliases:
+                errors.append("entry %d: alias %s already refers to %s@%s:%s" %
+                              ((index + 1, info[0]) + aliases[info[0]][1:]))
+                continue
+            seen.add(key)
+            aliases[info[0]] = key
+            new_hosts.append(info)
+            if jump:
+                jumps[info[0]] = str(jump)
+
+        # Jump hosts may refer to hosts defined later in the file
+        for name, jump in jumps.items():
+            chain = []
+            for token in jump.split(','):
+                alias = self._find_alias(token.strip(), aliases)
+                if alias is None:
+                    errors.append(
+                        "%s: jump host %s is not a known host" % (name, token))
+                chain.append(alias)
+            jumps[name] = chain
+
+        if len(errors) > 0:
+            for e in errors:
+                print("Error: %s" % e)
+            print("=> Nothing imported.")
+            sys.exit(1)
+
+        if dry_run:
+            for info in new_hosts:
+                print("=> Running add", tuple(info))
+            sys.exit(0)
+
+        if len(new_hosts) > 0:
+            for name, chain in jumps.items():
+                self.options.setdefault(name, {})['jump'] = chain
+            self.available_hosts.extend(new_hosts)
+            if len(self.active_host) == 0:
+                self.active_host = new_hosts[0]
+            self.save_hosts()
+        print("=> Imported %d hosts, skipped %d duplicates." %
+              (len(new_hosts), n_dup))
+        return new_hosts
+
     def host_check(self, name, username, host, port=22):
         """Check if a host exists
 
@@ -159,6 +293,11 @@ class Host:
         host2del = self.host_check(name, username, host, port)
         print("=> Removing host from available list...")
         self.available_hosts.remove(host2del)
+        self.options.pop(host2del[0], None)
+        for alias, opts in self.options.items():
+            if host2del[0] in opts.get('jump', []):
+                print("Warning: host %s uses the removed host as jump host." %
+                      alias)
         if host2del == self.active_host:
             print("=> Removing active host...")
             if len(self.available_hosts) > 0:
@@ -219,9 +358,106 @@ class Host:
             sys.exit(1)
         if host2rename == self.active_host:
             self.active_host[0] = new
+        if old in self.options:
+            self.options[new] = self.options.pop(old)
+        for opts in self.options.values():
+            if 'jump' in opts:
+                opts['jump'] = [new if i == old else i for i in opts['jump']]
         self.save_hosts()
         return
 
+    def _find_alias(self, token, aliases=None):
+        """Find the alias of a host given as alias or [user@]host[:port]"""
+        if aliases is None:
+            aliases = dict((h[0], tuple(h)) for h in self.available_hosts)
+        if token in aliases:
+            return token
+        m = re.match(r'^(?:([^@]+)@)?([^:@]+)(?::(\d+))?$', token)
+        if m is None:
+            return None
+        user, hostname, port = m.groups()
+        port = int(port) if port else 22
+        for alias, h in aliases.items():
+            if h[2] == hostname and int(h[3]) == port and (user is None
+                                                          or h[1] == user):
+                return alias
+        return None
+
+    def parse_jump(self, name, jump):
+        """Parse comma separated jump hosts of a host into a list of aliases"""
+        chain = []
+        for token in jump.split(','):
+            alias = self._find_alias(token.strip())
+            if alias is None or alias == name:
+                print("Error: jump host %s is not a known host." % token)
+                sys.exit(1)
+            chain.append(alias)
+        return chain
+
+    def jump_chain(self, host, _seen=()):
+        """Get hosts to connect through in order before connecting a host
+
+        Jump hosts of the first jump host come first, like ProxyJump of ssh.
+
+        Args:
+            host: a list representing the host
+
+        Returns:
+            a list of hosts
+        """
+        aliases = self.options.get(host[0], {}).get('jump', [])
+        if len(aliases) == 0:
+            return []
+        if host[0] in _seen:
+            print("Error: jump hosts of %s form a loop." % host[0])
+            sys.exit(1)
+        hosts = [self.host_check(i, None, None) for i in aliases]
+        return self.jump_chain(hosts[0], _seen + (host[0], )) + hosts
+
+    def config(self, name=None, settings=None, dry_run=False):
+        """Show or change options of a host
+
+        Args:
+            name: a string representing the host alias, default is the active host
+            settings: a list of 'key=value' strings, an empty value removes the option
+            dry_run: if `True`, dry run the code
+
+        Returns:
+            a dict containing options of the host
+        """
+        host = self.host_check(name, None, None) if name else self.active_host
+        if len(host) == 0:
+            print("Error: no active host.")
+            sys.exit(1)
+        opts = dict(self.options.get(host[0], {}))
+        if not settings:
+            content = [[k, ','.join(v) if isinstance(v, list) else v]
+                       for k, v in sorted(opts.items())]
+            pretty_table(['Option', 'Value'], content)
+            return opts
+        for item in settings:
+            key, sep, value = item.partition('=')
+            if not sep or key not in HOST_OPTIONS:
+                print("Error: bad option %s, supported options are %s." %
+                      (item, ', '.join(sorted(HOST_OPTIONS))))
+                sys.exit(1)
+            if value == '':
+                opts.pop(key, None)
+            elif key == 'jump':
+                opts[key] = self.parse_jump(host[0], value)
+            else:
+                opts[key] = HOST_OPTIONS[key](value)
+        if dry_run:
+            print("Running config", host[0], opts)
+            sys.exit(0)
+        if len(opts) > 0:
+            self.options[host[0]] = opts
+        else:
+            self.options.pop(host[0], None)
+        self.save_hosts()
+        print("=> Options of %s saved." % host[0])
+        return opts
+
     def list(self):
         """List all remote hosts"""
 
@@ -237,37 +473,344 @@ class Host:
     def connect(self,
                 privatekey_file="~/.ssh/id_rsa",
                 passphrase='',
-                open_channel=True):
+                open_channel=True,
+                bulk=False):
         """Connect active host and open a session
         
         Args:
             privatekey_file: a string representing the path to the private key file
             passphrase: a string representing the password
             open_channel: if `True`, open the SSH channel
+            bulk: if `True`, the session transfers files, see `socket_options`
 
         Returns:
             None
         """
-        privatekey_file = os.path.expanduser(privatekey_file)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((self.active_host[2], self.active_host[3]))
-        s = Session()
-        s.handshake(sock)
-        try:
-            # Try using private key file first
-            s.userauth_publickey_fromfile(self.active_host[1], privatekey_file,
-                                          passphrase)
-        except:
-            # Use password to auth
-            passwd = getpass(
-                'No private key found.\nEnter your password for %s: ' %
-                self.active_host[1])
-            s.userauth_password(self.active_host[1], passwd)
+        s, self.sock = self.open_host(self.active_host,
+                                      privatekey_file=privatekey_file,
+                                      passphrase=passphrase,
+                                      bulk=bulk)
         self.session = s
+        self.window = self.options.get(self.active_host[0], {}).get('window')
         if open_channel:
-            self.channel = self.session.open_session()
+            self.channel = new_channel(self.session, self.window)
+        # Used by reconnect
+        self._connect_args = (privatekey_file, passphrase, open_channel, bulk)
+        return
+
+    def open_host(self,
+                  host,
+                  privatekey_file="~/.ssh/id_rsa",
+                  passphrase='',
+                  bulk=False):
+        """Open a session to any available host with its options
+
+        Args:
+            host: a list representing the host
+            privatekey_file: a string representing the path to the private key file
+            passphrase: a string representing the password
+            bulk: if `True`, the session transfers files, see `socket_options`
+
+        Returns:
+            a tuple (session, socket)
+        """
+        opts = self.options.get(host[0], {})
+        return open_session(host,
+                            privatekey_file=privatekey_file,
+                            passphrase=passphrase,
+                            jump=self.jump_chain(host),
+                            keepalive=opts.get('keepalive',
+                                               KEEPALIVE_INTERVAL),
+                            methods=opts,
+                            sockopts=self.socket_options(host, bulk))
+
+    def select_hosts(self, patterns):
+        """Get available hosts by aliases or shell-style patterns of aliases
+
+        Args:
+            patterns: a list of strings, each may also be a comma separated
+                list, e.g. ['node1,node2', 'gpu*']
+
+        Returns:
+            a list of hosts without duplicates, in the order given
+        """
+        hosts = []
+        for pattern in patterns:
+            for token in pattern.split(','):
+                token = token.strip()
+                if token == '':
+                    continue
+                if has_magic(token):
+                    matched = [
+                        h for h in self.available_hosts
+                        if fnmatch.fnmatchcase(h[0], token)
+                    ]
+                    if len(matched) == 0:
+                        print("Error: no host alias matches %s." % token)
+                        sys.exit(1)
+                else:
+                    matched = [self.host_check(token, None, None)]
+                hosts.extend(h for h in matched if h not in hosts)
+        return hosts
+
+    def connect_hosts(self, hosts, thread=16, bulk=False):
+        """Connect hosts in parallel, a failed host does not stop others
+
+        Args:
+            hosts: a list of hosts
+            thread: number of hosts to connect at the same time
+            bulk: if `True`, the sessions transfer files, see `socket_options`
+
+        Returns:
+            a tuple (dict mapping aliases to (session, socket), dict mapping aliases to errors)
+        """
+        def connect(host):
+            try:
+                return self.open_host(host, bulk=bulk), None
+            except Exception as e:
+                return None, str(e) or e.__class__.__name__
+
+        from multiprocessing.pool import ThreadPool
+        with ThreadPool(processes=max(1, min(thread, len(hosts)))) as p:
+            results = p.map(connect, hosts)
+        connected, errors = {}, {}
+        for host, (conn, error) in zip(hosts, results):
+            if error is None:
+                connected[host[0]] = conn
+            else:
+                errors[host[0]] = error
+        return connected, errors
+
+    @staticmethod
+    def disconnect_hosts(connected):
+        """Close connections returned by `connect_hosts`"""
+        for session, sock in connected.values():
+            try:
+                session.disconnect()
+            except Exception:
+                pass
+            sock.close()
         return
 
+    def socket_options(self, host=None, bulk=False):
+        """Get socket options of a host (default is the active host) from its options
+
+        Args:
+            host: a list representing the host
+            bulk: if `True`, the session transfers files, so TCP_NODELAY
+                is left off and full packets are sent
+
+        Returns:
+            a dict, see `connection.set_socket_options`
+        """
+        opts = self.options.get((host or self.active_host)[0], {})
+        sockopts = {}
+        if not bulk:
+            # Commands are interactive, do not wait to fill packets
+            sockopts['nodelay'] = opts.get('nodelay', True)
+        if opts.get('sockbuf'):
+            sockopts['sockbuf'] = opts['sockbuf']
+        if opts.get('bandwidth'):
+            sockopts['bandwidth'] = opts['bandwidth'] * 1000 * 1000
+        return sockopts
+
+    def reconnect(self):
+        """Drop the current session and connect active host again"""
+        try:
+            self.session.disconnect()
+        except Exception:
+            pass
+        self.sock.close()
+        self.connect(*self._connect_args)
+        return
+
+    def retry(self, func, reconnect=True, retries=2):
+        """Call a function, reconnect and call it again when the connection is lost
+
+        Only use it for idempotent operations like listing and status polling.
+
+        Args:
+            func: a function without arguments, it should get the session
+                from this object on each call
+            reconnect: if `True`, reconnect before retrying
+            retries: maximum number of retries
+
+        Returns:
+            the return value of `func`
+        """
+        return retry(func,
+                     reconnect=self.reconnect if reconnect else None,
+                     retries=retries,
+                     name=self.active_host[0])
+
+    def tune(self, name=None, size=16, save=True, dry_run=False):
+        """Benchmark cipher, MAC and compression methods against a host
+
+        Each combination supported by both sides is used to transfer
+        random data in both directions, the fastest one is saved to
+        options of the host.
+
+        Args:
+            name: a string representing the host alias, default is the active host
+            size: size of data (MB) to transfer in each direction
+            save: if `True`, save the fastest methods to options of the host
+            dry_run: if `True`, dry run the code
+
+        Returns:
+            a list of dicts containing methods and throughput (MB/s), fastest first
+        """
+        if __package__ == '' or __package__ is None:    # Use for test
+            from remote import measure_throughput
+        else:
+            from loon.remote import measure_throughput
+        from ssh2.session import Session, LIBSSH2_METHOD_CRYPT_CS, \
+            LIBSSH2_METHOD_MAC_CS, LIBSSH2_METHOD_COMP_CS
+
+        host = self.host_check(name, None, None) if name else self.active_host
+        if len(host) == 0:
+            print("Error: no active host.")
+            sys.exit(1)
+        local = Session()
+        ciphers = [
+            c for c in TUNE_CIPHERS
+            if c in local.supported_algs(LIBSSH2_METHOD_CRYPT_CS)
+        ]
+        macs = [
+            m for m in TUNE_MACS
+            if m in local.supported_algs(LIBSSH2_METHOD_MAC_CS)
+        ]
+        compressions = [False]
+        if any(c.startswith('zlib')
+               for c in local.supported_algs(LIBSSH2_METHOD_COMP_CS)):
+            compressions.append(True)
+        candidates = []
+        for cipher in ciphers:
+            # MAC is part of AEAD ciphers
+            aead = 'gcm' in cipher or 'poly1305' in cipher
+            for mac in (macs[:1] if aead else macs):
+                for comp in compressions:
+                    candidates.append({
+                        'ciphers': cipher,
+                        'macs': mac,
+                        'compression': comp
+                    })
+        if dry_run:
+            print("Running tune on %s with %d candidates" %
+                  (host[0], len(candidates)))
+            sys.exit(0)
+
+        results = []
+        nbytes = int(size * 1024 * 1024)
+        jump = self.jump_chain(host)
+        opts = self.options.get(host[0], {})
+        for methods in candidates:
+            print("=> Trying %s, %s, compression %s..." %
+                  (methods['ciphers'], methods['macs'],
+                   'on' if methods['compression'] else 'off'))
+            res = dict(methods)
+            try:
+                s, sock = open_session(host,
+                                       jump=jump,
+                                       methods=dict(opts, **methods),
+                                       sockopts=self.socket_options(host))
+                try:
+                    down, up = measure_throughput(s,
+                                                  nbytes,
+                                                  window=opts.get('window'))
+                finally:
+                    s.disconnect()
+                    sock.close()
+            except Exception as e:
+                print("Warning: %s" % (str(e) or e.__class__.__name__))
+                continue
+            res['download'] = size / down
+            res['upload'] = size / up
+            res['total'] = 2 * size / (down + up)
+            results.append(res)
+        if len(results) == 0:
+            print("Error: no method combination works with %s." % host[0])
+            sys.exit(1)
+        results.sort(key=lambda x: -x['total'])
+
+        title = [
+            'Cipher', 'MAC', 'Compression', 'Download(MB/s)', 'Upload(MB/s)',
+            'Total(MB/s)'
+        ]
+        content = [[
+            r['ciphers'], r['macs'], 'on' if r['compression'] else 'off',
+            '%.1f' % r['download'],
+            '%.1f' % r['upload'],
+            '%.1f' % r['total']
+        ] for r in results]
+        pretty_table(title, content)
+        if save:
+            best = results[0]
+            opts = dict(opts)
+            for key in ('ciphers', 'macs', 'compression'):
+                opts[key] = best[key]
+            self.options[host[0]] = opts
+            self.save_hosts()
+            print("=> %s, %s and compression %s saved for %s." %
+                  (best['ciphers'], best['macs'],
+                   'on' if best['compression'] else 'off', host[0]))
+        return results
+
+    def ping(self, names=None, timeout=5, thread=8, dry_run=False):
+        """Check connection health of remote hosts concurrently
+
+        TCP connection, SSH handshake and authentication are done for
+        each host with timeout, the password is never asked.
+
+        Args:
+            names: a list of host aliases, all available hosts are checked if `None`
+            timeout: timeout in seconds for each phase
+            thread: number of hosts to check in parallel
+            dry_run: if `True`, dry run the code
+
+        Returns:
+            a list of dicts containing status and timings, sorted by total latency
+        """
+        if names is None or len(names) == 0:
+            hosts = self.available_hosts
+        else:
+            hosts = [self.host_check(i, None, None) for i in names]
+        if dry_run:
+            print("Running ping on", [h[0] for h in hosts])
+            sys.exit(0)
+        if len(hosts) == 0:
+            print("=> No host available.")
+            return []
+
+        chains = [self.jump_chain(h) for h in hosts]
+        from multiprocessing.pool import ThreadPool
+        with ThreadPool(processes=max(1, min(thread, len(hosts)))) as p:
+            results = p.starmap(
+                lambda h, jump: probe(h, timeout=timeout, jump=jump),
+                zip(hosts, chains))
+        for res in results:
+            res['total'] = sum(res['timings'].values())
+        results.sort(key=lambda x: (not x['ok'], x['total']))
+
+        title = [
+            'Alias', 'Status', 'DNS(ms)', 'TCP(ms)', 'Handshake(ms)',
+            'Auth(ms)', 'Total(ms)'
+        ]
+        content = []
+        for res in results:
+            row = [res['name'], 'OK' if res['ok'] else 'FAILED']
+            for phase in ['dns', 'tcp', 'handshake', 'auth']:
+                if phase in res['timings']:
+                    row.append('%.1f' % (res['timings'][phase] * 1000))
+                else:
+                    row.append('-')
+            row.append('%.1f' % (res['total'] * 1000))
+            content.append(row)
+        pretty_table(title, content)
+        for res in results:
+            if not res['ok']:
+                print("Error: %s: %s" % (res['name'], res['error']))
+        return results
+
     def cmd(self,
             commands,
             _logger=None,
@@ -276,6 +819,11 @@ class Host:
             remote_file=False,
             dir='/tmp',
             prog=None,
+            cache=False,
+            cache_size=512,
+            parallel=1,
+            persist=False,
+            idle=600,
             dry_run=False):
         """Run command(s) in active remote host using channel session
         Therefore, `open_channel` in `connect` method must be `True` before using it.
@@ -288,17 +836,30 @@ class Host:
             remote_file: if `True`, collect input from remote host instead of local machine
             dir: Remote directory for storing local scripts
             prog: a string representing the program to run the commands
+            cache: if `True`, keep local scripts and data in a content addressed cache
+                on remote host and only upload files not in it
+            cache_size: maximum size of the remote cache in MB
+            parallel: number of scripts to run at the same time, each in its own channel
+            persist: if `True`, run commands in the persistent shell of the host,
+                which keeps environment between calls
+            idle: seconds after which an idle persistent shell exits
             dry_run: if `True`, dry run the code
 
         Returns:
             A string containing result information
         """
+        if __package__ == '' or __package__ is None:    # Use for test
+            from remote import RemoteGlob, ScriptCache
+        else:
+            from loon.remote import RemoteGlob, ScriptCache
         if dry_run:
             print("Running", "files:" if run_file else "commands:", commands)
             sys.exit(0)
         if not run_file:
+            if persist:
+                return self.run_persistent(commands, idle=idle)
             self.connect()
-            self.channel.execute(commands)
+            self.execute(commands)
         else:
             # Run scripts
             _logger.info(commands)
@@ -307,20 +868,25 @@ class Host:
             if remote_file:
                 # Run remote scripts
                 # Support some wildcards
-                # *,?,{}
-                wildcards = r'\*|\?|\{\}'
-                matches = [
-                    re.compile(wildcards).search(i) is not None
-                    for i in scripts
-                ]
-                if any(matches):
-                    commands_1 = list(map(lambda x: 'ls ' + x, scripts))
-                    commands_1 = ';'.join(commands_1)
-                    self.connect()
-                    self.channel.execute(commands_1)
-                    scripts = self.get_result(print_info=False).split('\n')
-                    if '' in scripts:
-                        scripts.remove('')
+                # *,?,[],{a,b} and **
+                self.connect()
+                if any(has_magic(i) for i in scripts):
+                    # Expand on the opened session through SFTP
+                    def expand():
+                        rglob = RemoteGlob(self.session)
+                        expanded = []
+                        for pattern in scripts:
+                            if not has_magic(pattern):
+                                expanded.append(pattern)
+                                continue
+                            entries = [e for e in rglob.glob(pattern) if not e.is_dir]
+                            if len(entries) == 0:
+                                print('Error: no remote file matches %s.' % pattern)
+                                sys.exit(1)
+                            expanded.extend(e.path for e in entries)
+                        return expanded
+
+                    scripts = self.retry(expand)
                 if prog is None:
                     commands_1 = list(map(lambda x: 'chmod u+x ' + x, scripts))
                     commands_1 = ';'.join(commands_1)
@@ -330,17 +896,37 @@ class Host:
                     commands = list(
                         map(lambda x: '{} '.format(prog) + x, scripts))
                     commands = ';'.join(commands)
+                if parallel > 1:
+                    return self.run_parallel(scripts, prog, parallel)
                 _logger.info(commands)
-                self.connect()
                 print("=> Getting results:")
-                self.channel.execute(commands)
+                self.execute(commands)
             else:
                 # Run local scripts
                 #
                 # 1) upload
-                self.upload(scripts, dir, _logger)
-                if data_dir is not None:
-                    self.upload(data_dir, dir, _logger)
+                sources = scripts + ([data_dir] if data_dir is not None else [])
+                if cache:
+                    # Link cached copies on remote host, only files
+                    # not in cache are transferred
+                    self.connect()
+                    mapping = {}
+                    for f, is_dir in expand_paths(map(os.path.expanduser, sources)):
+                        if is_dir:
+                            # Same layout as 'scp -r'
+                            base = os.path.basename(os.path.normpath(f))
+                            for entry in walk_files(f, follow_symlinks=True):
+                                rel = os.path.relpath(entry.path, f)
+                                mapping['/'.join([dir, base] + rel.split(os.sep))] = entry.path
+                        elif is_dir is not None:
+                            mapping['/'.join([dir, os.path.basename(f)])] = f
+                    # Uploads are resumed from scratch, objects already
+                    # in cache are skipped
+                    link_cmds = self.retry(lambda: ScriptCache(
+                        self.session, max_size=cache_size * 1024 * 1024).sync(
+                            mapping))
+                else:
+                    self.upload(sources, dir, _logger)
                 # 2) get all file names
                 if len(scripts) == 1:
                     if isdir(scripts[0]):
@@ -351,23 +937,19 @@ class Host:
                         else:
                             dir = os.path.join(dir,
                                                os.path.basename(scripts[0]))
-                        scripts = glob.glob(scripts[0] + '/*')
+                        scripts = [os.path.join(scripts[0], '*')]
                 filelist = []
-                for fp in scripts:
-                    _logger.info("fp:%s" % fp)
-                    fs = glob.glob(fp)
-                    _logger.info("fs:%s" % fs)
-                    for f in fs:
-                        _logger.info("f:%s" % f)
-                        if isdir(f):
-                            print(
-                                "Warning: directory %s is detected, note anything in it will be ignored to execute."
-                                % f)
-                        elif isfile(f):
-                            filelist.append(f)
-                        else:
-                            print('Error: file %s does not exist.' % f)
-                            sys.exit(1)
+                for f, is_dir in expand_paths(scripts):
+                    _logger.info("f:%s" % f)
+                    if is_dir:
+                        print(
+                            "Warning: directory %s is detected, note anything in it will be ignored to execute."
+                            % f)
+                    elif is_dir is not None:
+                        filelist.append(f)
+                    else:
+                        print('Error: file %s does not exist.' % f)
+                        sys.exit(1)
                 filelist = list(map(os.path.basename, filelist))
                 _logger.info(filelist)
                 # 3) run them one by one
@@ -381,15 +963,168 @@ class Host:
                     commands = list(
                         map(lambda x: '{} '.format(prog) + x, scripts))
                     commands = ';'.join(commands)
+                if not cache:
+                    self.connect()
+                if parallel > 1:
+                    return self.run_parallel(scripts,
+                                             prog,
+                                             parallel,
+                                             setup=link_cmds if cache else None)
+                if cache and link_cmds:
+                    commands = link_cmds + ';' + commands
                 _logger.info(commands)
-                self.connect()
                 print("=> Getting results:")
-                self.channel.execute(commands)
+                self.execute(commands)
 
         datalist = self.get_result()
         # Return a string containing output
         return "".join(datalist)
 
+    def run_persistent(self, commands, idle=600):
+        """Run command(s) in the persistent shell of active remote host
+
+        The shell is kept by a background process for `idle` seconds
+        after the last call, so environment set by previous calls
+        (e.g. `source activate`, `cd`, exported variables) is kept.
+
+        Args:
+            commands: a string representing commands to run
+            idle: seconds after which an idle persistent shell exits
+
+        Returns:
+            A string containing output of commands
+        """
+        if __package__ == '' or __package__ is None:    # Use for test
+            import shell
+        else:
+            from loon import shell
+        if not hasattr(socket, 'AF_UNIX'):
+            print("Error: persistent shell is not supported on this platform.")
+            sys.exit(1)
+        try:
+            with metrics.timer('exec',
+                               phase='persistent',
+                               host=self.active_host[0]):
+                stdout, stderr, status = shell.run_persistent(
+                    self.active_host,
+                    commands,
+                    idle=idle,
+                    jump=self.jump_chain(self.active_host))
+        except ConnectionError as e:
+            print("Error: %s" % e)
+            sys.exit(1)
+        print(stdout, sep='', end='')
+        if stderr:
+            print(stderr, sep='', end='', file=sys.stderr)
+        if status != 0:
+            sys.exit(status)
+        return stdout
+
+    def stop_shell(self, dry_run=False):
+        """Stop the persistent shell of active remote host
+
+        Args:
+            dry_run: if `True`, dry run the code
+
+        Returns:
+            None
+        """
+        if __package__ == '' or __package__ is None:    # Use for test
+            import shell
+        else:
+            from loon import shell
+        if dry_run:
+            print("Stopping persistent shell of %s" % self.active_host[0])
+            sys.exit(0)
+        if shell.stop_server(self.active_host[0]):
+            print("=> Persistent shell of %s stopped." % self.active_host[0])
+        else:
+            print("=> No persistent shell of %s is running." %
+                  self.active_host[0])
+        return
+
+    def list_shells(self):
+        """List hosts which have a running persistent shell"""
+        if __package__ == '' or __package__ is None:    # Use for test
+            import shell
+        else:
+            from loon import shell
+        aliases = shell.list_servers()
+        if len(aliases) == 0:
+            print("=> No persistent shell is running.")
+            return
+        content = [h for h in self.available_hosts if h[0] in aliases]
+        pretty_table(['Alias', 'Username', 'IP address', 'Port'], content)
+        return
+
+    def run_parallel(self, scripts, prog=None, parallel=4, setup=None):
+        """Run scripts concurrently on the connected active remote host
+
+        Each script runs in its own channel of the current session, output
+        of a script is printed as a whole when it finishes.
+
+        Args:
+            scripts: a list of script paths on remote host
+            prog: a string representing the program to run the scripts
+            parallel: maximum number of scripts running at the same time
+            setup: commands to run before all scripts, if any
+
+        Returns:
+            A string containing output of all scripts in input order
+        """
+        if __package__ == '' or __package__ is None:    # Use for test
+            from remote import run_parallel
+        else:
+            from loon.remote import run_parallel
+        if setup:
+            self.execute(setup)
+            self.get_result(print_info=False)
+        if prog is None:
+            commands = ['chmod u+x {0};{0}'.format(x) for x in scripts]
+        else:
+            commands = ['{} {}'.format(prog, x) for x in scripts]
+
+        def report(job):
+            print("=> %s finished with exit status %d" %
+                  (job['name'], job['status']))
+            print(job['stdout'], sep='', end='')
+            if job['stderr']:
+                print(job['stderr'], sep='', end='', file=sys.stderr)
+
+        print("=> Running %d scripts with %d channels:" %
+              (len(scripts), parallel))
+        with metrics.timer('exec',
+                           phase='parallel',
+                           host=self.active_host[0],
+                           items=len(commands)):
+            jobs = run_parallel(self.session,
+                                self.sock,
+                                commands,
+                                parallel=parallel,
+                                window=self.window,
+                                names=scripts,
+                                callback=report)
+        failed = [job for job in jobs if job['status'] != 0]
+        if len(failed) > 0:
+            print("Error: %d of %d scripts failed: %s" %
+                  (len(failed), len(jobs), ', '.join(j['name'] for j in failed)))
+            sys.exit(1)
+        return "".join(job['stdout'] for job in jobs)
+
+    def execute(self, commands):
+        """Execute command(s) on the opened channel
+
+        Args:
+            commands: a string representing commands to run
+
+        Returns:
+            None
+        """
+        with metrics.timer('exec', host=self.active_host[0]):
+            self.channel.execute(commands)
+        self._exec_time = perf_counter()
+        return
+
     def get_result(self, print_info=True):
         """Get result from executed channel
         
@@ -399,22 +1134,36 @@ class Host:
         Returns:
             a string containing output from executed commands
         """
+        start = getattr(self, '_exec_time', perf_counter())
+        # Read stdout first, a blocking read of stderr only returns
+        # once the command has finished
+        datalist = []
+        nbytes = 0
+        size, data = self.channel.read()
+        first_byte = perf_counter()
+        metrics.record('exec',
+                       first_byte - start,
+                       phase='first_byte',
+                       host=self.active_host[0])
+        # Here data is byte type
+        while size > 0:
+            nbytes += size
+            data = data.decode('utf-8', errors='ignore')
+            if print_info:
+                print(data, sep='', end='')
+            datalist.append(data)
+            size, data = self.channel.read()
+        metrics.record('exec',
+                       perf_counter() - first_byte,
+                       phase='drain',
+                       nbytes=nbytes,
+                       host=self.active_host[0])
+
         size, errinfo = self.channel.read_stderr()
         if size > 0:
             print('An error is raised by remote host, please read the info:\n')
             print(errinfo.decode('utf-8', errors='replace'), end="")
             sys.exit(1)
-        else:
-            # Get output
-            datalist = []
-            size, data = self.channel.read()
-            # Here data is byte type
-            while size > 0:
-                data = data.decode('utf-8', errors='ignore')
-                if print_info:
-                    print(data, sep='', end='')
-                datalist.append(data)
-                size, data = self.channel.read()
 
         # Return a string containing output from commands
         return "".join(datalist)
@@ -424,7 +1173,10 @@ class Host:
                destination,
                _logger,
                use_rsync=False,
-               dry_run=False):
+               dry_run=False,
+               use_sftp=False,
+               checksum=False,
+               verify=False):
         """Upload files to active remote host.
 
         Currently, it is dependent on scp command.
@@ -435,6 +1187,12 @@ class Host:
             _logger: the logging logger
             use_rsync: if `True`, use rsync instead of scp
             dry_run: if `True`, dry run the code
+            use_sftp: if `True`, transfer through SFTP of loon's own
+                session instead of scp
+            checksum: if `True`, skip files whose remote copy has the
+                same content, implies `use_sftp`
+            verify: if `True`, compare hashes of both sides after
+                uploading and upload mismatched files again
 
         Returns:
             None
@@ -444,6 +1202,11 @@ class Host:
             print("Running upload", ' '.join(source), "to", destination, "on",
                   tuple(self.active_host[1:]))
             sys.exit(0)
+        if use_sftp or checksum:
+            print("=> Starting upload...", end="\n\n")
+            self._sftp_transfer('upload', source, destination, _logger,
+                                checksum, verify)
+            return
         # Make sure scp/rsync recognize destination as directory
         # Path must end with '/'
         if list(destination)[-1] != '/':
@@ -467,15 +1230,24 @@ class Host:
                 destination=destination)
 
         print("=> Starting upload...", end="\n\n")
-        now = datetime.now()
-        _logger.info("Running " + cmds)
-        run_res = run(cmds, shell=True)
-        _logger.info("Status code: " + str(run_res.returncode))
-        if run_res.returncode != 0:
-            print("Error: an error occurred, please check the info!")
-            sys.exit(run_res.returncode)
-        taken = datetime.now() - now
-        print("\n=> Finished uploading in %ss" % taken.seconds)
+        with metrics.timer('upload', host=self.active_host[0]) as info:
+            now = perf_counter()
+            _logger.info("Running " + cmds)
+            run_res = run(cmds, shell=True)
+            _logger.info("Status code: " + str(run_res.returncode))
+            if run_res.returncode != 0:
+                print("Error: an error occurred, please check the info!")
+                sys.exit(run_res.returncode)
+            taken = perf_counter() - now
+            if metrics.enabled:
+                # Walking the sources again is only worth it for metrics
+                info['bytes'] = get_size(source)
+        msg = "\n=> Finished uploading in %.2fs" % taken
+        if 'bytes' in info and taken > 0:
+            msg += " (%.2f MB/s)" % (info['bytes'] / 1e6 / taken)
+        print(msg)
+        if verify:
+            self._verify('upload', source, destination, use_rsync)
         return
 
     def download(self,
@@ -483,7 +1255,10 @@ class Host:
                  destination,
                  _logger,
                  use_rsync=False,
-                 dry_run=False):
+                 dry_run=False,
+                 use_sftp=False,
+                 checksum=False,
+                 verify=False):
         """Download files to local machine from active remote host.
         
         Currently, it is dependent on scp command.
@@ -494,6 +1269,12 @@ class Host:
             _logger: the logging logger
             use_rsync: if `True`, use rsync instead of scp
             dry_run: if `True`, dry run the code
+            use_sftp: if `True`, transfer through SFTP of loon's own
+                session instead of scp
+            checksum: if `True`, skip existing local files with the
+                same content, implies `use_sftp`
+            verify: if `True`, compare hashes of both sides after
+                downloading and download mismatched files again
 
         Returns:
             None
@@ -503,6 +1284,11 @@ class Host:
             print("Running download", ' '.join(source), "to", destination,
                   "from", tuple(self.active_host[1:]))
             sys.exit(0)
+        if use_sftp or checksum:
+            print("=> Starting downloading...", end="\n\n")
+            self._sftp_transfer('download', source, destination, _logger,
+                                checksum, verify)
+            return
         if not isdir(os.path.expanduser(destination)):
             os.makedirs(os.path.expanduser(destination))
         # Make sure scp/rsync recognize destination as directory
@@ -510,7 +1296,6 @@ class Host:
         if list(destination)[-1] != '/':
             destination = destination + '/'
         print("=> Starting downloading...", end="\n\n")
-        now = datetime.now()
         if use_rsync:
             if sys.platform == 'win32':
                 print("--rsync is disabled in Windows, please don't use it.")
@@ -528,14 +1313,583 @@ class Host:
                 username=username,
                 host=host,
                 destination=os.path.expanduser(destination))
-        _logger.info("Running " + cmds)
-        run_res = run(cmds, shell=True)
-        _logger.info("Status code: " + str(run_res.returncode))
-        if run_res.returncode != 0:
-            print("Error: an error occurred, please check the info!")
-            sys.exit(run_res.returncode)
-        taken = datetime.now() - now
-        print("\n=> Finished downloading in %ss" % taken.seconds)
+        with metrics.timer('download', host=self.active_host[0]) as info:
+            now = perf_counter()
+            _logger.info("Running " + cmds)
+            run_res = run(cmds, shell=True)
+            _logger.info("Status code: " + str(run_res.returncode))
+            if run_res.returncode != 0:
+                print("Error: an error occurred, please check the info!")
+                sys.exit(run_res.returncode)
+            taken = perf_counter() - now
+            if metrics.enabled:
+                # Only size of sources without wildcards can be known
+                info['bytes'] = get_size([
+                    os.path.join(destination, os.path.basename(i.rstrip('/')))
+                    for i in source if re.search(r'\*|\?|\[', i) is None
+                ])
+        msg = "\n=> Finished downloading in %.2fs" % taken
+        if 'bytes' in info and taken > 0:
+            msg += " (%.2f MB/s)" % (info['bytes'] / 1e6 / taken)
+        print(msg)
+        if verify:
+            self._verify('download', source, destination, use_rsync)
+        return
+
+    def _sftp_transfer(self,
+                       direction,
+                       source,
+                       destination,
+                       _logger,
+                       checksum=False,
+                       verify=False):
+        """Upload or download files through SFTP of a new session
+
+        Args:
+            direction: 'upload' or 'download'
+            source: list of files (directories) to transfer
+            destination: destination directory
+            _logger: the logging logger
+            checksum: if `True`, skip files with the same content on both sides
+            verify: if `True`, verify transferred files by hashes
+
+        Returns:
+            None
+        """
+        if __package__ == '' or __package__ is None:    # Use for test
+            from hashindex import HashIndex
+            import transfer
+        else:
+            from loon.hashindex import HashIndex
+            from loon import transfer
+        func = transfer.upload if direction == 'upload' else transfer.download
+        self.connect(open_channel=False, bulk=True)
+        # Only downloads are received through the window of this side
+        kwargs = {'window': self.window} if direction == 'download' else {}
+        index = HashIndex() if checksum or verify else None
+        with metrics.timer(direction, host=self.active_host[0],
+                           method='sftp') as info:
+            now = perf_counter()
+            _logger.info("Running SFTP %s of %s to %s" %
+                         (direction, ' '.join(source), destination))
+            try:
+                res = func(self.session,
+                           source,
+                           destination,
+                           index=index,
+                           checksum=checksum,
+                           verify=verify,
+                           **kwargs)
+            except Exception as e:
+                print("Error: %s failed: %s" % (direction, e))
+                sys.exit(1)
+            finally:
+                if index is not None:
+                    index.close()
+            info['bytes'] = res['bytes']
+            info['items'] = res['files']
+            taken = perf_counter() - now
+        if checksum:
+            print("=> %d file(s) unchanged, skipped" % res['skipped'])
+        print("=> Finished %sing %d file(s) in %.2fs (%.2f MB/s)" %
+              (direction, res['files'], taken,
+               res['bytes'] / 1e6 / taken if taken > 0 else 0))
+        if verify:
+            self._report_verify(res['files'], res['mismatched'],
+                                res['failed'])
+        return
+
+    def _verify(self, direction, source, destination, use_rsync=False):
+        """Verify files transferred by scp or rsync, transfer mismatched ones again through SFTP
+
+        Args:
+            direction: 'upload' or 'download'
+            source: list of files (directories) transferred
+            destination: destination directory
+            use_rsync: if `True`, sources ending with '/' stand for their contents
+
+        Returns:
+            None
+        """
+        if __package__ == '' or __package__ is None:    # Use for test
+            from remote import RemoteGlob
+            from hashindex import HashIndex
+            import transfer
+        else:
+            from loon.remote import RemoteGlob
+            from loon.hashindex import HashIndex
+            from loon import transfer
+        print("=> Verifying...")
+        self.connect(open_channel=False, bulk=True)
+        with HashIndex() as index, metrics.timer(
+                'verify', host=self.active_host[0]) as info:
+            try:
+                rglob = RemoteGlob(self.session, self.window)
+                if use_rsync:
+                    source = self._rsync_contents(direction, source, rglob)
+                if direction == 'upload':
+                    pairs = transfer.plan_upload(rglob, source, destination)
+                else:
+                    pairs = [(i[1], i[0].path) for i in transfer.plan_download(
+                        rglob, source, destination)]
+                mismatched, failed = transfer.verify_files(
+                    self.session, pairs, index, direction, rglob.sftp)
+            except Exception as e:
+                print("Error: verification failed: %s" % e)
+                sys.exit(1)
+            info['items'] = len(pairs)
+        self._report_verify(len(pairs), mismatched, failed)
+        return
+
+    def _rsync_contents(self, direction, source, rglob):
+        """Replace sources ending with '/' by their entries, like rsync does"""
+        res = []
+        for path in source:
+            if not path.endswith('/'):
+                res.append(path)
+            elif direction == 'upload':
+                path = os.path.expanduser(path)
+                res.extend(
+                    os.path.join(path, name)
+                    for name in sorted(os.listdir(path)))
+            else:
+                for entry in rglob.glob(path):
+                    res.extend(i.path for i in rglob.listdir(entry.path))
+        return res
+
+    @staticmethod
+    def _report_verify(nfile, mismatched, failed):
+        """Print result of verification, exit if some files still differ"""
+        print("=> Verified %d file(s), %d mismatched" %
+              (nfile, len(mismatched)))
+        if len(failed) > 0:
+            print("Error: %d file(s) still differ after transferring again:" %
+                  len(failed))
+            for local_path, remote_path in failed:
+                print("  %s <-> %s" % (local_path, remote_path))
+            sys.exit(1)
+        if len(mismatched) > 0:
+            print("=> %d mismatched file(s) transferred again and verified" %
+                  len(mismatched))
+        return
+
+    def watch(self,
+              source,
+              destination,
+              exclude=None,
+              delete=False,
+              initial=True,
+              debounce=0.3,
+              poll=False,
+              dry_run=False):
+        """Watch a local directory and push changed files to active remote host
+
+        Contents of `source` are mirrored into `destination` through SFTP
+        of one session kept open while watching.
+
+        Args:
+            source: a string representing the local directory
+            destination: a string representing the remote directory
+            exclude: a list of patterns of files and directories to skip,
+                added to `watch.DEFAULT_EXCLUDE`
+            delete: if `True`, remove remote files deleted locally
+            initial: if `True`, first upload files which differ from
+                remote ones (compared by sha256)
+            debounce: seconds to wait for more changes before pushing
+            poll: if `True`, poll for changes instead of using inotify
+            dry_run: if `True`, dry run the code
+
+        Returns:
+            None
+        """
+        if __package__ == '' or __package__ is None:    # Use for test
+            from remote import RemoteGlob
+            from hashindex import HashIndex
+            import transfer
+            import watch
+        else:
+            from loon.remote import RemoteGlob
+            from loon.hashindex import HashIndex
+            from loon import transfer
+            from loon import watch
+        source = os.path.expanduser(source)
+        if dry_run:
+            print("Running watch", source, "to", destination, "on",
+                  tuple(self.active_host[1:]))
+            sys.exit(0)
+        if not isdir(source):
+            print("Error: directory %s does not exist" % source)
+            sys.exit(1)
+        exclude = watch.DEFAULT_EXCLUDE + (exclude or [])
+        self.connect(open_channel=False)
+        destination = transfer.expand_home(RemoteGlob(self.session),
+                                           destination).rstrip('/') or '/'
+        if initial:
+            print("=> Syncing %s to %s..." % (source, destination))
+            with HashIndex() as index:
+                res = self.retry(lambda: transfer.upload(
+                    self.session, [
+                        os.path.join(source, name)
+                        for name in sorted(os.listdir(source))
+                        if not is_excluded(name, exclude)
+                    ],
+                    destination,
+                    index=index,
+                    exclude=exclude))
+            print("=> %d file(s) uploaded, %d unchanged" %
+                  (res['files'], res['skipped']))
+
+        watcher = watch.open_watcher(source, exclude, poll)
+        print("=> Watching %s (%s), press Ctrl+C to stop" %
+              (source, 'polling' if isinstance(
+                  watcher, watch.PollingWatcher) else 'inotify'))
+        made = set()
+
+        def push(changed, deleted):
+            sftp = self.session.sftp_init()
+            nfile, nbytes = 0, 0
+            # Parents come before their children
+            for rel in sorted(changed):
+                local_path = os.path.join(source, rel)
+                remote_path = destination + '/' + rel.replace(os.sep, '/')
+                parent = remote_path.rsplit('/', 1)[0]
+                if os.path.isdir(local_path):
+                    transfer.makedirs(sftp, remote_path)
+                    made.add(remote_path)
+                elif os.path.isfile(local_path):
+                    if parent not in made:
+                        transfer.makedirs(sftp, parent)
+                        made.add(parent)
+                    nbytes += transfer.put_file(sftp, local_path,
+                                                remote_path)
+                    nfile += 1
+            nremoved = 0
+            if delete:
+                for rel in sorted(deleted, reverse=True):
+                    remote_path = destination + '/' + rel.replace(os.sep, '/')
+                    made.difference_update([
+                        i for i in made if i == remote_path
+                        or i.startswith(remote_path + '/')
+                    ])
+                    # A directory moved out comes as one event, remove
+                    # everything in it
+                    nremoved += transfer.remove_tree(sftp, remote_path)
+            return nfile, nbytes, nremoved
+
+        try:
+            for changed, deleted in watch.batches(watcher, debounce):
+                if len(changed) == 0 and len(deleted) == 0:
+                    # Idle, keep NAT mappings and the session alive
+                    self.retry(lambda: self.session.keepalive_send())
+                    continue
+                with metrics.timer('watch', host=self.active_host[0],
+                                   phase='push') as info:
+                    nfile, nbytes, nremoved = self.retry(
+                        lambda: push(changed, deleted))
+                    info['bytes'] = nbytes
+                    info['items'] = nfile
+                print("=> [%s] %d file(s) pushed (%d bytes), %d removed" %
+                      (time.strftime('%H:%M:%S'), nfile, nbytes, nremoved))
+        except KeyboardInterrupt:
+            print("\n=> Stopped watching")
+        finally:
+            watcher.close()
+        return
+
+    def broadcast(self,
+                  names,
+                  source,
+                  destination,
+                  relay=False,
+                  fanout=4,
+                  exclude=None,
+                  dry_run=False):
+        """Upload files to many hosts at once, reading each local file once
+
+        Args:
+            names: a list of host aliases or patterns, see `select_hosts`
+            source: list of files (directories) in local machine
+            destination: destination directory on every host
+            relay: if `True`, upload to `fanout` hosts only and let
+                served hosts copy files to the others with scp, hosts
+                which cannot be served this way get files from here
+            fanout: number of hosts to upload to directly in relay mode
+            exclude: a list of patterns of files and directories to skip
+            dry_run: if `True`, dry run the code
+
+        Returns:
+            a dict mapping host aliases to dicts containing 'via' (alias
+            of the sending host, `None` for this machine), 'files',
+            'bytes' and 'error'
+        """
+        if __package__ == '' or __package__ is None:    # Use for test
+            import multihost
+        else:
+            from loon import multihost
+        hosts = self.select_hosts(names)
+        if dry_run:
+            print("Running broadcast", ' '.join(source), "to", destination,
+                  "on", [h[0] for h in hosts])
+            sys.exit(0)
+        for path in source:
+            if not os.path.exists(os.path.expanduser(path)):
+                print("Error: %s does not exist" % path)
+                sys.exit(1)
+
+        print("=> Connecting %d host(s)..." % len(hosts))
+        connected, errors = self.connect_hosts(hosts, bulk=True)
+        results = dict((alias, {
+            'via': None,
+            'files': 0,
+            'bytes': 0,
+            'error': error
+        }) for alias, error in errors.items())
+        live = [h for h in hosts if h[0] in connected]
+        direct = live[:fanout] if relay else live
+        sessions = dict((alias, conn[0]) for alias, conn in connected.items())
+
+        def send(targets):
+            res = multihost.broadcast(
+                dict((h[0], sessions[h[0]]) for h in targets),
+                source,
+                destination,
+                exclude=exclude)
+            for alias, r in res.items():
+                r['via'] = None
+                r['error'] = None if r['error'] is None else str(
+                    r['error']) or r['error'].__class__.__name__
+                results[alias] = r
+
+        try:
+            with metrics.timer('broadcast', items=len(hosts)) as info:
+                now = perf_counter()
+                print("=> Sending to %d host(s)..." % len(direct))
+                send(direct)
+                if relay and len(live) > len(direct):
+                    served = [
+                        h[0] for h in direct if results[h[0]]['error'] is None
+                    ]
+                    print("=> Relaying from %d host(s) to %d host(s)..." %
+                          (len(served), len(live) - len(direct)))
+                    top = [
+                        os.path.basename(
+                            os.path.expanduser(i).rstrip(os.sep) or os.sep)
+                        for i in source
+                    ]
+                    relayed = multihost.relay(sessions, served,
+                                              live[len(direct):], top,
+                                              destination)
+                    retry = []
+                    for h in live[len(direct):]:
+                        r = relayed.get(h[0])
+                        if r is not None and r['error'] is None:
+                            results[h[0]] = {
+                                'via': r['via'],
+                                'files': results[r['via']]['files'],
+                                'bytes': results[r['via']]['bytes'],
+                                'error': None
+                            }
+                        else:
+                            retry.append(h)
+                    if len(retry) > 0:
+                        print("=> Relaying failed for %d host(s), "
+                              "sending from here..." % len(retry))
+                        send(retry)
+                info['bytes'] = sum(r['bytes'] for alias, r in results.items()
+                                    if r['error'] is None
+                                    and r['via'] is None)
+                taken = perf_counter() - now
+        finally:
+            self.disconnect_hosts(connected)
+
+        title = ['Alias', 'Via', 'Status', 'Files', 'Size(MB)']
+        content = []
+        for h in hosts:
+            r = results[h[0]]
+            content.append([
+                h[0], r['via'] or '-', 'OK' if r['error'] is None else
+                'FAILED', r['files'], '%.1f' % (r['bytes'] / 1e6)
+            ])
+        pretty_table(title, content)
+        failed = [h[0] for h in hosts if results[h[0]]['error'] is not None]
+        for alias in failed:
+            print("Error: %s: %s" % (alias, results[alias]['error']))
+        print("=> Finished broadcasting to %d of %d host(s) in %.2fs, "
+              "%.2f MB sent from here" %
+              (len(hosts) - len(failed), len(hosts), taken,
+               info['bytes'] / 1e6))
+        if len(failed) > 0:
+            sys.exit(1)
+        return results
+
+    def gather(self,
+               names,
+               source,
+               destination,
+               parallel=8,
+               checksum=False,
+               dry_run=False):
+        """Download the same files from many hosts into `destination/<alias>`
+
+        Args:
+            names: a list of host aliases or patterns, see `select_hosts`
+            source: list of remote files (directories, patterns) on every host
+            destination: local directory, one sub directory per host is created
+            parallel: number of hosts to download from at the same time
+            checksum: if `True`, skip local files with the same content
+                as remote ones, e.g. from the last gather
+            dry_run: if `True`, dry run the code
+
+        Returns:
+            a dict mapping host aliases to dicts containing 'files',
+            'bytes', 'skipped', 'taken' and 'error'
+        """
+        if __package__ == '' or __package__ is None:    # Use for test
+            import multihost
+        else:
+            from loon import multihost
+        hosts = self.select_hosts(names)
+        if dry_run:
+            print("Running gather", ' '.join(source), "to", destination,
+                  "from", [h[0] for h in hosts])
+            sys.exit(0)
+
+        print("=> Gathering from %d host(s), %d at a time..." %
+              (len(hosts), parallel))
+        done = []
+
+        def report(alias, res):
+            done.append(alias)
+            if res['error'] is None:
+                print("=> [%d/%d] %s: %d file(s), %.2f MB in %.2fs" %
+                      (len(done), len(hosts), alias, res['files'],
+                       res['bytes'] / 1e6, res['taken']))
+            else:
+                print("=> [%d/%d] %s: failed" % (len(done), len(hosts), alias))
+
+        with metrics.timer('gather', items=len(hosts)) as info:
+            now = perf_counter()
+            results = multihost.gather(
+                lambda host: self.open_host(host, bulk=True),
+                hosts,
+                source,
+                destination,
+                parallel=parallel,
+                checksum=checksum,
+                callback=report,
+                windows=dict((h[0], self.options.get(h[0], {}).get('window'))
+                             for h in hosts))
+            info['bytes'] = sum(r['bytes'] for r in results.values())
+            taken = perf_counter() - now
+
+        title = ['Alias', 'Status', 'Files', 'Skipped', 'Size(MB)', 'Time(s)']
+        content = []
+        for h in hosts:
+            r = results[h[0]]
+            content.append([
+                h[0], 'OK' if r['error'] is None else 'FAILED', r['files'],
+                r['skipped'],
+                '%.1f' % (r['bytes'] / 1e6),
+                '%.2f' % r['taken']
+            ])
+        pretty_table(title, content)
+        failed = [h[0] for h in hosts if results[h[0]]['error'] is not None]
+        for alias in failed:
+            print("Error: %s: %s" % (alias, results[alias]['error']))
+        print("=> Finished gathering from %d of %d host(s) in %.2fs (%.2f MB/s)"
+              % (len(hosts) - len(failed), len(hosts), taken,
+                 info['bytes'] / 1e6 / taken if taken > 0 else 0))
+        if len(failed) > 0:
+            sys.exit(1)
+        return results
+
+    def copy(self,
+             source_name,
+             target_name,
+             source,
+             destination,
+             use_stream=False,
+             dry_run=False):
+        """Copy files between two remote hosts without storing them locally
+
+        By default the source host runs scp to the target host, so data
+        does not pass through this machine at all. If that is not
+        possible (e.g. the hosts cannot log in to each other, or the
+        target is only reachable through jump hosts), tar output of the
+        source host is piped to the target host through loon.
+
+        Args:
+            source_name: alias of the host to copy from, default is the active host
+            target_name: alias of the host to copy to
+            source: list of files (directories, patterns) on the source host
+            destination: destination directory on the target host
+            use_stream: if `True`, always pipe data through loon
+            dry_run: if `True`, dry run the code
+
+        Returns:
+            None
+        """
+        if __package__ == '' or __package__ is None:    # Use for test
+            import multihost
+        else:
+            from loon import multihost
+        src = self.active_host if source_name is None else self.host_check(
+            source_name, None, None)
+        dst = self.host_check(target_name, None, None)
+        if dry_run:
+            print("Running copy", ' '.join(source), "on", src[0], "to",
+                  destination, "on", dst[0])
+            sys.exit(0)
+        if src[0] == dst[0]:
+            print("Error: source and target host are both %s" % src[0])
+            sys.exit(1)
+
+        connected, errors = self.connect_hosts([src, dst], bulk=True)
+        try:
+            for alias, error in errors.items():
+                print("Error: cannot connect %s: %s" % (alias, error))
+            if len(errors) > 0:
+                sys.exit(1)
+            sessions = dict(
+                (alias, conn[0]) for alias, conn in connected.items())
+            try:
+                paths = multihost.remote_paths(sessions[src[0]], source)
+            except FileNotFoundError as e:
+                print("Error: %s on %s" % (e, src[0]))
+                sys.exit(1)
+
+            now = perf_counter()
+            if not use_stream:
+                print("=> Copying from %s to %s directly..." %
+                      (src[0], dst[0]))
+                with metrics.timer('copy', host=src[0], method='direct'):
+                    error = multihost.push(sessions[src[0]], paths,
+                                           destination, dst)
+                if error is None:
+                    print("=> Finished copying in %.2fs" %
+                          (perf_counter() - now))
+                    return
+                print("=> Direct copy failed (%s), "
+                      "piping through here instead..." % error)
+                now = perf_counter()
+            else:
+                print("=> Piping from %s to %s..." % (src[0], dst[0]))
+            with metrics.timer('copy', host=src[0], method='stream') as info:
+                try:
+                    info['bytes'] = multihost.stream(
+                        sessions[src[0]],
+                        sessions[dst[0]],
+                        paths,
+                        destination,
+                        window=self.options.get(src[0], {}).get('window'))
+                except Exception as e:
+                    print("Error: copy failed: %s" % e)
+                    sys.exit(1)
+                taken = perf_counter() - now
+            print("=> Finished copying in %.2fs (%.2f MB/s)" %
+                  (taken, info['bytes'] / 1e6 / taken if taken > 0 else 0))
+        finally:
+            self.disconnect_hosts(connected)
         return
 
 
@@ -682,6 +2036,94 @@ class PBS:
         print("Done.")
         return
 
+    def gen_pbs_remote(self,
+                       host,
+                       template,
+                       samplefile,
+                       mapfile,
+                       outdir,
+                       _logger,
+                       submit=False,
+                       dry_run=False):
+        """Generate PBS files on the active remote host like `gen_pbs`
+
+        Only the template, sample file and mapping file are uploaded
+        with a small helper which generates the files there.
+
+        Args:
+            host: a host object
+            template: a string representing the path to the template file
+            samplefile: a string representing the path to the sample file
+            mapfile: a string representing the path to the mapping file
+            outdir: a string representing the output directory on remote host
+            _logger: the logging logger
+            submit: if `True`, submit generated files in the output directory
+            dry_run: if `True`, dry run the code
+
+        Returns:
+            None
+        """
+        if __package__ == '' or __package__ is None:    # Use for test
+            import deploy
+        else:
+            from loon import deploy
+        if outdir is None:
+            print("Error: output directory on remote host is required")
+            sys.exit(1)
+        for path in (template, samplefile, mapfile):
+            if path is None or not isfile(path):
+                print("Error: file %s does not exist" % path)
+                sys.exit(1)
+
+        print("=====================")
+        print("Remote path : %s on %s" % (outdir, host.active_host[0]))
+        print("PBS Template: " + template)
+        print("Sample file : " + samplefile)
+        print("Mapping file: " + mapfile)
+        print("=====================")
+        if dry_run:
+            sys.exit(0)
+
+        host.connect(open_channel=False)
+        with metrics.timer('pbsgen', host=host.active_host[0],
+                           method='remote') as info:
+            now = perf_counter()
+            _logger.info("Rendering %s on %s" % (template, outdir))
+            try:
+                outdir, nfile = host.retry(lambda: deploy.render_remote(
+                    host.session, template, samplefile, mapfile, outdir))
+            except RuntimeError as e:
+                print("Error: %s" % e)
+                sys.exit(1)
+            info['items'] = nfile
+        print("=> Generated %d file(s) in %s in %.2fs" %
+              (nfile, outdir, perf_counter() - now))
+        if not submit:
+            return
+
+        print('====================================================')
+
+        def report(path, ok, output):
+            if ok:
+                print("=> Submitted %s: %s" % (path, output))
+            else:
+                print("Error: failed to submit %s: %s" % (path, output))
+
+        with metrics.timer('pbssub', host=host.active_host[0]) as info:
+            try:
+                jobs = deploy.submit_rendered(host.session,
+                                              outdir,
+                                              callback=report)
+            except RuntimeError as e:
+                print("Error: %s" % e)
+                sys.exit(1)
+            info['items'] = len(jobs)
+        nfailed = len([i for i in jobs if not i[1]])
+        print("=> Submitted %d of %d job(s)" % (len(jobs) - nfailed, len(jobs)))
+        if nfailed > 0:
+            sys.exit(1)
+        return
+
     def gen_pbs_example(self, outdir, _logger, dry_run=False):
         """Generate example files for pbsgen command to specified directory
         
@@ -728,24 +2170,35 @@ class PBS:
         Returns:
             A list of files
         """
+        if __package__ == '' or __package__ is None:    # Use for test
+            from remote import RemoteGlob
+        else:
+            from loon.remote import RemoteGlob
         print('NOTE: PBS file must be LF mode (Unix), not CRLF mode (Windows)')
         print('====================================================')
         filelist = []
         if remote:
-            tasks = ' '.join(tasks)
             host.connect()
-            _logger.info('ls -p ' + tasks)
-            host.channel.execute('ls -p ' + tasks)
-            filelist = host.get_result(print_info=False).split('\n')
-            if '' in filelist:
-                filelist.remove('')
-            fl_bk = filelist.copy()
-            for f in fl_bk:
-                if len(f) > 1 and (f[-1] == '/' or f[-1] == ':'):
-                    filelist.remove(f)
-                if f == '' or f == ' ':
-                    filelist.remove(f)
+
+            def expand():
+                rglob = RemoteGlob(host.session)
+                filelist = []
+                for pattern in tasks:
+                    _logger.info('Expanding ' + pattern)
+                    for entry in rglob.glob(pattern):
+                        if entry.is_dir:
+                            # Submit all files in the directory
+                            filelist.extend(e.path for e in rglob.listdir(entry.path)
+                                            if not e.is_dir)
+                        else:
+                            filelist.append(entry.path)
+                return filelist
+
+            filelist = host.retry(expand)
             _logger.info(filelist)
+            if len(filelist) == 0:
+                print('Error: no PBS file matches %s.' % ' '.join(tasks))
+                sys.exit(1)
             if workdir is None:
                 workdir = '/tmp'
             cmds = 'cd {}; for i in {}; do qsub $i; done'.format(
@@ -755,29 +2208,33 @@ class PBS:
                 print(cmds)
                 sys.exit(0)
             _logger.info(cmds)
-            host.cmd(cmds, _logger=_logger)
+            with metrics.timer('pbssub', host=host.active_host[0]) as info:
+                info['items'] = len(filelist)
+                # The channel opened above is not used yet
+                host.execute(cmds)
+                host.get_result()
         else:
             if workdir is None:
                 workdir = os.getcwd()
-            for fp in tasks:
-                fs = glob.glob(fp)
-                for f in fs:
-                    if isdir(f):
-                        print(
-                            "Warning: directory %s is detected, note anything in it will be ignored to execute."
-                            % f)
-                    elif isfile(f):
-                        filelist.append(f)
-                        cmds = 'cd ' + workdir + ';qsub ' + f
-
-                        if dry_run:
-                            print(cmds)
-                        else:
-                            _logger.info(cmds)
-                            run(cmds, shell=True)
+            for f, is_dir in expand_paths(tasks):
+                if is_dir:
+                    print(
+                        "Warning: directory %s is detected, note anything in it will be ignored to execute."
+                        % f)
+                elif is_dir is not None:
+                    filelist.append(f)
+                    cmds = 'cd ' + workdir + ';qsub ' + f
+
+                    if dry_run:
+                        print(cmds)
                     else:
-                        print('Error: file %s does not exist.' % f)
-                        sys.exit(1)
+                        _logger.info(cmds)
+                        with metrics.timer('pbssub', host='localhost') as info:
+                            info['items'] = 1
+                            run(cmds, shell=True)
+                else:
+                    print('Error: file %s does not exist.' % f)
+                    sys.exit(1)
         return filelist
 
     def deploy(self,
@@ -786,10 +2243,16 @@ class PBS:
                destination,
                _logger,
                use_rsync=False,
-               dry_run=False):
+               dry_run=False,
+               use_sftp=False,
+               checksum=False,
+               verify=False,
+               pipeline=False):
         """Deploy target directory on the active remote host
         
         Upload the target destination and then submit all *.pbs files.
+        With `pipeline`, each *.pbs file is submitted as soon as it and
+        files it references are uploaded, see `loon.deploy`.
 
         Args:
             host: a host object
@@ -798,6 +2261,11 @@ class PBS:
             _logger: the logging logger
             use_rsync: if `True`, use rsync instead of scp
             dry_run: if `True`, dry run the code
+            use_sftp: if `True`, upload through SFTP instead of scp
+            checksum: if `True`, only upload files changed on remote host
+            verify: if `True`, verify uploaded files by hashes before submitting
+            pipeline: if `True`, upload through SFTP and submit jobs while
+                uploading, jobs run in the uploaded directory
 
         Returns:
             None
@@ -811,11 +2279,80 @@ class PBS:
         if not isdir(source):
             print("Error: directory %s does not exist" % source)
             sys.exit(1)
+        if pipeline:
+            if verify:
+                print("Error: --verify checks all files before submitting, "
+                      "it cannot be used with --pipeline")
+                sys.exit(1)
+            self._deploy_pipeline(host, source, destination, _logger,
+                                  checksum)
+            return
         source = [source]
-        host.upload(source, destination, _logger, use_rsync=use_rsync)
+        host.upload(source,
+                    destination,
+                    _logger,
+                    use_rsync=use_rsync,
+                    use_sftp=use_sftp,
+                    checksum=checksum,
+                    verify=verify)
         self.sub(host, [destination + '/*.pbs'], True, destination, _logger)
         return
 
+    def _deploy_pipeline(self, host, source, destination, _logger,
+                         checksum=False):
+        """Upload and submit jobs at the same time, see `deploy`"""
+        if __package__ == '' or __package__ is None:    # Use for test
+            from hashindex import HashIndex
+            import deploy
+        else:
+            from loon.hashindex import HashIndex
+            from loon import deploy
+        print('NOTE: PBS file must be LF mode (Unix), not CRLF mode (Windows)')
+        print('====================================================')
+        host.connect(open_channel=False, bulk=True)
+        submit_session, submit_sock = host.open_host(host.active_host)
+
+        def report(path, ok, output):
+            if ok:
+                print("=> Submitted %s: %s" % (path, output))
+            else:
+                print("Error: failed to submit %s: %s" % (path, output))
+
+        index = HashIndex() if checksum else None
+        with metrics.timer('pbsdeploy', host=host.active_host[0],
+                           method='pipeline') as info:
+            now = perf_counter()
+            _logger.info("Running pipelined deploy of %s to %s" %
+                         (source, destination))
+            try:
+                res = deploy.pipeline(host.session,
+                                      submit_session,
+                                      source,
+                                      destination,
+                                      index=index,
+                                      checksum=checksum,
+                                      callback=report)
+            except Exception as e:
+                print("Error: deploy failed: %s" % e)
+                sys.exit(1)
+            finally:
+                if index is not None:
+                    index.close()
+                host.disconnect_hosts(
+                    {host.active_host[0]: (submit_session, submit_sock)})
+            info['bytes'] = res['bytes']
+            info['items'] = len(res['jobs'])
+            taken = perf_counter() - now
+        nfailed = len([i for i in res['jobs'] if not i[1]])
+        if checksum:
+            print("=> %d file(s) unchanged, skipped" % res['skipped'])
+        print("=> Uploaded %d file(s) and submitted %d of %d job(s) in %.2fs" %
+              (res['files'], len(res['jobs']) - nfailed, len(res['jobs']),
+               taken))
+        if nfailed > 0:
+            sys.exit(1)
+        return
+
     def check(self, host, job_id, dry_run=False):
         """Check PBS task status
         
@@ -831,13 +2368,15 @@ class PBS:
             if dry_run:
                 print("Running qstat on", tuple(host.active_host[1:]))
                 sys.exit(0)
-            return host.cmd('qstat')
+            # qstat is safe to run again, cmd connects by itself
+            return host.retry(lambda: host.cmd('qstat'), reconnect=False)
         else:
             if dry_run:
                 print("Running qstat", job_id, "on",
                       tuple(host.active_host[1:]))
                 sys.exit(0)
-            return host.cmd('qstat ' + job_id)
+            return host.retry(lambda: host.cmd('qstat ' + job_id),
+                              reconnect=False)
 
 
 if __name__ == "__main__":
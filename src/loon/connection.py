@@ -0,0 +1,768 @@
+# -*- coding: utf-8 -*-
+"""Functions used to establish SSH connections to remote hosts"""
+
+import os
+import sys
+import queue
+import select
+import socket
+import threading
+from getpass import getpass
+from time import perf_counter, sleep, time
+if __package__ == '' or __package__ is None:    # Use for test
+    from __init__ import __privatekey_file__
+    from metrics import metrics
+else:
+    from loon import __privatekey_file__
+    from loon.metrics import metrics
+
+
+# Tunnels through jump hosts, shared by all connections in the process
+_tunnels = {}
+_tunnels_lock = threading.Lock()
+
+# Default interval in seconds of SSH keepalive messages, long enough
+# to be free for short commands and short enough for NAT timeouts
+KEEPALIVE_INTERVAL = 30
+
+# Default receive window of libssh2 channels
+CHANNEL_WINDOW_DEFAULT = 2 * 1024 * 1024
+
+# Assumed bandwidth (bits/s) to size socket buffers automatically
+BANDWIDTH_DEFAULT = 1000 * 1000 * 1000
+
+
+class AuthenticationError(Exception):
+    pass
+
+
+class Credentials:
+    """
+    Credentials shared by all connections in the process
+
+    Authentication tries ssh-agent, then the private key and then the
+    password. Private keys are read from disk once and kept in memory,
+    a passphrase or password is asked at most once and reused by
+    following connections (e.g. to many hosts in parallel). Prompts
+    are serialized so that parallel connections never ask together.
+    """
+    def __init__(self):
+        # Set to `False` to fail fast instead of asking for passwords
+        self.interactive = True
+        self.use_agent = True
+        self._keys = {}
+        self._passphrases = {}
+        self._passwords = {}
+        self._lock = threading.Lock()
+        return
+
+    def load_key(self, path):
+        """Return content of a private key file, `None` if it does not exist"""
+        path = os.path.expanduser(path)
+        if path not in self._keys:
+            try:
+                with open(path, 'rb') as f:
+                    self._keys[path] = f.read()
+            except OSError:
+                self._keys[path] = None
+        return self._keys[path]
+
+    def authenticate(self,
+                     session,
+                     host,
+                     privatekey_file=__privatekey_file__,
+                     passphrase='',
+                     interactive=True):
+        """Authenticate a session
+
+        Args:
+            session: a session after handshake
+            host: a list representing the host, i.e. [alias, username, host, port]
+            privatekey_file: a string representing the path to the private key file
+            passphrase: a string representing the passphrase of the private key
+            interactive: if `False` (or `interactive` attribute is `False`),
+                raise AuthenticationError instead of asking for anything
+
+        Returns:
+            a string representing the method used, 'agent', 'publickey' or 'password'
+        """
+        username = host[1]
+        interactive = interactive and self.interactive
+        methods = session.userauth_list(username)
+        if session.userauth_authenticated():
+            return 'none'
+        methods = methods or []
+
+        if 'publickey' in methods:
+            if self.use_agent and os.environ.get('SSH_AUTH_SOCK'):
+                try:
+                    session.agent_auth(username)
+                    return 'agent'
+                except Exception:
+                    pass
+            keys = [privatekey_file]
+            if os.path.expanduser(privatekey_file) == __privatekey_file__:
+                # Other default keys of ssh
+                keys += [
+                    os.path.join(os.path.dirname(__privatekey_file__), i)
+                    for i in ('id_ed25519', 'id_ecdsa')
+                ]
+            for key in keys:
+                if self._auth_key(session, username, key, passphrase,
+                                  interactive):
+                    return 'publickey'
+
+        if 'password' in methods:
+            if self._auth_password(session, host, interactive):
+                return 'password'
+        raise AuthenticationError(
+            "authentication failed for %s@%s (server accepts %s)%s" %
+            (username, host[2], ','.join(methods),
+             '' if interactive else ', no password is asked in non-interactive mode'))
+
+    def _auth_key(self, session, username, privatekey_file, passphrase,
+                  interactive):
+        path = os.path.expanduser(privatekey_file)
+        key = self.load_key(path)
+        if key is None:
+            return False
+        passphrase = passphrase or self._passphrases.get(path, '')
+        try:
+            session.userauth_publickey_frommemory(username, key, passphrase)
+            return True
+        except Exception:
+            if not interactive or not _is_encrypted(key):
+                return False
+        with self._lock:
+            # Another connection may have got the passphrase meanwhile
+            cached = self._passphrases.get(path)
+            if cached is not None and cached != passphrase:
+                passphrase = cached
+            else:
+                passphrase = getpass('Enter passphrase for key %s: ' % path)
+            try:
+                session.userauth_publickey_frommemory(username, key,
+                                                      passphrase)
+            except Exception:
+                return False
+            self._passphrases[path] = passphrase
+        return True
+
+    def _auth_password(self, session, host, interactive):
+        username = host[1]
+        cached = self._passwords.get(username)
+        if cached is not None:
+            try:
+                session.userauth_password(username, cached)
+                return True
+            except Exception:
+                pass
+        if not interactive:
+            return False
+        with self._lock:
+            passwd = self._passwords.get(username)
+            if passwd is None or passwd == cached:
+                passwd = getpass('Enter your password for %s@%s: ' %
+                                 (username, host[2]))
+            try:
+                session.userauth_password(username, passwd)
+            except Exception:
+                return False
+            # Hosts of a cluster often share the password
+            self._passwords[username] = passwd
+        return True
+
+
+def _is_encrypted(key):
+    """Check if a private key needs a passphrase"""
+    if b'ENCRYPTED' in key:
+        # PEM format
+        return True
+    if b'OPENSSH PRIVATE KEY' in key:
+        import base64
+        body = b''.join(
+            line for line in key.splitlines() if not line.startswith(b'-----'))
+        try:
+            data = base64.b64decode(body)
+        except ValueError:
+            return False
+        # The cipher name follows the magic string
+        return not data[len(b'openssh-key-v1\0'):].startswith(
+            b'\0\0\0\x04none')
+    return False
+
+
+credentials = Credentials()
+
+
+def open_session(host,
+                 privatekey_file=__privatekey_file__,
+                 passphrase='',
+                 timeout=None,
+                 interactive=True,
+                 timings=None,
+                 jump=None,
+                 keepalive=KEEPALIVE_INTERVAL,
+                 methods=None,
+                 sockopts=None):
+    """Connect a remote host and open an authenticated session
+
+    With jump hosts, the connection is forwarded through a direct-tcpip
+    channel of the last jump host, whose session is opened once and
+    shared by all following connections in the process.
+
+    Args:
+        host: a list representing the host, i.e. [alias, username, host, port]
+        privatekey_file: a string representing the path to the private key file
+        passphrase: a string representing the password
+        timeout: timeout in seconds for each phase, `None` means blocking forever
+        interactive: if `True`, ask for password when private key authentication fails,
+            otherwise raise the error
+        timings: a dict to store time (in seconds) taken by
+            'dns', 'tcp', 'handshake' and 'auth' phases
+        jump: a list of hosts to connect through in order, like ProxyJump of ssh
+        keepalive: interval in seconds of keepalive messages, 0 disables them.
+            libssh2 sends one only when `keepalive_send` of the session is called
+            and the interval has passed
+        methods: a dict of method preferences, see `set_methods`
+        sockopts: a dict of socket options, see `set_socket_options`
+
+    Returns:
+        a tuple (session, socket)
+    """
+    if timings is None:
+        timings = {}
+    tunnel = None
+    if jump:
+        tunnel = get_tunnel(jump,
+                            privatekey_file=privatekey_file,
+                            passphrase=passphrase,
+                            timeout=timeout,
+                            interactive=interactive)
+    try:
+        s, sock = _connect(host, privatekey_file, passphrase, timeout,
+                           interactive, timings, tunnel, keepalive, methods,
+                           sockopts)
+    finally:
+        for phase, seconds in timings.items():
+            metrics.record('connect', seconds, phase=phase, host=host[0])
+    if keepalive:
+        s.keepalive_config(True, keepalive)
+    return s, sock
+
+
+def _connect(host, privatekey_file, passphrase, timeout, interactive,
+             timings, tunnel, keepalive, methods, sockopts):
+    # Import here, ssh2 is only needed when connecting
+    from ssh2.session import Session
+
+    hostname, port = host[2:4]
+
+    if tunnel is not None:
+        # The name is resolved by the jump host
+        now = perf_counter()
+        sock = tunnel.open(hostname, port, timeout=timeout)
+        timings['tcp'] = perf_counter() - now
+    else:
+        now = perf_counter()
+        addrinfo = socket.getaddrinfo(hostname, port, 0, socket.SOCK_STREAM)
+        timings['dns'] = perf_counter() - now
+
+        now = perf_counter()
+        family, socktype, proto, _, sockaddr = addrinfo[0]
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(timeout)
+        try:
+            if sockopts:
+                # Buffers must be set before connecting to take part
+                # in TCP window scaling
+                set_socket_options(sock, sockopts)
+            sock.connect(sockaddr)
+            if sockopts and sockopts.get('sockbuf') == 'auto':
+                set_socket_options(sock, sockopts, rtt=perf_counter() - now)
+        except Exception:
+            sock.close()
+            raise
+        # libssh2 manages blocking by itself
+        sock.settimeout(None)
+        if keepalive:
+            # SSH keepalive messages are not sent while blocked in libssh2
+            # (e.g. waiting for output of a long command), TCP keepalive is
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            for opt in ('TCP_KEEPIDLE', 'TCP_KEEPINTVL'):
+                if hasattr(socket, opt):
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt),
+                                    keepalive)
+        timings['tcp'] = perf_counter() - now
+
+    s = Session()
+    if timeout is not None:
+        s.set_timeout(int(timeout * 1000))
+    try:
+        if methods:
+            set_methods(s, methods)
+        now = perf_counter()
+        s.handshake(sock)
+        timings['handshake'] = perf_counter() - now
+
+        now = perf_counter()
+        credentials.authenticate(s, host, privatekey_file, passphrase,
+                                 interactive)
+        timings['auth'] = perf_counter() - now
+    except Exception:
+        sock.close()
+        raise
+    if timeout is not None:
+        # Restore blocking mode for following operations
+        s.set_timeout(0)
+    return s, sock
+
+
+def set_socket_options(sock, sockopts, rtt=None):
+    """Set TCP options of a socket
+
+    Args:
+        sock: a TCP socket
+        sockopts: a dict containing any of 'sockbuf' (send and receive
+            buffer size in bytes, or 'auto' to size them to the bandwidth-delay
+            product), 'bandwidth' (bits/s used by 'auto') and 'nodelay'
+            (`True` to disable Nagle's algorithm, for interactive commands)
+        rtt: round trip time in seconds, needed by 'auto'
+
+    Returns:
+        None
+    """
+    sockbuf = sockopts.get('sockbuf')
+    if sockbuf == 'auto':
+        # Keep kernel auto tuning until the round trip time is known
+        sockbuf = None
+        if rtt is not None:
+            bdp = rtt * sockopts.get('bandwidth', BANDWIDTH_DEFAULT) / 8
+            sockbuf = int(min(max(2 * bdp, 256 * 1024), 64 * 1024 * 1024))
+    if sockbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, sockbuf)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sockbuf)
+    if sockopts.get('nodelay') is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                        1 if sockopts['nodelay'] else 0)
+    return
+
+
+def open_channel(session, window=None):
+    """Open a channel session, with a larger receive window for bulk output
+
+    Args:
+        session: an authenticated session
+        window: receive window size in bytes, `None` keeps the default
+
+    Returns:
+        a channel
+    """
+    channel = session.open_session()
+    if window and window > CHANNEL_WINDOW_DEFAULT:
+        # Announce the extra window to the server right now
+        channel.receive_window_adjust2(window - CHANNEL_WINDOW_DEFAULT, True)
+    return channel
+
+
+def open_sftp(session, window=None):
+    """Open SFTP of a session, with a larger receive window for downloads
+
+    Only what this side receives can be sped up, the window for uploads
+    is announced by the server.
+
+    Args:
+        session: an authenticated session
+        window: receive window size in bytes, `None` keeps the default
+
+    Returns:
+        an SFTP object
+    """
+    sftp = session.sftp_init()
+    if window and window > CHANNEL_WINDOW_DEFAULT:
+        sftp.get_channel().receive_window_adjust2(
+            window - CHANNEL_WINDOW_DEFAULT, True)
+    return sftp
+
+
+def set_methods(session, methods):
+    """Set method preferences of a session before handshake
+
+    Args:
+        session: a session before handshake
+        methods: a dict containing any of 'kex', 'ciphers', 'macs' (comma
+            separated names in order of preference, like options of ssh)
+            and 'compression' (`True` or `False`)
+
+    Returns:
+        None
+    """
+    # Import here, ssh2 is only needed when connecting
+    from ssh2 import session as ssh2_session
+
+    types = {
+        'kex': ['LIBSSH2_METHOD_KEX'],
+        'ciphers': ['LIBSSH2_METHOD_CRYPT_CS', 'LIBSSH2_METHOD_CRYPT_SC'],
+        'macs': ['LIBSSH2_METHOD_MAC_CS', 'LIBSSH2_METHOD_MAC_SC']
+    }
+    for key, names in types.items():
+        if methods.get(key):
+            for name in names:
+                session.method_pref(getattr(ssh2_session, name),
+                                    methods[key])
+    if methods.get('compression') is not None:
+        session.flag(ssh2_session.LIBSSH2_FLAG_COMPRESS,
+                     bool(methods['compression']))
+    return
+
+
+def negotiated_methods(session):
+    """Return a dict of kex, cipher, MAC and compression methods in use"""
+    # Import here, ssh2 is only needed when connecting
+    from ssh2 import session as ssh2_session
+
+    return dict(
+        (key, session.methods(getattr(ssh2_session, name)))
+        for key, name in [('kex', 'LIBSSH2_METHOD_KEX'),
+                          ('cipher', 'LIBSSH2_METHOD_CRYPT_CS'),
+                          ('mac', 'LIBSSH2_METHOD_MAC_CS'),
+                          ('compression', 'LIBSSH2_METHOD_COMP_CS')])
+
+
+def is_connection_error(e):
+    """Check if an exception means that the connection is lost"""
+    # Import here, ssh2 is only needed when connecting
+    from ssh2 import exceptions
+    return isinstance(
+        e, (ConnectionError, TimeoutError, socket.timeout, EOFError,
+            exceptions.SocketDisconnectError, exceptions.SocketRecvError,
+            exceptions.SocketSendError, exceptions.SocketTimeout,
+            exceptions.BadSocketError, exceptions.Timeout))
+
+
+def retry(func, reconnect=None, retries=2, delay=1, name=None):
+    """Call a function, reconnect and call it again when the connection is lost
+
+    Only use it for idempotent operations (listing, status polling,
+    resumable transfers), the function may have been partly done
+    before the connection is lost.
+
+    Args:
+        func: a function without arguments
+        reconnect: a function without arguments to reconnect before retrying
+        retries: maximum number of retries
+        delay: seconds to wait before the first retry, doubled for each retry
+        name: a string representing the host alias used in messages
+
+    Returns:
+        the return value of `func`
+    """
+    attempt = 0
+    while True:
+        try:
+            if attempt > 0 and reconnect is not None:
+                with metrics.timer('reconnect', host=name):
+                    reconnect()
+            return func()
+        except Exception as e:
+            if attempt >= retries or not is_connection_error(e):
+                raise
+            attempt += 1
+            print("Warning: connection to %s is lost (%s), retrying (%d/%d)..." %
+                  (name, str(e) or e.__class__.__name__, attempt, retries),
+                  file=sys.stderr)
+            sleep(delay * 2**(attempt - 1))
+
+
+def get_tunnel(jump,
+               privatekey_file=__privatekey_file__,
+               passphrase='',
+               timeout=None,
+               interactive=True):
+    """Get the shared tunnel through a chain of jump hosts
+
+    The tunnel is created on first use, later calls with the same chain
+    (from any thread) reuse its session.
+
+    Args:
+        jump: a list of hosts to connect through in order
+        privatekey_file: a string representing the path to the private key file
+        passphrase: a string representing the password
+        timeout: timeout in seconds for each phase, `None` means blocking forever
+        interactive: if `True`, ask for password when private key authentication fails
+
+    Returns:
+        a Tunnel object
+    """
+    key = tuple(tuple(h) for h in jump)
+    # Hold the lock while connecting, so concurrent connections
+    # never handshake with the same jump host twice
+    with _tunnels_lock:
+        tunnel = _tunnels.get(key)
+        if tunnel is None or tunnel.closed:
+            session, sock = open_session(jump[-1],
+                                         privatekey_file=privatekey_file,
+                                         passphrase=passphrase,
+                                         timeout=timeout,
+                                         interactive=interactive,
+                                         jump=jump[:-1])
+            tunnel = Tunnel(session, sock, name=jump[-1][0])
+            _tunnels[key] = tunnel
+    return tunnel
+
+
+class Tunnel:
+    """
+    Forward connections through the session of a jump host
+
+    Each forwarded connection is a direct-tcpip channel paired with a
+    local socket, which is used as the socket of the inner session.
+    A session can not be used from more than one thread, so a single
+    background thread drives the session and all channels in
+    non-blocking mode.
+    """
+    def __init__(self, session, sock, name=None):
+        self.session = session
+        self.sock = sock
+        self.name = name
+        self.closed = False
+        self._links = []
+        self._requests = queue.Queue()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return
+
+    def open(self, hostname, port, timeout=None):
+        """Open a forwarded connection to hostname:port on the jump host side
+
+        Args:
+            hostname: a string representing the host name or IP address
+            port: an integer representing the port
+            timeout: seconds to wait for the channel, `None` means forever
+
+        Returns:
+            a connected local socket
+        """
+        if self.closed:
+            raise ConnectionError("connection to jump host %s is closed" %
+                                  self.name)
+        local, remote = socket.socketpair()
+        remote.setblocking(False)
+        request = {
+            'hostname': hostname,
+            'port': port,
+            'sock': remote,
+            'done': threading.Event(),
+            'error': None
+        }
+        self._requests.put(request)
+        self._wakeup()
+        if not request['done'].wait(timeout):
+            request['error'] = 'timed out'
+        if request['error'] is not None:
+            local.close()
+            raise ConnectionError(
+                "cannot open channel to %s:%s through %s: %s" %
+                (hostname, port, self.name, request['error']))
+        return local
+
+    def close(self):
+        """Close all forwarded connections and the session"""
+        self.closed = True
+        self._wakeup()
+        self._thread.join()
+        return
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b'x')
+        except OSError:
+            pass
+
+    def _loop(self):
+        # Import here, ssh2 is only needed when connecting
+        from ssh2.error_codes import LIBSSH2_ERROR_EAGAIN
+        from ssh2.session import LIBSSH2_SESSION_BLOCK_INBOUND, \
+            LIBSSH2_SESSION_BLOCK_OUTBOUND
+
+        self.session.set_blocking(False)
+        request = None
+        error = 'closed'
+        next_keepalive = 0
+        try:
+            while not self.closed:
+                progress = False
+                if time() >= next_keepalive:
+                    # Raises if the jump host is lost
+                    seconds = self.session.keepalive_send()
+                    next_keepalive = time() + max(1, seconds)
+                if request is None and not self._requests.empty():
+                    request = self._requests.get_nowait()
+                if request is not None:
+                    try:
+                        channel = self.session.direct_tcpip(
+                            request['hostname'], request['port'])
+                    except Exception as e:
+                        channel = None
+                        request['error'] = str(e) or e.__class__.__name__
+                    if channel != LIBSSH2_ERROR_EAGAIN:
+                        if channel is not None:
+                            self._links.append(_Link(channel, request['sock']))
+                        else:
+                            request['sock'].close()
+                        request['done'].set()
+                        request = None
+                        progress = True
+                for link in list(self._links):
+                    progress = link.pump(LIBSSH2_ERROR_EAGAIN) or progress
+                    if link.closed:
+                        self._links.remove(link)
+                if progress:
+                    continue
+
+                readfds = [self._wakeup_r, self.sock]
+                writefds = []
+                for link in self._links:
+                    if link.to_local:
+                        writefds.append(link.sock)
+                    elif not link.local_eof and not link.to_remote:
+                        readfds.append(link.sock)
+                if self.session.block_directions(
+                ) & LIBSSH2_SESSION_BLOCK_OUTBOUND:
+                    writefds.append(self.sock)
+                select.select(readfds, writefds, [], 1)
+                try:
+                    while self._wakeup_r.recv(1024):
+                        pass
+                except BlockingIOError:
+                    pass
+        except Exception as e:
+            # The jump host is lost, fail all forwarded connections
+            error = str(e) or e.__class__.__name__
+        self.closed = True
+        while True:
+            if request is not None:
+                request['error'] = error
+                request['sock'].close()
+                request['done'].set()
+            try:
+                request = self._requests.get_nowait()
+            except queue.Empty:
+                break
+        for link in self._links:
+            link.sock.close()
+        try:
+            self.session.disconnect()
+        except Exception:
+            pass
+        self.sock.close()
+        return
+
+
+class _Link:
+    """A forwarded connection: a channel and its local socket"""
+    def __init__(self, channel, sock, chunk_size=65536):
+        self.channel = channel
+        self.sock = sock
+        self.chunk_size = chunk_size
+        self.to_local = b''
+        self.to_remote = b''
+        self.local_eof = False
+        self.remote_eof = False
+        self.eof_sent = False
+        self.shut = False
+        self.closed = False
+
+    def pump(self, EAGAIN):
+        """Move data in both directions without blocking, return `True` on progress"""
+        progress = False
+        try:
+            # Remote to local
+            if not self.to_local and not self.remote_eof:
+                size, data = self.channel.read(self.chunk_size)
+                if size > 0:
+                    self.to_local = data
+                    progress = True
+                elif size != EAGAIN or self.channel.eof():
+                    self.remote_eof = True
+                    progress = True
+            if self.to_local:
+                try:
+                    n = self.sock.send(self.to_local)
+                except BlockingIOError:
+                    n = 0
+                if n > 0:
+                    self.to_local = self.to_local[n:]
+                    progress = True
+            # Local to remote
+            if not self.to_remote and not self.local_eof:
+                try:
+                    data = self.sock.recv(self.chunk_size)
+                except BlockingIOError:
+                    data = None
+                if data == b'':
+                    self.local_eof = True
+                    progress = True
+                elif data:
+                    self.to_remote = data
+            if self.to_remote:
+                rc, n = self.channel.write(self.to_remote)
+                if n > 0:
+                    self.to_remote = self.to_remote[n:]
+                    progress = True
+            if self.local_eof and not self.to_remote and not self.eof_sent:
+                if self.channel.send_eof() != EAGAIN:
+                    self.eof_sent = True
+            if self.remote_eof and not self.to_local and not self.shut:
+                # Let the inner session see the end of stream
+                self.sock.shutdown(socket.SHUT_WR)
+                self.shut = True
+            if self.eof_sent and self.shut:
+                if self.channel.close() != EAGAIN:
+                    self.sock.close()
+                    self.closed = True
+                    progress = True
+        except Exception:
+            # The inner session or the channel went away
+            self.sock.close()
+            self.closed = True
+            progress = True
+        return progress
+
+
+def probe(host, privatekey_file=__privatekey_file__, timeout=5, jump=None):
+    """Check if a remote host is reachable and measure latencies
+
+    Authentication is never interactive here, hosts which need
+    a password are reported as failed.
+
+    Args:
+        host: a list representing the host, i.e. [alias, username, host, port]
+        privatekey_file: a string representing the path to the private key file
+        timeout: timeout in seconds for each phase
+        jump: a list of hosts to connect through in order
+
+    Returns:
+        a dict containing host alias, status, error and timings (in seconds)
+    """
+    timings = {}
+    res = {'name': host[0], 'ok': False, 'error': '', 'timings': timings}
+    try:
+        s, sock = open_session(host,
+                               privatekey_file=privatekey_file,
+                               timeout=timeout,
+                               interactive=False,
+                               timings=timings,
+                               jump=jump)
+    except Exception as e:
+        res['error'] = str(e) if str(e) else e.__class__.__name__
+        return res
+    res['ok'] = True
+    try:
+        s.disconnect()
+    except Exception:
+        pass
+    sock.close()
+    return res
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Render PBS files from a template on a remote host
+
+Shipped by `loon pbsgen --remote`, it does what `loon pbsgen` does
+locally and works with Python 2.7 and 3 without extra packages.
+
+Usage: python pbs-render.py TEMPLATE SAMPLEFILE MAPFILE OUTDIR
+
+Paths of rendered files are printed, one per line.
+"""
+
+import io
+import os
+import sys
+import csv
+
+PY2 = sys.version_info[0] < 3
+
+
+def read_csv(path):
+    """Read a CSV file, text after '#' and empty lines are skipped"""
+    with io.open(path, 'r', encoding='utf-8') as f:
+        lines = [l.split('#')[0].strip() for l in f]
+    lines = [l for l in lines if l]
+    if PY2:
+        rows = csv.reader([l.encode('utf-8') for l in lines])
+        return [[c.decode('utf-8') for c in row] for row in rows]
+    return list(csv.reader(lines))
+
+
+def write(stream, text):
+    stream.write(text.encode('utf-8') if PY2 else text)
+    return
+
+
+def main(argv):
+    if len(argv) != 5:
+        write(sys.stderr, __doc__)
+        return 2
+    template, samplefile, mapfile, outdir = argv[1:]
+    sample_data = read_csv(samplefile)
+    map_data = read_csv(mapfile)
+
+    if len(sample_data) != len(set(row[0] for row in sample_data)):
+        write(sys.stderr, u"Error: the first column is not unique!\n")
+        return 1
+    for row in map_data:
+        if len(row) != 2:
+            write(sys.stderr, u"Error: only two columns are quired in mapfile!\n")
+            return 1
+        try:
+            int(row[1])
+        except ValueError:
+            write(sys.stderr, u"Error: the second column must be "
+                  u"(or can be transformed to) an integer!\n")
+            return 1
+
+    with io.open(template, 'r', encoding='utf-8') as f:
+        temp_data = f.read()
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    for row in sample_data:
+        content = temp_data
+        for label, index in map_data:
+            try:
+                content = content.replace(label, row[int(index)])
+            except IndexError:
+                write(sys.stderr,
+                      u"Error: the second column out of range for label %s!\n"
+                      % label)
+        pbsfile = os.path.join(outdir, row[0] + u'.pbs')
+        with io.open(pbsfile, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(content)
+        write(sys.stdout, pbsfile + u'\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
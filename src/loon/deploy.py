@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""Pipelined deployment and remote rendering of PBS jobs
+
+Files of a job directory are uploaded through SFTP in an order where
+every job script comes right after the files it references, and each
+script is submitted with qsub as soon as it is on the remote host,
+while the upload goes on. Submission runs in a thread with a session
+of its own; scripts which land while qsub is busy are submitted
+together by the next call, so a slow scheduler never holds the upload.
+
+A script references a file or directory when its path relative to the
+job directory (optionally prefixed by './' or '$PBS_O_WORKDIR/')
+appears in the script as a word. Files which no script references may
+be needed by any job (e.g. a shared config sourced by a helper), so
+they are uploaded before the first job is submitted.
+
+`render_remote` uploads a template, a sample file and a mapping file
+with a small helper (`data/pbs-render.py`, Python 2.7 or 3 on the
+remote host) which generates the PBS files there, so three small files
+are sent instead of one file per sample.
+"""
+
+import os
+import re
+import queue
+import shlex
+import threading
+if __package__ == '' or __package__ is None:    # Use for test
+    from remote import RemoteGlob, remote_hashes, run_command, _join
+    from transfer import CHUNK_SIZE, plan_local, expand_home, make_tree, makedirs, put_file
+else:
+    from loon.remote import RemoteGlob, remote_hashes, run_command, _join
+    from loon.transfer import CHUNK_SIZE, plan_local, expand_home, make_tree, makedirs, put_file
+
+# Characters which end a word in a script
+_WORD_SEP = re.compile(r'[\s"\'`=;|&<>(),]+')
+_WORKDIR_PREFIX = re.compile(r'^(\./|\$\{?PBS_O_WORKDIR\}?/)+')
+
+RENDER_HELPER = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             'data', 'pbs-render.py')
+# Inputs of rendering are kept here under the output directory, hidden
+# from `*.pbs` patterns
+RENDER_DIR = '.loon-render'
+
+
+def _words(path):
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        text = f.read()
+    return set(
+        _WORKDIR_PREFIX.sub('', w).rstrip('/') for w in _WORD_SEP.split(text))
+
+
+def job_order(files, suffix='.pbs'):
+    """Order files so that each job script follows the files it references
+
+    Args:
+        files: a list of tuples (local path, relative path) of one job
+            directory, as returned by `transfer.plan_local`
+        suffix: suffix of job scripts
+
+    Returns:
+        a list of tuples (local path, relative path, `True` for a job script)
+    """
+    scripts = [i for i in files if i[1].endswith(suffix)]
+    others = [i for i in files if not i[1].endswith(suffix)]
+
+    # Files under each path a script may mention, paths in scripts
+    # are relative to the job directory
+    under = {}
+    for i in others:
+        parts = i[1].split('/')[1:]
+        for n in range(1, len(parts) + 1):
+            under.setdefault('/'.join(parts[:n]), []).append(i)
+
+    inputs = []
+    for local_path, rel in scripts:
+        group = {}
+        for word in _words(local_path):
+            for i in under.get(word, []):
+                group[i[1]] = i
+        inputs.append([group[k] for k in sorted(group)])
+    referenced = set(i[1] for group in inputs for i in group)
+
+    res = [(local_path, rel, False) for local_path, rel in others
+           if rel not in referenced]
+    sent = set()
+    for script, group in zip(scripts, inputs):
+        for local_path, rel in group:
+            if rel not in sent:
+                sent.add(rel)
+                res.append((local_path, rel, False))
+        res.append(script + (True, ))
+    return res
+
+
+class _Submitter(threading.Thread):
+    """
+    Submit job scripts with qsub through a session as they come in
+    """
+    def __init__(self, session, workdir, callback=None):
+        super().__init__(daemon=True)
+        self.session = session
+        self.workdir = workdir
+        self.callback = callback
+        self.queue = queue.Queue()
+        self.results = []
+        return
+
+    def submit(self, path):
+        self.queue.put(path)
+        return
+
+    def finish(self):
+        """Submit what is left and wait for the thread"""
+        self.queue.put(None)
+        self.join()
+        return self.results
+
+    def run(self):
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                done = True
+                batch = [i for i in batch if i is not None]
+            if len(batch) > 0:
+                self._qsub(batch)
+        return
+
+    def _qsub(self, paths):
+        cmds = 'cd %s && for i in %s; do if out=$(qsub "$i" 2>&1); ' \
+            'then echo "OK $out"; else echo "FAILED $out"; fi | ' \
+            'tr "\\n" " "; echo; done' % (
+                shlex.quote(self.workdir), ' '.join(map(shlex.quote, paths)))
+        try:
+            status, output = run_command(self.session, cmds)
+        except Exception as e:
+            status, output = None, str(e) or e.__class__.__name__
+        lines = output.splitlines() if status is not None else []
+        if len(lines) != len(paths):
+            # cd failed or the connection is lost
+            message = output.strip() or 'exit status %s' % status
+            lines = ['FAILED ' + message.replace('\n', ' ')] * len(paths)
+        for path, line in zip(paths, lines):
+            ok, _, message = line.strip().partition(' ')
+            res = (path, ok == 'OK', message.strip())
+            self.results.append(res)
+            if self.callback is not None:
+                self.callback(*res)
+        return
+
+
+def pipeline(session,
+             submit_session,
+             source,
+             destination,
+             chunk_size=CHUNK_SIZE,
+             index=None,
+             checksum=False,
+             suffix='.pbs',
+             callback=None):
+    """Upload a job directory and submit each job script as soon as it is uploaded
+
+    Layout is the same as `scp -pr source destination`, jobs are
+    submitted in the uploaded directory.
+
+    Args:
+        session: an authenticated session used for uploading
+        submit_session: another authenticated session of the same host used for qsub
+        source: a string representing the local job directory
+        destination: a string representing the remote directory
+        chunk_size: size of each write in bytes
+        index: a HashIndex, needed by `checksum`
+        checksum: if `True` and `index` is given, files whose remote
+            copy has the same content are not uploaded again, their
+            jobs are still submitted
+        suffix: suffix of job scripts
+        callback: a function called with the remote path of a script,
+            `True` if it is submitted and the output of qsub
+
+    Returns:
+        a dict containing numbers of 'files' and 'bytes' uploaded, files
+        'skipped' and 'jobs', a list of tuples (remote path, submitted, output)
+    """
+    rglob = RemoteGlob(session)
+    destination = expand_home(rglob, destination).rstrip('/') or '/'
+    dirs, files = plan_local([source])
+    make_tree(rglob.sftp, destination, dirs)
+    order = job_order(files, suffix)
+    res = {'files': 0, 'bytes': 0, 'skipped': 0}
+    skip = set()
+    if index is not None and checksum:
+        local = index.hash_files([i[0] for i in order])
+        remote = remote_hashes(session,
+                               [_join(destination, i[1]) for i in order],
+                               index.algorithm)
+        skip = set(i[1] for i in order
+                   if local[i[0]] == remote.get(_join(destination, i[1])))
+        res['skipped'] = len(skip)
+
+    workdir = _join(destination, dirs[0][0]) if len(dirs) > 0 else destination
+    submitter = _Submitter(submit_session, workdir, callback)
+    submitter.start()
+    try:
+        for local_path, rel, is_job in order:
+            remote_path = _join(destination, rel)
+            if rel not in skip:
+                res['bytes'] += put_file(rglob.sftp, local_path, remote_path,
+                                         chunk_size)
+                res['files'] += 1
+            if is_job:
+                submitter.submit(remote_path)
+    finally:
+        res['jobs'] = submitter.finish()
+    return res
+
+
+def render_remote(session, template, samplefile, mapfile, outdir):
+    """Generate PBS files on the remote host like `PBS.gen_pbs`
+
+    Args:
+        session: an authenticated session
+        template: a string representing the local template file
+        samplefile: a string representing the local sample file
+        mapfile: a string representing the local mapping file
+        outdir: a string representing the remote output directory
+
+    Returns:
+        a tuple (output directory with '~' expanded, number of generated files)
+
+    Raises:
+        RuntimeError if rendering fails on the remote host
+    """
+    rglob = RemoteGlob(session)
+    outdir = expand_home(rglob, outdir).rstrip('/') or '/'
+    inputs = _join(outdir, RENDER_DIR)
+    makedirs(rglob.sftp, inputs)
+    names = []
+    for path in (RENDER_HELPER, template, samplefile, mapfile):
+        name = os.path.basename(path)
+        if name in names:
+            # e.g. sample and mapping files with the same name
+            name = '%d-%s' % (len(names), name)
+        put_file(rglob.sftp, path, _join(inputs, name))
+        names.append(name)
+    args = ' '.join(shlex.quote(_join(RENDER_DIR, i)) for i in names)
+    status, output = run_command(
+        session, 'cd %s && py=$(command -v python3 || command -v python) && '
+        '"$py" %s . > %s && wc -l < %s' %
+        (shlex.quote(outdir), args, _join(RENDER_DIR, 'rendered.txt'),
+         _join(RENDER_DIR, 'rendered.txt')))
+    if status != 0:
+        raise RuntimeError(output.strip()
+                           or 'python is not found on the remote host')
+    return outdir, int(output.split()[-1])
+
+
+def submit_rendered(session, outdir, callback=None):
+    """Submit PBS files generated by `render_remote`, in the output directory
+
+    Args:
+        session: an authenticated session
+        outdir: a string representing the remote output directory, '~' expanded
+        callback: a function called with the path of a PBS file,
+            `True` if it is submitted and the output of qsub
+
+    Returns:
+        a list of tuples (path, submitted, output)
+    """
+    res = []
+
+    def parse(line):
+        code, _, rest = line.partition('\t')
+        path, _, message = rest.partition('\t')
+        if path == '':
+            return
+        res.append((_join(outdir, path[2:] if path.startswith('./') else path),
+                    code == '0', message.strip()))
+        if callback is not None:
+            callback(*res[-1])
+
+    status, output = run_command(
+        session, 'cd %s && while IFS= read -r i; do '
+        'out=$(qsub "$i" 2>&1); s=$?; '
+        'printf "%%s\\t%%s\\t%%s\\n" "$s" "$i" "$(echo $out)"; done < %s' %
+        (shlex.quote(outdir), _join(RENDER_DIR, 'rendered.txt')),
+        callback=parse)
+    if status != 0:
+        raise RuntimeError(output.strip() or 'exit status %d' % status)
+    return res
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""Persistent index of local file content hashes
+
+Hashes are stored in a SQLite database under the loon config directory,
+keyed by device and inode and validated by size and modification time,
+so a file is only hashed again after it changes. Missing hashes are
+computed in a thread pool (hashlib releases the GIL on large updates and
+files are memory mapped), and results are saved as they come in, so an
+interrupted run over a large directory keeps its progress.
+"""
+
+import os
+import time
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+if __package__ == '' or __package__ is None:    # Use for test
+    from __init__ import __host_file__
+    from utils import file_hash
+    from metrics import metrics
+else:
+    from loon import __host_file__
+    from loon.utils import file_hash
+    from loon.metrics import metrics
+
+INDEX_FILE = os.path.join(os.path.dirname(__host_file__), 'hashes.db')
+# Entries not used for this many seconds are removed
+MAX_AGE = 90 * 24 * 3600
+
+
+class HashIndex:
+    """
+    Content hashes of local files, computed once per version of a file
+    """
+    def __init__(self,
+                 path=INDEX_FILE,
+                 algorithm='sha256',
+                 workers=None,
+                 max_age=MAX_AGE):
+        """
+        Args:
+            path: a string representing the database file
+            algorithm: a hash algorithm supported by hashlib
+            workers: number of hashing threads, default is the number of CPUs (at most 8)
+            max_age: seconds after which unused entries are removed
+        """
+        parent = os.path.dirname(path)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+        self.algorithm = algorithm
+        self.workers = workers or min(8, os.cpu_count() or 1)
+        self.max_age = max_age
+        # Other loon processes may use the index at the same time
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("CREATE TABLE IF NOT EXISTS hashes ("
+                        "dev INTEGER, ino INTEGER, algorithm TEXT, "
+                        "size INTEGER, mtime INTEGER, digest TEXT, "
+                        "path TEXT, used REAL, "
+                        "PRIMARY KEY (dev, ino, algorithm))")
+        self.db.commit()
+        return
+
+    def lookup(self, path, st=None):
+        """Get the indexed hash of a file
+
+        Args:
+            path: a string representing the local file
+            st: result of os.stat(path) if it is known
+
+        Returns:
+            a hex string or `None` if the file is not indexed or changed
+        """
+        st = st or os.stat(path)
+        row = self.db.execute(
+            "SELECT size, mtime, digest FROM hashes "
+            "WHERE dev = ? AND ino = ? AND algorithm = ?",
+            (st.st_dev, st.st_ino, self.algorithm)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+            return None
+        return row[2]
+
+    def add(self, path, digest, st=None):
+        """Record the hash of a file, e.g. one that is just downloaded and verified
+
+        Args:
+            path: a string representing the local file
+            digest: a hex string
+            st: result of os.stat(path) taken when the digest was valid
+        """
+        self._save([(st or os.stat(path), path, digest)])
+        self.db.commit()
+        return
+
+    def _save(self, records):
+        now = time.time()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(st.st_dev, st.st_ino, self.algorithm, st.st_size,
+              st.st_mtime_ns, digest, os.path.abspath(path), now)
+             for st, path, digest in records])
+        return
+
+    def hash_files(self, paths, refresh=False):
+        """Get hashes of files, only new and changed files are hashed
+
+        Args:
+            paths: a list of local files
+            refresh: if `True`, hash all files and update the index, use it
+                for files just written in place, whose size and
+                modification time may equal those of the old content
+
+        Returns:
+            a dict mapping paths to hex strings
+        """
+        res = {}
+        todo = []
+        used = []
+        now = time.time()
+        for path in paths:
+            st = os.stat(path)
+            digest = None if refresh else self.lookup(path, st)
+            if digest is None:
+                todo.append((path, st))
+            else:
+                res[path] = digest
+                used.append((now, st.st_dev, st.st_ino, self.algorithm))
+        self.db.executemany(
+            "UPDATE hashes SET used = ? "
+            "WHERE dev = ? AND ino = ? AND algorithm = ?", used)
+        self.db.commit()
+        if len(todo) == 0:
+            return res
+
+        with metrics.timer('hash', items=len(todo)) as info:
+            info['bytes'] = sum(st.st_size for _, st in todo)
+            pending = []
+            last = time.time()
+            with ThreadPoolExecutor(self.workers) as pool:
+                futures = dict((pool.submit(file_hash, path, self.algorithm),
+                                (path, st)) for path, st in todo)
+                for future in as_completed(futures):
+                    path, st = futures[future]
+                    res[path] = digest = future.result()
+                    # A file modified while hashing must not be indexed,
+                    # nor one modified within mtime granularity of now
+                    if _same_version(st, os.stat(path)) and \
+                            time.time() - st.st_mtime > 2:
+                        pending.append((st, path, digest))
+                    if time.time() - last > 5:
+                        self._save(pending)
+                        self.db.commit()
+                        pending = []
+                        last = time.time()
+            self._save(pending)
+            self.db.commit()
+        return res
+
+    def prune(self):
+        """Remove entries not used for `max_age` seconds
+
+        Returns:
+            number of removed entries
+        """
+        cur = self.db.execute("DELETE FROM hashes WHERE used < ?",
+                              (time.time() - self.max_age, ))
+        self.db.commit()
+        return cur.rowcount
+
+    def close(self):
+        self.prune()
+        self.db.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+
+def _same_version(st1, st2):
+    return (st1.st_dev, st1.st_ino, st1.st_size,
+            st1.st_mtime_ns) == (st2.st_dev, st2.st_ino, st2.st_size,
+                                 st2.st_mtime_ns)
+
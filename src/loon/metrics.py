@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Timing and byte counters for connections and operations
+
+All records are collected by the module level `metrics` object, which
+is disabled by default. Enable it with `metrics.enabled = True` (or the
+`--metrics` command line option) and export the records as JSON lines
+or Prometheus text format.
+"""
+
+import sys
+import json
+import threading
+from time import perf_counter, time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Collector of timing records
+    """
+    def __init__(self):
+        self.enabled = False
+        self.records = []
+        self._lock = threading.Lock()
+        return
+
+    def record(self,
+               op,
+               seconds,
+               phase=None,
+               nbytes=None,
+               items=None,
+               **labels):
+        """Add a timing record
+
+        Args:
+            op: a string representing the operation, e.g. 'connect', 'exec'
+            seconds: time taken in seconds
+            phase: a string representing the phase of the operation, e.g. 'tcp'
+            nbytes: number of bytes transferred, if any
+            items: number of items processed (e.g. jobs, commands), if any
+            labels: other labels like host alias
+
+        Returns:
+            None
+        """
+        if not self.enabled:
+            return
+        rec = {'time': time(), 'op': op, 'phase': phase, 'seconds': seconds}
+        if nbytes is not None:
+            rec['bytes'] = nbytes
+            rec['throughput'] = nbytes / seconds if seconds > 0 else None
+        if items is not None:
+            rec['items'] = items
+        rec.update(labels)
+        with self._lock:
+            self.records.append(rec)
+        return
+
+    @contextmanager
+    def timer(self, op, phase=None, **labels):
+        """Time the code block
+
+        The yielded dict can be used to set 'bytes', 'items' and extra
+        labels inside the block, they can also be given as arguments.
+
+        Args:
+            op: a string representing the operation
+            phase: a string representing the phase of the operation
+            labels: other labels like host alias
+        """
+        info = {}
+        now = perf_counter()
+        try:
+            yield info
+        finally:
+            if self.enabled:
+                labels.update(info)
+                nbytes = labels.pop('bytes', None)
+                items = labels.pop('items', None)
+                self.record(op,
+                            perf_counter() - now,
+                            phase=phase,
+                            nbytes=nbytes,
+                            items=items,
+                            **labels)
+
+    def to_jsonl(self, f):
+        """Write records to a file object as JSON lines"""
+        for rec in self.records:
+            print(json.dumps(rec), file=f)
+        return
+
+    def to_prometheus(self, f):
+        """Write records to a file object as Prometheus text format
+
+        Records with the same labels are aggregated to sum and count.
+        """
+        seconds = {}
+        nbytes = {}
+        items = {}
+        for rec in self.records:
+            labels = dict(
+                (k, v) for k, v in rec.items()
+                if k not in ('time', 'seconds', 'bytes', 'throughput', 'items'))
+            key = tuple(sorted((k, str(v)) for k, v in labels.items()
+                               if v is not None))
+            total, count = seconds.get(key, (0.0, 0))
+            seconds[key] = (total + rec['seconds'], count + 1)
+            if 'bytes' in rec:
+                nbytes[key] = nbytes.get(key, 0) + rec['bytes']
+            if 'items' in rec:
+                items[key] = items.get(key, 0) + rec['items']
+
+        def fmt(key):
+            return ','.join('%s="%s"' % (k, v.replace('\\', r'\\').replace(
+                '"', r'\"')) for k, v in key)
+
+        print("# TYPE loon_operation_seconds summary", file=f)
+        for key, (total, count) in seconds.items():
+            print("loon_operation_seconds_sum{%s} %f" % (fmt(key), total),
+                  file=f)
+            print("loon_operation_seconds_count{%s} %d" % (fmt(key), count),
+                  file=f)
+        print("# TYPE loon_operation_bytes_total counter", file=f)
+        for key, total in nbytes.items():
+            print("loon_operation_bytes_total{%s} %d" % (fmt(key), total),
+                  file=f)
+        print("# TYPE loon_operation_items_total counter", file=f)
+        for key, total in items.items():
+            print("loon_operation_items_total{%s} %d" % (fmt(key), total),
+                  file=f)
+        return
+
+    def dump(self, path, fmt='json'):
+        """Save records to file
+
+        Args:
+            path: a string representing the path to output file, '-' for stdout
+            fmt: 'json' for JSON lines or 'prom' for Prometheus text format
+
+        Returns:
+            None
+        """
+        write = self.to_prometheus if fmt == 'prom' else self.to_jsonl
+        if path == '-':
+            write(sys.stdout)
+        else:
+            with open(path, 'a' if fmt == 'json' else 'w') as f:
+                write(f)
+        return
+
+
+metrics = Metrics()
@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+"""Transfers between loon and many hosts at once
+
+`broadcast` reads each local file once and hands every chunk to one
+thread per host, each writing through SFTP of its own session (libssh2
+releases the GIL, so all hosts receive at the same time). The same
+chunk object is shared by all threads and queues are bounded, so memory
+does not grow with the number of hosts and the reader is never more
+than a few chunks ahead of the slowest host. A host which fails is
+dropped without stopping the others.
+
+`gather` downloads the same remote paths from many hosts into one
+local directory per host, a limited number of hosts at a time.
+
+`relay` spreads data which is already on some hosts to the other ones
+with scp run on the hosts themselves. Every served host sends to one
+more host per round, so the number of served hosts doubles each round
+and the uplink of this machine is only used for the first hosts.
+
+`stream` copies files between two hosts through this machine without
+touching its disk: tar output of the sending host is piped chunk by
+chunk into tar of the receiving host, reading and writing overlap in
+two threads.
+"""
+
+import os
+import posixpath
+import queue
+import time
+import shlex
+import threading
+from multiprocessing.pool import ThreadPool
+if __package__ == '' or __package__ is None:    # Use for test
+    from remote import RemoteGlob, run_command, _join
+    from transfer import CHUNK_SIZE, QUEUE_DEPTH, read_chunks, plan_local, expand_home, make_tree, download, _set_times
+    from hashindex import HashIndex
+    from connection import open_channel
+else:
+    from loon.remote import RemoteGlob, run_command, _join
+    from loon.transfer import CHUNK_SIZE, QUEUE_DEPTH, read_chunks, plan_local, expand_home, make_tree, download, _set_times
+    from loon.hashindex import HashIndex
+    from loon.connection import open_channel
+
+# Options of ssh and scp run on hosts for relaying, never ask anything
+RELAY_OPTIONS = '-o BatchMode=yes -o ConnectTimeout=10'
+
+
+class _Receiver(threading.Thread):
+    """
+    Write files sent by `broadcast` to one host
+    """
+    def __init__(self, session, destination, dirs, depth=QUEUE_DEPTH):
+        super().__init__(daemon=True)
+        self.session = session
+        self.destination = destination
+        self.dirs = dirs
+        self.queue = queue.Queue(depth)
+        self.error = None
+        self.files = 0
+        self.bytes = 0
+        return
+
+    def put(self, item):
+        """Queue a tuple ('open', relative path, stat result), a chunk or ('close', )"""
+        if self.error is None:
+            self.queue.put(item)
+        return
+
+    def finish(self):
+        """Tell the thread no more files come and wait for it"""
+        self.queue.put(None)
+        self.join()
+        return
+
+    def run(self):
+        # Import here, ssh2 is only needed when connecting
+        from ssh2.sftp import LIBSSH2_FXF_WRITE, LIBSSH2_FXF_CREAT, \
+            LIBSSH2_FXF_TRUNC
+
+        handle = None
+        try:
+            rglob = RemoteGlob(self.session)
+            sftp = rglob.sftp
+            destination = expand_home(rglob,
+                                      self.destination).rstrip('/') or '/'
+            make_tree(sftp, destination, self.dirs)
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                if isinstance(item, bytes):
+                    handle.write(item)
+                    self.bytes += len(item)
+                elif item[0] == 'open':
+                    _, rel, st = item
+                    path = _join(destination, rel)
+                    handle = sftp.open(
+                        path,
+                        LIBSSH2_FXF_WRITE | LIBSSH2_FXF_CREAT
+                        | LIBSSH2_FXF_TRUNC, st.st_mode & 0o777)
+                else:
+                    handle.close()
+                    handle = None
+                    _set_times(sftp, path, st)
+                    self.files += 1
+        except Exception as e:
+            self.error = e
+            # Keep taking chunks, the reader must never be blocked
+            while self.queue.get() is not None:
+                pass
+        return
+
+
+def broadcast(sessions, sources, destination, chunk_size=CHUNK_SIZE,
+              exclude=None):
+    """Upload local files to many hosts, each file is read once
+
+    Layout is the same as `scp -pr sources destination` on every host.
+
+    Args:
+        sessions: a dict mapping host aliases to authenticated sessions
+        sources: a list of local files or directories
+        destination: a string representing the remote directory
+        chunk_size: size of each chunk in bytes
+        exclude: a list of patterns of files and directories to skip,
+            matched like `exclude` of `walk_files`
+
+    Returns:
+        a dict mapping host aliases to dicts containing numbers of 'files'
+        and 'bytes' sent and the 'error' which stopped the host (or `None`)
+    """
+    dirs, files = plan_local(sources, exclude)
+    receivers = dict((alias, _Receiver(session, destination, dirs))
+                     for alias, session in sessions.items())
+    for receiver in receivers.values():
+        receiver.start()
+    try:
+        for local_path, rel in files:
+            live = [r for r in receivers.values() if r.error is None]
+            if len(live) == 0:
+                break
+            st = os.stat(local_path)
+            for receiver in live:
+                receiver.put(('open', rel, st))
+            for chunk in read_chunks(local_path, chunk_size):
+                for receiver in live:
+                    receiver.put(chunk)
+            for receiver in live:
+                receiver.put(('close', ))
+    finally:
+        for receiver in receivers.values():
+            receiver.finish()
+    return dict((alias, {
+        'files': r.files,
+        'bytes': r.bytes,
+        'error': r.error
+    }) for alias, r in receivers.items())
+
+
+def gather(connect,
+           hosts,
+           sources,
+           destination,
+           parallel=8,
+           checksum=False,
+           callback=None,
+           windows=None):
+    """Download the same remote paths from many hosts, into `destination/<alias>`
+
+    Each host is connected, downloaded and disconnected in a thread of
+    its own, at most `parallel` hosts at a time.
+
+    Args:
+        connect: a function which takes a host and returns a tuple
+            (session, socket)
+        hosts: a list of hosts
+        sources: a list of remote files, directories or patterns
+        destination: a string representing the local directory
+        parallel: number of hosts to download from at the same time
+        checksum: if `True`, skip existing local files with the same
+            content as remote ones
+        callback: a function called with the alias and the result of
+            each host as soon as it finishes
+        windows: a dict mapping host aliases to receive window sizes in
+            bytes of their SFTP channels, other hosts keep the default
+
+    Returns:
+        a dict mapping host aliases to dicts containing numbers of
+        'files' and 'bytes' downloaded, files 'skipped', seconds
+        'taken' and the 'error' which stopped the host (or `None`)
+    """
+    destination = os.path.expanduser(destination)
+
+    def fetch(host):
+        res = {'files': 0, 'bytes': 0, 'skipped': 0, 'error': None}
+        start = time.time()
+        try:
+            session, sock = connect(host)
+            try:
+                # SQLite connections can not be shared between threads
+                index = HashIndex() if checksum else None
+                try:
+                    res.update(
+                        download(session,
+                                 sources,
+                                 os.path.join(destination, host[0]),
+                                 index=index,
+                                 checksum=checksum,
+                                 window=(windows or {}).get(host[0])))
+                finally:
+                    if index is not None:
+                        index.close()
+            finally:
+                try:
+                    session.disconnect()
+                except Exception:
+                    pass
+                sock.close()
+        except Exception as e:
+            res['error'] = str(e) or e.__class__.__name__
+        res['taken'] = time.time() - start
+        return host[0], res
+
+    results = {}
+    with ThreadPool(processes=max(1, min(parallel, len(hosts)))) as p:
+        for alias, res in p.imap_unordered(fetch, hosts):
+            results[alias] = res
+            if callback is not None:
+                callback(alias, res)
+    return results
+
+
+def _home_relative(path):
+    """Commands run in the home directory, so '~/x' is just 'x'"""
+    if path == '~':
+        return '.'
+    if path.startswith('~/'):
+        return path[2:] or '.'
+    return path
+
+
+def push_command(paths, destination, host):
+    """Get the command which copies files of one host to another with scp
+
+    Args:
+        paths: a list of files and directories on the sending host
+        destination: a string representing the directory on the receiving host
+        host: a list representing the receiving host, i.e. [alias, username, host, port]
+
+    Returns:
+        a string to run on the sending host
+    """
+    destination = _home_relative(destination)
+    _, username, hostname, port = host[:4]
+    login = '%s@%s' % (username, hostname)
+    mkdir = shlex.quote('mkdir -p %s' % shlex.quote(destination))
+    sources = ' '.join(shlex.quote(_home_relative(i)) for i in paths)
+    return 'ssh -p %d %s %s %s && scp -rp -P %d %s %s %s' % (
+        int(port), RELAY_OPTIONS, login, mkdir, int(port), RELAY_OPTIONS,
+        sources, shlex.quote('%s:%s' % (login, destination)))
+
+
+def push(session, paths, destination, host):
+    """Copy files of the host of a session to another host with `push_command`
+
+    Args:
+        session: an authenticated session of the sending host
+        paths: a list of files and directories on the sending host
+        destination: a string representing the directory on the receiving host
+        host: a list representing the receiving host
+
+    Returns:
+        a string describing the error, `None` on success
+    """
+    try:
+        status, output = run_command(session,
+                                     push_command(paths, destination, host))
+    except Exception as e:
+        return str(e) or e.__class__.__name__
+    if status == 0:
+        return None
+    lines = output.strip().splitlines()
+    return lines[-1] if len(lines) > 0 else 'exit status %d' % status
+
+
+def relay(sessions, served, hosts, names, destination):
+    """Copy files from hosts which have them to other hosts in rounds
+
+    In each round every served host sends to one host which has not
+    been served, successful receivers send in the next round. Hosts
+    must be able to log in to each other with keys and without prompts.
+
+    Args:
+        sessions: a dict mapping host aliases to authenticated sessions,
+            for every host in `served` and `hosts`
+        served: a list of aliases of hosts which have the files
+        hosts: a list of hosts to copy the files to
+        names: a list of names of files and directories under `destination`
+        destination: a string representing the remote directory
+
+    Returns:
+        a dict mapping aliases of `hosts` to dicts containing the alias
+        which sent the files ('via') and the 'error' (or `None`)
+    """
+    served = list(served)
+    pending = list(hosts)
+    results = {}
+    while len(pending) > 0 and len(served) > 0:
+        pairs = list(zip(served, pending))
+        pending = pending[len(pairs):]
+        paths = [_join(_home_relative(destination), i) for i in names]
+        with ThreadPool(processes=len(pairs)) as p:
+            errors = p.starmap(
+                lambda sender, host: push(sessions[sender], paths,
+                                          destination, host), pairs)
+        for (sender, host), error in zip(pairs, errors):
+            if error is None:
+                served.append(host[0])
+            results[host[0]] = {'via': sender, 'error': error}
+    return results
+
+
+def remote_paths(session, sources):
+    """Expand remote patterns into absolute paths
+
+    Args:
+        session: an authenticated session
+        sources: a list of remote files, directories or patterns
+
+    Returns:
+        a list of strings
+
+    Raises:
+        FileNotFoundError if a pattern matches nothing
+    """
+    rglob = RemoteGlob(session)
+    paths = []
+    for pattern in sources:
+        entries = rglob.glob(pattern)
+        if len(entries) == 0:
+            raise FileNotFoundError("no such remote file: %s" % pattern)
+        for entry in entries:
+            path = entry.path.rstrip('/') or '/'
+            if not path.startswith('/'):
+                path = _join(rglob.home(), path)
+            paths.append(path)
+    return paths
+
+
+def stream(src_session, dst_session, paths, destination, chunk_size=CHUNK_SIZE,
+           depth=QUEUE_DEPTH, window=None):
+    """Copy files from one host to another through this machine, in memory only
+
+    Layout is the same as `scp -pr paths destination` on the receiving
+    host, permissions and modification times are kept by tar.
+
+    Args:
+        src_session: an authenticated session of the sending host
+        dst_session: an authenticated session of the receiving host
+        paths: a list of absolute paths on the sending host
+        destination: a string representing the directory on the receiving host
+        chunk_size: size of each read in bytes
+        depth: number of chunks read ahead
+        window: receive window size in bytes of the channel reading from
+            the sending host, `None` keeps the default
+
+    Returns:
+        number of bytes of the tar stream
+
+    Raises:
+        RuntimeError if tar fails on either host
+    """
+    members = ' '.join(
+        '-C %s %s' % (shlex.quote(posixpath.dirname(i)),
+                      shlex.quote(posixpath.basename(i))) for i in paths)
+    destination = shlex.quote(_home_relative(destination))
+    reader = open_channel(src_session, window)
+    reader.execute('tar cf - %s' % members)
+    writer = dst_session.open_session()
+    writer.execute('(mkdir -p %s && tar xpf - -C %s) 2>&1' %
+                   (destination, destination))
+
+    chunks = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # Give up when the writer fails
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            size, data = reader.read(chunk_size)
+            while size > 0:
+                if not put(data):
+                    return
+                size, data = reader.read(chunk_size)
+            put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    nbytes = 0
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            writer.write(chunk)
+            nbytes += len(chunk)
+    finally:
+        stop.set()
+        thread.join()
+    writer.send_eof()
+    errors = []
+    for channel, read in ((writer, writer.read), (reader, reader.read_stderr)):
+        out = bytearray()
+        size, data = read(chunk_size)
+        while size > 0:
+            out.extend(data)
+            size, data = read(chunk_size)
+        channel.close()
+        channel.wait_closed()
+        if channel.get_exit_status() != 0:
+            errors.append(out.decode('utf-8', errors='replace').strip()
+                          or 'tar exited with status %d' %
+                          channel.get_exit_status())
+    if len(errors) > 0:
+        raise RuntimeError('; '.join(errors))
+    return nbytes
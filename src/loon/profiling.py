@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Profiling of a whole loon run
+
+`Profiler` combines cProfile (deterministic call statistics), a
+sampling thread (stacks of all threads, written in the collapsed format
+read by flamegraph.pl and speedscope), tracemalloc (top allocation
+sites and peak traced memory) and the peak resident set size.
+
+Child processes (e.g. the pool of `batch`) are not profiled, only their
+peak RSS is reported.
+"""
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from collections import Counter
+
+
+class Profiler:
+    """
+    Profile the current process and save results to files with a common prefix
+    """
+    def __init__(self, prefix, interval=0.005):
+        """
+        Args:
+            prefix: a string representing the path prefix of output files
+            interval: seconds between two stack samples
+        """
+        self.prefix = prefix
+        self.interval = interval
+        self.stacks = Counter()
+        self._profile = cProfile.Profile()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        return
+
+    def start(self):
+        tracemalloc.start()
+        self._start_time = time.time()
+        self._sampler.start()
+        self._profile.enable()
+        return
+
+    def _sample(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident not in names:
+                    names = dict((t.ident, t.name) for t in threading.enumerate())
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' %
+                                 (code.co_name, os.path.basename(
+                                     code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread'))
+                self.stacks[';'.join(reversed(stack))] += 1
+        return
+
+    def stop(self):
+        """Stop profiling and write result files
+
+        Files written:
+            <prefix>.prof: cProfile stats, read with `python -m pstats` or snakeviz
+            <prefix>.txt: top functions by cumulative time
+            <prefix>.collapsed: sampled stacks, one 'frame;frame;... count' per line
+            <prefix>.mem.txt: top allocation sites by size
+
+        Returns:
+            a dict containing wall time, peak traced memory and peak RSS in bytes
+        """
+        self._profile.disable()
+        self._stop.set()
+        self._sampler.join()
+        wall = time.time() - self._start_time
+        snapshot = tracemalloc.take_snapshot()
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        parent = os.path.dirname(self.prefix)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+        self._profile.dump_stats(self.prefix + '.prof')
+        with open(self.prefix + '.txt', 'w') as f:
+            stats = pstats.Stats(self._profile, stream=f)
+            stats.sort_stats('cumulative').print_stats(50)
+        with open(self.prefix + '.collapsed', 'w') as f:
+            for stack, count in self.stacks.most_common():
+                print("%s %d" % (stack, count), file=f)
+        with open(self.prefix + '.mem.txt', 'w') as f:
+            print("Peak traced memory: %d bytes" % peak_traced, file=f)
+            for stat in snapshot.statistics('lineno')[:30]:
+                print(stat, file=f)
+
+        res = {
+            'wall': wall,
+            'peak_traced': peak_traced,
+            'peak_rss': peak_rss(),
+            'peak_rss_children': peak_rss(children=True)
+        }
+        return res
+
+
+def peak_rss(children=False):
+    """Return peak resident set size in bytes, `None` if it is unknown
+
+    Args:
+        children: if `True`, return the largest of terminated child processes
+
+    Returns:
+        an integer or `None`
+    """
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    rss = resource.getrusage(who).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def start(prefix):
+    """Start a profiler and report results to stderr at exit
+
+    Args:
+        prefix: a string representing the path prefix of output files
+
+    Returns:
+        a Profiler object
+    """
+    import atexit
+
+    profiler = Profiler(prefix)
+
+    def report():
+        res = profiler.stop()
+        print("=> Profile saved to %s.{prof,txt,collapsed,mem.txt}" % prefix,
+              file=sys.stderr)
+        msg = "=> Wall time %.3fs, peak traced memory %.1f MB" % (
+            res['wall'], res['peak_traced'] / 1e6)
+        if res['peak_rss'] is not None:
+            msg += ", peak RSS %.1f MB (children %.1f MB)" % (
+                res['peak_rss'] / 1e6, res['peak_rss_children'] / 1e6)
+        print(msg, file=sys.stderr)
+
+    atexit.register(report)
+    profiler.start()
+    return profiler
@@ -0,0 +1,622 @@
+# -*- coding: utf-8 -*-
+"""Operations on remote host through an opened SSH session"""
+
+import os
+import re
+import select
+import fnmatch
+from shlex import quote
+from collections import namedtuple
+from time import perf_counter
+if __package__ == '' or __package__ is None:    # Use for test
+    from utils import has_magic, expand_braces, file_hash
+    from metrics import metrics
+    from connection import open_channel, open_sftp, CHANNEL_WINDOW_DEFAULT
+    from hashindex import HashIndex
+else:
+    from loon.utils import has_magic, expand_braces, file_hash
+    from loon.metrics import metrics
+    from loon.connection import open_channel, open_sftp, CHANNEL_WINDOW_DEFAULT
+    from loon.hashindex import HashIndex
+
+# S_IFMT, S_IFDIR and S_IFLNK, same as LIBSSH2_SFTP_S_* constants
+S_IFMT = 0o170000
+S_IFDIR = 0o040000
+S_IFLNK = 0o120000
+
+# Escapes in file names printed by `sha256sum`
+_UNESCAPE = {'n': '\n', 'r': '\r'}
+
+RemoteEntry = namedtuple('RemoteEntry',
+                         ['path', 'name', 'is_dir', 'size', 'mtime', 'is_link'])
+
+
+class RemoteGlob:
+    """
+    Expand glob patterns on remote host through SFTP
+
+    Patterns support *, ?, [], brace expansion ({a,b}) and
+    recursive `**`. Directory listings are cached, so create
+    one object for each operation.
+    """
+    def __init__(self, session, window=None):
+        """
+        Args:
+            session: an authenticated session
+            window: receive window size in bytes of the SFTP channel,
+                `None` keeps the default
+        """
+        self.sftp = open_sftp(session, window)
+        self._listing = {}
+        self._stat = {}
+        self._home = None
+        return
+
+    def home(self):
+        """Get home directory of remote user"""
+        if self._home is None:
+            self._home = self.sftp.realpath('.')
+        return self._home
+
+    def _entry(self, path, name, attrs):
+        mode = attrs.permissions & S_IFMT
+        if mode == S_IFLNK:
+            # Follow symbolic links like shell
+            target = self.stat(path)
+            if target is not None:
+                return target._replace(path=path, name=name, is_link=True)
+        return RemoteEntry(path, name, mode == S_IFDIR, attrs.filesize,
+                           attrs.mtime, mode == S_IFLNK)
+
+    def stat(self, path):
+        """Stat a remote path
+
+        Args:
+            path: a string representing the path on remote host
+
+        Returns:
+            a RemoteEntry or `None` if path does not exist
+        """
+        if path not in self._stat:
+            try:
+                attrs = self.sftp.stat(path)
+            except Exception:
+                attrs = None
+            if attrs is None or isinstance(attrs, int):
+                self._stat[path] = None
+            else:
+                name = path.rstrip('/').split('/')[-1]
+                self._stat[path] = RemoteEntry(
+                    path, name, attrs.permissions & S_IFMT == S_IFDIR,
+                    attrs.filesize, attrs.mtime, False)
+        return self._stat[path]
+
+    def listdir(self, path):
+        """List a remote directory
+
+        Args:
+            path: a string representing the directory, '' for the home directory
+
+        Returns:
+            a list of RemoteEntry, empty if path cannot be read
+        """
+        if path not in self._listing:
+            entries = []
+            try:
+                handle = self.sftp.opendir(path if path else '.')
+            except Exception:
+                handle = None
+            if handle is not None and not isinstance(handle, int):
+                for _, name, attrs in handle.readdir():
+                    name = name.decode('utf-8', errors='replace')
+                    if name in ('.', '..'):
+                        continue
+                    entries.append(
+                        self._entry(_join(path, name), name, attrs))
+                handle.close()
+            self._listing[path] = entries
+        return self._listing[path]
+
+    def _walk(self, path):
+        """All entries under a directory recursively, links are not followed"""
+        res = []
+        for entry in self.listdir(path):
+            res.append(entry)
+            if entry.is_dir and not entry.is_link:
+                res.extend(self._walk(entry.path))
+        return res
+
+    def glob(self, pattern):
+        """Expand a glob pattern
+
+        Args:
+            pattern: a string representing the pattern, e.g. '~/scripts/{a,b}*.sh'
+
+        Returns:
+            a list of RemoteEntry sorted by path
+        """
+        res = {}
+        for p in expand_braces(pattern):
+            for entry in self._glob(p):
+                if p.endswith('/') and not entry.is_dir:
+                    continue
+                res[entry.path] = entry
+        return [res[k] for k in sorted(res)]
+
+    def _glob(self, pattern):
+        if pattern == '~' or pattern.startswith('~/'):
+            pattern = self.home() + pattern[1:]
+        if not has_magic(pattern):
+            entry = self.stat(pattern)
+            return [] if entry is None else [entry]
+
+        if pattern.startswith('/'):
+            current = ['/']
+        else:
+            current = ['']
+        parts = [i for i in pattern.split('/') if i != '']
+        # Each item is a directory path (or a RemoteEntry for last part)
+        for index, part in enumerate(parts):
+            last = index == len(parts) - 1
+            matched = []
+            if part == '**':
+                for d in current:
+                    if last:
+                        matched.extend(self._walk(d))
+                    else:
+                        matched.append(d)
+                        matched.extend(e.path for e in self._walk(d)
+                                       if e.is_dir)
+            elif not has_magic(part):
+                for d in current:
+                    path = _join(d, part)
+                    if last:
+                        entry = self.stat(path)
+                        if entry is not None:
+                            matched.append(entry)
+                    else:
+                        matched.append(path)
+            else:
+                for d in current:
+                    for entry in self.listdir(d):
+                        if entry.name.startswith(
+                                '.') and not part.startswith('.'):
+                            continue
+                        if not fnmatch.fnmatchcase(entry.name, part):
+                            continue
+                        if last:
+                            matched.append(entry)
+                        elif entry.is_dir:
+                            matched.append(entry.path)
+            if not last:
+                # Remove duplicates from '**'
+                matched = list(dict.fromkeys(matched))
+            current = matched
+        return current
+
+
+class ScriptCache:
+    """
+    Content addressed cache of local files on remote host
+
+    Files are stored once as <cache_dir>/<sha256>-<mode> and symlinked to
+    where they are expected, so unchanged scripts and data are never
+    transferred again. Least recently used objects are removed when
+    the cache grows larger than `max_size` bytes.
+    """
+    def __init__(self,
+                 session,
+                 cache_dir='.cache/loon/objects',
+                 max_size=512 * 1024 * 1024):
+        self.sftp = session.sftp_init()
+        if not cache_dir.startswith('/'):
+            cache_dir = self.sftp.realpath('.') + '/' + cache_dir
+        self.cache_dir = cache_dir.rstrip('/')
+        self.max_size = max_size
+        self._makedirs(self.cache_dir)
+        return
+
+    def _makedirs(self, path):
+        current = ''
+        for part in path.split('/')[1:]:
+            current += '/' + part
+            try:
+                self.sftp.mkdir(current, 0o700)
+            except Exception:
+                # Exists or no permission, failure comes out later
+                pass
+        return
+
+    def _exists(self, path):
+        try:
+            return not isinstance(self.sftp.stat(path), int)
+        except Exception:
+            return False
+
+    def put(self, local_path, digest=None, chunk_size=1024 * 1024):
+        """Upload a file to cache if its content and mode are not cached
+
+        Args:
+            local_path: a string representing the local file
+            digest: sha256 of the file, computed if `None`
+            chunk_size: size of each write in bytes
+
+        Returns:
+            a tuple (remote object path, number of bytes uploaded),
+            the number is `None` if content is already cached
+        """
+        # Import here, transfer depends on this module
+        if __package__ == '' or __package__ is None:
+            from transfer import put_file, set_mode
+        else:
+            from loon.transfer import put_file, set_mode
+
+        if digest is None:
+            digest = file_hash(local_path)
+        # Permission bits are part of the key, so a chmod gives a new object
+        mode = os.stat(local_path).st_mode & 0o777
+        obj = '%s/%s-%o' % (self.cache_dir, digest, mode)
+        if self._exists(obj):
+            return obj, None
+
+        # Write to a temporary name first, so that an interrupted
+        # upload is never taken as a cached object
+        tmp = obj + '.tmp'
+        with metrics.timer('cache', phase='upload') as info:
+            # New objects must look recently used
+            nbytes = put_file(self.sftp,
+                              local_path,
+                              tmp,
+                              chunk_size,
+                              preserve=False)
+            set_mode(self.sftp, tmp, mode)
+            info['bytes'] = nbytes
+        try:
+            self.sftp.rename(tmp, obj)
+        except Exception:
+            # Uploaded by another process at the same time
+            self.sftp.unlink(tmp)
+        return obj, nbytes
+
+    def sync(self, mapping):
+        """Make sure local files are cached and build commands to link them
+
+        Args:
+            mapping: a dict mapping remote target paths to local file paths
+
+        Returns:
+            a string containing shell commands which create parent
+            directories, link cached objects to targets and mark
+            them as recently used
+        """
+        links = []
+        objs = set()
+        nbytes = 0
+        nhit = 0
+        # Unchanged files are not hashed again
+        with HashIndex() as index:
+            digests = index.hash_files(sorted(set(mapping.values())))
+        for target, local_path in mapping.items():
+            obj, size = self.put(local_path, digests[local_path])
+            if size is None:
+                nhit += 1
+            else:
+                nbytes += size
+            objs.add(obj)
+            links.append((obj, target))
+        print("=> %d file(s) reused from cache, %d uploaded (%d bytes)" %
+              (nhit, len(mapping) - nhit, nbytes))
+        self.cleanup(keep=objs)
+
+        cmds = []
+        dirs = sorted(set(os.path.dirname(t) for t in mapping))
+        if len(dirs) > 0:
+            cmds.append('mkdir -p ' + ' '.join(quote(d) for d in dirs))
+        for obj, target in links:
+            cmds.append('ln -sf {} {}'.format(quote(obj), quote(target)))
+        if len(objs) > 0:
+            cmds.append('touch ' + ' '.join(quote(o) for o in sorted(objs)))
+        return ';'.join(cmds)
+
+    def cleanup(self, keep=()):
+        """Remove least recently used objects when cache is too large
+
+        Args:
+            keep: remote object paths which must not be removed
+
+        Returns:
+            number of bytes removed
+        """
+        entries = []
+        handle = self.sftp.opendir(self.cache_dir)
+        for _, name, attrs in handle.readdir():
+            name = name.decode('utf-8', errors='replace')
+            if name in ('.', '..'):
+                continue
+            entries.append((attrs.mtime, attrs.filesize,
+                            self.cache_dir + '/' + name))
+        handle.close()
+
+        total = sum(i[1] for i in entries)
+        removed = 0
+        # Oldest first
+        for mtime, size, path in sorted(entries):
+            if total - removed <= self.max_size:
+                break
+            if path in keep:
+                continue
+            try:
+                self.sftp.unlink(path)
+                removed += size
+            except Exception:
+                pass
+        return removed
+
+
+def run_parallel(session,
+                 sock,
+                 commands,
+                 parallel=4,
+                 names=None,
+                 callback=None,
+                 chunk_size=32768,
+                 window=None):
+    """Run commands concurrently, each in its own channel of one session
+
+    Channels of a session must be driven from one thread, so the session
+    is switched to non-blocking mode and all channels are polled in turn,
+    waiting on the socket only when none of them can make progress.
+
+    Args:
+        session: an authenticated session
+        sock: the socket of the session
+        commands: a list of commands
+        parallel: maximum number of commands running at the same time
+        names: a list of names for commands, default is the commands
+        callback: a function called with the job dict when a command finishes
+        chunk_size: size of each read in bytes
+        window: receive window size in bytes of channels, `None` keeps the default
+
+    Returns:
+        a list of dicts containing 'name', 'command', 'stdout', 'stderr' and 'status',
+        in the same order as commands
+    """
+    # Import here, ssh2 is only needed when connecting
+    from ssh2.error_codes import LIBSSH2_ERROR_EAGAIN
+
+    if names is None:
+        names = commands
+    jobs = [{
+        'name': name,
+        'command': command,
+        'channel': None,
+        'stdout': [],
+        'stderr': [],
+        'status': None,
+        'closed': False
+    } for name, command in zip(names, commands)]
+    waiting = list(jobs)
+    running = []
+
+    def drain(job):
+        progress = False
+        channel = job['channel']
+        for stream, read in (('stdout', channel.read), ('stderr',
+                                                        channel.read_stderr)):
+            size, data = read(chunk_size)
+            while size > 0:
+                job[stream].append(data)
+                progress = True
+                size, data = read(chunk_size)
+        return progress
+
+    session.set_blocking(False)
+    try:
+        while len(waiting) > 0 or len(running) > 0:
+            progress = False
+            # Only one channel can be being opened at a time
+            while len(waiting) > 0 and len(running) < parallel:
+                job = waiting[0]
+                if job['channel'] is None:
+                    channel = session.open_session()
+                    if channel == LIBSSH2_ERROR_EAGAIN:
+                        break
+                    job['channel'] = channel
+                    if window and window > CHANNEL_WINDOW_DEFAULT:
+                        channel.receive_window_adjust2(
+                            window - CHANNEL_WINDOW_DEFAULT, True)
+                    progress = True
+                if job['channel'].execute(
+                        job['command']) == LIBSSH2_ERROR_EAGAIN:
+                    break
+                waiting.pop(0)
+                running.append(job)
+                progress = True
+
+            for job in list(running):
+                channel = job['channel']
+                if not job['closed']:
+                    progress = drain(job) or progress
+                    if not channel.eof():
+                        continue
+                    # Data may arrive together with EOF
+                    drain(job)
+                    if channel.close() == LIBSSH2_ERROR_EAGAIN:
+                        continue
+                    job['closed'] = True
+                    progress = True
+                # The exit status is only known once the remote side
+                # has closed the channel too
+                if channel.wait_closed() == LIBSSH2_ERROR_EAGAIN:
+                    continue
+                job['status'] = channel.get_exit_status()
+                for stream in ('stdout', 'stderr'):
+                    job[stream] = b''.join(job[stream]).decode(
+                        'utf-8', errors='replace')
+                del job['channel']
+                del job['closed']
+                running.remove(job)
+                progress = True
+                if callback is not None:
+                    callback(job)
+
+            if not progress:
+                _wait_socket(session, sock)
+    finally:
+        session.set_blocking(True)
+    return jobs
+
+
+def measure_throughput(session,
+                       nbytes=16 * 1024 * 1024,
+                       chunk_size=1024 * 1024,
+                       window=None):
+    """Measure bulk throughput of a session in both directions
+
+    Random data is used, so that compression does not inflate results.
+
+    Args:
+        session: an authenticated session
+        nbytes: number of bytes to transfer in each direction
+        chunk_size: size of each write in bytes
+        window: receive window size in bytes, `None` keeps the default
+
+    Returns:
+        a tuple (download seconds, upload seconds)
+    """
+    # Remote to local
+    channel = open_channel(session, window)
+    now = perf_counter()
+    channel.execute('head -c %d /dev/urandom' % nbytes)
+    size, _ = channel.read(chunk_size)
+    total = 0
+    while size > 0:
+        total += size
+        size, _ = channel.read(chunk_size)
+    down = perf_counter() - now
+    channel.close()
+    if total != nbytes:
+        raise RuntimeError("received %d of %d bytes" % (total, nbytes))
+
+    # Local to remote
+    block = os.urandom(chunk_size)
+    channel = session.open_session()
+    now = perf_counter()
+    channel.execute('cat > /dev/null')
+    sent = 0
+    while sent < nbytes:
+        n = min(chunk_size, nbytes - sent)
+        channel.write(block[:n])
+        sent += n
+    channel.send_eof()
+    channel.wait_eof()
+    up = perf_counter() - now
+    channel.close()
+    return down, up
+
+
+def remote_hashes(session, paths, algorithm='sha256', chunk_size=32768):
+    """Hash remote files with one `sha256sum` (or `<algorithm>sum`) call
+
+    Paths are sent on stdin and stored in a temporary file before
+    hashing starts, so that a long list never blocks on full windows.
+
+    Args:
+        session: an authenticated session
+        paths: a list of remote files, absolute or relative to the home directory
+        algorithm: 'md5', 'sha1', 'sha256' or 'sha512'
+        chunk_size: size of each read in bytes
+
+    Returns:
+        a dict mapping paths to hex strings, missing and unreadable files are left out
+    """
+    if len(paths) == 0:
+        return {}
+    channel = session.open_session()
+    channel.execute('f=$(mktemp) && cat > "$f" && '
+                    'xargs -0 %ssum -- < "$f" 2> /dev/null; rm -f "$f"' %
+                    algorithm)
+    data = b''.join(p.encode('utf-8') + b'\0' for p in paths)
+    for offset in range(0, len(data), chunk_size):
+        channel.write(data[offset:offset + chunk_size])
+    channel.send_eof()
+    out = bytearray()
+    size, chunk = channel.read(chunk_size)
+    while size > 0:
+        out.extend(chunk)
+        size, chunk = channel.read(chunk_size)
+    channel.close()
+
+    res = {}
+    for line in out.decode('utf-8', errors='replace').split('\n'):
+        digest, sep, path = line.partition('  ')
+        if sep == '':
+            continue
+        if digest.startswith('\\'):
+            # GNU coreutils escapes backslashes and newlines in names
+            digest = digest[1:]
+            path = re.sub(r'\\(.)',
+                          lambda m: _UNESCAPE.get(m.group(1), m.group(1)),
+                          path)
+        res[path] = digest
+    return res
+
+
+def run_command(session, command, chunk_size=32768, callback=None):
+    """Run a command on a new channel and wait for it to finish
+
+    Stdin is closed at once and stderr is merged into stdout.
+
+    Args:
+        session: an authenticated session
+        command: a string representing the shell command
+        chunk_size: size of each read in bytes
+        callback: a function called with each line of output (without
+            the line break) as soon as it arrives
+
+    Returns:
+        a tuple (exit status, output)
+    """
+    channel = session.open_session()
+    channel.execute('(%s) 2>&1' % command)
+    channel.send_eof()
+    out = bytearray()
+    start = 0
+    size, chunk = channel.read(chunk_size)
+    while size > 0:
+        out.extend(chunk)
+        if callback is not None:
+            end = out.rfind(b'\n') + 1
+            if end > start:
+                for line in out[start:end - 1].split(b'\n'):
+                    callback(line.decode('utf-8', errors='replace'))
+                start = end
+        size, chunk = channel.read(chunk_size)
+    if callback is not None and start < len(out):
+        callback(out[start:].decode('utf-8', errors='replace'))
+    channel.close()
+    channel.wait_closed()
+    return channel.get_exit_status(), out.decode('utf-8', errors='replace')
+
+
+def _wait_socket(session, sock, timeout=1):
+    """Wait until the socket is ready in the direction libssh2 is blocked on"""
+    # Import here, ssh2 is only needed when connecting
+    from ssh2.session import LIBSSH2_SESSION_BLOCK_INBOUND, \
+        LIBSSH2_SESSION_BLOCK_OUTBOUND
+
+    directions = session.block_directions()
+    if directions == 0:
+        return
+    readfds = [sock] if directions & LIBSSH2_SESSION_BLOCK_INBOUND else []
+    writefds = [sock] if directions & LIBSSH2_SESSION_BLOCK_OUTBOUND else []
+    select.select(readfds, writefds, [], timeout)
+    return
+
+
+def _join(dir, name):
+    if dir == '':
+        return name
+    elif dir.endswith('/'):
+        return dir + name
+    return dir + '/' + name
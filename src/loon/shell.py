@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""Persistent remote shells which keep environment between commands
+
+A `RemoteShell` runs commands one by one in a single shell channel, so
+`source activate`, `module load`, `cd` and exported variables are kept
+for following commands. Each command is followed by a random marker line
+carrying its exit status, which is used to split output of commands.
+
+To reuse a shell across CLI invocations, a small server process keeps
+the session and the shell of a host open and listens on a Unix socket
+under the loon config directory. It sends keepalive messages while idle
+and exits after being idle for a while or when the host is lost.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import socket
+import socketserver
+from subprocess import Popen, DEVNULL
+if __package__ == '' or __package__ is None:    # Use for test
+    from __init__ import __host_file__, __privatekey_file__
+    from connection import open_session, KEEPALIVE_INTERVAL
+    from remote import _wait_socket
+else:
+    from loon import __host_file__, __privatekey_file__
+    from loon.connection import open_session, KEEPALIVE_INTERVAL
+    from loon.remote import _wait_socket
+
+this_file = os.path.realpath(__file__)
+shell_dir = os.path.join(os.path.dirname(__host_file__), 'shells')
+
+
+class RemoteShell:
+    """
+    A shell channel running commands one by one
+    """
+    def __init__(self, session, sock):
+        self.session = session
+        self.sock = sock
+        self.channel = session.open_session()
+        self.channel.shell()
+        return
+
+    def run(self, command, chunk_size=32768):
+        """Run a command in the shell
+
+        Args:
+            command: a string representing the command
+            chunk_size: size of each read in bytes
+
+        Returns:
+            a tuple (stdout, stderr, exit status)
+        """
+        # Import here, ssh2 is only needed when connecting
+        from ssh2.error_codes import LIBSSH2_ERROR_EAGAIN
+
+        marker = 'LOON-%s' % uuid.uuid4().hex
+        # Braces keep the command in the current shell, stdin is closed
+        # so that the command never reads following markers
+        script = ("{ %s\n} < /dev/null\n"
+                  "__loon_status=$?\n"
+                  "printf '\\n%s:%%d\\n' $__loon_status\n"
+                  "printf '\\n%s\\n' >&2\n") % (command, marker, marker)
+        self.channel.write(script.encode('utf-8'))
+
+        out_end = re.compile(('\n%s:(-?[0-9]+)\n' % marker).encode())
+        err_end = ('\n%s\n' % marker).encode()
+        out, err = bytearray(), bytearray()
+        status = None
+        err_done = False
+        self.session.set_blocking(False)
+        try:
+            while status is None or not err_done:
+                progress = False
+                size, data = self.channel.read(chunk_size)
+                while size > 0:
+                    out.extend(data)
+                    progress = True
+                    size, data = self.channel.read(chunk_size)
+                size, data = self.channel.read_stderr(chunk_size)
+                while size > 0:
+                    err.extend(data)
+                    progress = True
+                    size, data = self.channel.read_stderr(chunk_size)
+                if status is None:
+                    m = out_end.search(out)
+                    if m is not None:
+                        status = int(m.group(1))
+                        del out[m.start():]
+                if not err_done and err.endswith(err_end):
+                    err_done = True
+                    del err[-len(err_end):]
+                if progress:
+                    continue
+                if self.channel.eof():
+                    raise ConnectionError("remote shell exited")
+                if size != LIBSSH2_ERROR_EAGAIN and size < 0:
+                    raise ConnectionError("failed to read from remote shell")
+                _wait_socket(self.session, self.sock)
+        finally:
+            self.session.set_blocking(True)
+        return (out.decode('utf-8', errors='replace'),
+                err.decode('utf-8', errors='replace'), status)
+
+    def close(self):
+        try:
+            self.channel.close()
+        except Exception:
+            pass
+        return
+
+
+def socket_path(alias):
+    """Path to the Unix socket of the shell server of a host"""
+    return os.path.join(shell_dir, alias + '.sock')
+
+
+def _request(path, message, timeout=None):
+    """Send a message to a shell server and return its reply"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    finally:
+        sock.close()
+    if not line:
+        raise ConnectionError("shell server closed the connection")
+    return json.loads(line.decode('utf-8'))
+
+
+def start_server(host,
+                 idle=600,
+                 privatekey_file=__privatekey_file__,
+                 timeout=30,
+                 jump=None):
+    """Start a shell server of a host in background and wait until it is ready
+
+    Args:
+        host: a list representing the host, i.e. [alias, username, host, port]
+        idle: seconds after which an idle server exits
+        privatekey_file: a string representing the path to the private key file
+        timeout: seconds to wait for the server
+        jump: a list of hosts to connect through in order
+
+    Returns:
+        the path to the Unix socket
+    """
+    path = socket_path(host[0])
+    os.makedirs(shell_dir, mode=0o700, exist_ok=True)
+    log_file = path[:-len('.sock')] + '.log'
+    with open(log_file, 'w') as log:
+        proc = Popen([
+            sys.executable, this_file, '--serve',
+            json.dumps(host), path,
+            str(idle), privatekey_file,
+            json.dumps(jump or [])
+        ],
+                     stdin=DEVNULL,
+                     stdout=log,
+                     stderr=log,
+                     start_new_session=True)
+    end = time.time() + timeout
+    while time.time() < end:
+        if proc.poll() is not None:
+            with open(log_file) as f:
+                raise ConnectionError("shell server exited: %s" %
+                                      f.read().strip())
+        try:
+            _request(path, {'ping': True}, timeout=1)
+            return path
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise ConnectionError("shell server does not start in %ss" % timeout)
+
+
+def run_persistent(host,
+                   command,
+                   idle=600,
+                   privatekey_file=__privatekey_file__,
+                   jump=None):
+    """Run a command in the persistent shell of a host
+
+    The shell server is started if it is not running.
+
+    Args:
+        host: a list representing the host, i.e. [alias, username, host, port]
+        command: a string representing the command
+        idle: seconds after which an idle server exits
+        privatekey_file: a string representing the path to the private key file
+        jump: a list of hosts to connect through in order
+
+    Returns:
+        a tuple (stdout, stderr, exit status)
+    """
+    path = socket_path(host[0])
+    try:
+        reply = _request(path, {'command': command, 'host': host, 'jump': jump or []})
+    except (FileNotFoundError, ConnectionRefusedError):
+        # Not running or a stale socket left by a killed server
+        start_server(host, idle, privatekey_file, jump=jump)
+        reply = _request(path, {'command': command, 'host': host, 'jump': jump or []})
+    if reply.get('restart'):
+        # The host record is changed since the server started
+        start_server(host, idle, privatekey_file, jump=jump)
+        reply = _request(path, {'command': command, 'host': host, 'jump': jump or []})
+    if 'error' in reply:
+        raise ConnectionError(reply['error'])
+    return reply['stdout'], reply['stderr'], reply['status']
+
+
+def stop_server(alias):
+    """Stop the shell server of a host, return `False` if it is not running"""
+    try:
+        _request(socket_path(alias), {'stop': True}, timeout=5)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return False
+    return True
+
+
+def list_servers():
+    """Return aliases of hosts which have a running shell server"""
+    if not os.path.isdir(shell_dir):
+        return []
+    aliases = []
+    for name in sorted(os.listdir(shell_dir)):
+        if not name.endswith('.sock'):
+            continue
+        try:
+            _request(os.path.join(shell_dir, name), {'ping': True}, timeout=1)
+        except OSError:
+            continue
+        aliases.append(name[:-len('.sock')])
+    return aliases
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        message = json.loads(line.decode('utf-8'))
+        server = self.server
+        server.last_request = time.time()
+        if 'stop' in message:
+            server.stopped = True
+            reply = {'ok': True}
+        elif 'command' in message:
+            if [message.get('host'), message.get('jump')
+                ] != [server.host, server.jump]:
+                reply = {'restart': True}
+                server.stopped = True
+            else:
+                try:
+                    stdout, stderr, status = server.shell.run(
+                        message['command'])
+                    reply = {
+                        'stdout': stdout,
+                        'stderr': stderr,
+                        'status': status
+                    }
+                except Exception as e:
+                    # The environment is lost, let the client start a new one
+                    reply = {'error': "remote shell is lost: %s" % e}
+                    server.stopped = True
+        else:
+            reply = {'ok': True}
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+class _Server(socketserver.UnixStreamServer):
+    def handle_timeout(self):
+        if time.time() - self.last_request >= self.idle:
+            self.stopped = True
+            return
+        try:
+            # Keep NAT mappings alive, fails if the host is lost
+            self.shell.session.keepalive_send()
+        except Exception:
+            self.stopped = True
+
+
+def serve(host,
+          path,
+          idle=600,
+          privatekey_file=__privatekey_file__,
+          jump=None):
+    """Keep a persistent shell of a host and serve commands on a Unix socket
+
+    Args:
+        host: a list representing the host, i.e. [alias, username, host, port]
+        path: a string representing the path to the Unix socket
+        idle: seconds after which the server exits if no request comes
+        privatekey_file: a string representing the path to the private key file
+        jump: a list of hosts to connect through in order
+
+    Returns:
+        None
+    """
+    session, sock = open_session(host,
+                                 privatekey_file=privatekey_file,
+                                 interactive=False,
+                                 jump=jump)
+    if os.path.exists(path):
+        os.remove(path)
+    server = _Server(path, _Handler)
+    os.chmod(path, 0o600)
+    inode = os.stat(path).st_ino
+    server.host = host
+    server.jump = jump or []
+    server.shell = RemoteShell(session, sock)
+    server.stopped = False
+    server.idle = idle
+    server.last_request = time.time()
+    # Wake up regularly to send keepalive messages
+    server.timeout = min(idle, KEEPALIVE_INTERVAL)
+    try:
+        while not server.stopped:
+            server.handle_request()
+    finally:
+        server.server_close()
+        # A new server may already listen on the same path
+        if os.path.exists(path) and os.stat(path).st_ino == inode:
+            os.remove(path)
+        server.shell.close()
+        session.disconnect()
+        sock.close()
+    return
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 7 and sys.argv[1] == '--serve':
+        serve(json.loads(sys.argv[2]), sys.argv[3], int(sys.argv[4]),
+              sys.argv[5], json.loads(sys.argv[6]))
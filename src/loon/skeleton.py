@@ -9,18 +9,24 @@ import os
 import sys
 import argparse
 import logging
+import atexit
 
 if __package__ == '' or __package__ is None:    # Use for test
     from __init__ import __version__, __author__, __license__
-    from classes import Host, PBS
-    from tool import batch
+    from metrics import metrics
 else:
     from loon import __version__, __author__, __license__
-    from loon.classes import Host, PBS
-    from loon.tool import batch
+    from loon.metrics import metrics
 
 _logger = logging.getLogger(__name__)
 
+# Subcommands which need the host file, other subcommands
+# never read it
+HOST_COMMANDS = ('add', 'config', 'tune', 'import', 'delete', 'switch',
+                 'list', 'rename', 'ping', 'health', 'run', 'shell', 'upload',
+                 'download', 'watch', 'broadcast', 'gather',
+                 'copy', 'pbssub', 'pbsdeploy', 'pbscheck')
+
 
 def parse_args(args):
     """Parse command line parameters
@@ -84,6 +90,36 @@ def parse_args(args):
     verbose_parser.add_argument('--dry',
                                 help="Dry run the commands",
                                 action='store_true')
+    verbose_parser.add_argument(
+        '--non-interactive',
+        dest='non_interactive',
+        help=
+        "Never ask for passwords or passphrases, fail if ssh-agent and private keys do not work",
+        action='store_true')
+    verbose_parser.add_argument(
+        '--profile',
+        help=
+        "Profile the run with cProfile, stack sampling and tracemalloc, save results to files prefixed with loon-profile-<subcommand>-<pid>",
+        action='store_true')
+    verbose_parser.add_argument(
+        '--profile-prefix',
+        dest='profile_prefix',
+        metavar='PATH',
+        help="Path prefix of profile result files, implies --profile",
+        type=str,
+        required=False)
+    verbose_parser.add_argument(
+        '--metrics',
+        help=
+        "Save timings and byte counters of connections and operations to a file, '-' for stdout",
+        type=str,
+        required=False)
+    verbose_parser.add_argument(
+        '--metrics-format',
+        dest='metrics_format',
+        help="Format of metrics, JSON lines (default) or Prometheus text",
+        choices=['json', 'prom'],
+        default='json')
 
     # Subcommands
     subparsers = parser.add_subparsers(
@@ -102,8 +138,70 @@ def parse_args(args):
                             dest='switch_active',
                             help='Set new host as active host',
                             action='store_true')
+    parser_add.add_argument(
+        '-J',
+        '--jump',
+        help=
+        'Comma separated jump hosts (aliases or user@host:port of added hosts) to connect through, like ProxyJump of ssh',
+        type=str,
+        required=False)
 
-    # Create the parser for the "add" command
+    # Create the parser for the "config" command
+    parser_config = subparsers.add_parser(
+        'config',
+        help="Show or set options of a host",
+        parents=[verbose_parser])
+    parser_config.add_argument('-N',
+                               '--name',
+                               help='Host alias, default is the active host',
+                               type=str,
+                               required=False)
+    parser_config.add_argument(
+        'settings',
+        nargs='*',
+        help=
+        "Options to set as key=value, e.g. jump=bastion, an empty value removes the option"
+    )
+
+    # Create the parser for the "tune" command
+    parser_tune = subparsers.add_parser(
+        'tune',
+        help=
+        "Benchmark cipher, MAC and compression methods against a host and save the fastest",
+        parents=[verbose_parser])
+    parser_tune.add_argument('-N',
+                             '--name',
+                             help='Host alias, default is the active host',
+                             type=str,
+                             required=False)
+    parser_tune.add_argument(
+        '--size',
+        help='Size (MB) of data to transfer in each direction, default is 16',
+        default=16,
+        type=float)
+    parser_tune.add_argument('--no-save',
+                             dest='save',
+                             help="Only show results, do not save the fastest",
+                             action='store_false')
+
+    # Create the parser for the "import" command
+    parser_import = subparsers.add_parser(
+        'import',
+        help="Import remote hosts from ssh config, CSV or YAML file",
+        parents=[verbose_parser])
+    parser_import.add_argument(
+        'file',
+        help=
+        "Inventory file, e.g. ~/.ssh/config or a CSV file with columns alias,username,host,port"
+    )
+    parser_import.add_argument(
+        '--format',
+        dest='fmt',
+        help="Inventory format, default is guessed from file extension",
+        choices=['ssh', 'csv', 'yaml'],
+        required=False)
+
+    # Create the parser for the "delete" command
     parser_del = subparsers.add_parser(
         'delete',
         help="Delete a remote host",
@@ -127,6 +225,27 @@ def parse_args(args):
     parser_rename.add_argument('old', help="Old host alias", type=str)
     parser_rename.add_argument('new', help="New host alias", type=str)
 
+    # Create the parser for the "ping" command
+    parser_ping = subparsers.add_parser(
+        'ping',
+        aliases=['health'],
+        help="Check connection health and latency of remote hosts",
+        parents=[verbose_parser])
+    parser_ping.add_argument(
+        'names',
+        nargs='*',
+        help="Host aliases to check, if not set, all hosts will be checked")
+    parser_ping.add_argument('--timeout',
+                             help="Timeout in seconds, default is 5",
+                             default=5,
+                             type=float)
+    parser_ping.add_argument('-T',
+                             '--thread',
+                             help="Thread number, default is 8",
+                             required=False,
+                             default=8,
+                             type=int)
+
     # Create the parser for the "run" command
     parser_run = subparsers.add_parser(
         'run',
@@ -158,12 +277,50 @@ def parse_args(args):
         help=
         'Remote directory for storing local scripts. Only used when flag --file sets and --remote does not set. Default is /tmp',
         default='/tmp')
+    parser_run.add_argument(
+        '--cache',
+        help=
+        'Cache local scripts and data on remote host by content, unchanged files are not uploaded again',
+        action='store_true')
+    parser_run.add_argument(
+        '--cache-size',
+        dest='cache_size',
+        help='Maximum size (MB) of the remote cache, default is 512',
+        default=512,
+        type=int)
+    parser_run.add_argument(
+        '-j',
+        '--parallel',
+        help=
+        'Number of scripts to run at the same time, each with its own output and exit status. Default is 1 (run one by one)',
+        default=1,
+        type=int)
+    parser_run.add_argument(
+        '--persist',
+        help=
+        'Run commands in a persistent shell of the active host, which keeps environment (e.g. activated conda env) between calls',
+        action='store_true')
+    parser_run.add_argument(
+        '--idle',
+        help=
+        'Seconds after which an idle persistent shell exits, default is 600',
+        default=600,
+        type=int)
     parser_run.add_argument(
         '--prog',
         help=
         'Specified program to run scripts, if not set, scripts will be executed directly assuming shbang exist',
         required=False)
 
+    # Create the parser for the "shell" command
+    parser_shell = subparsers.add_parser(
+        'shell',
+        help='List running persistent shells or stop the one of active host',
+        parents=[verbose_parser])
+    parser_shell.add_argument('--stop',
+                              help="Stop persistent shell of active host",
+                              action='store_true')
+
     # Create the parser for the "upload" command
     parser_upload = subparsers.add_parser(
         'upload',
@@ -178,6 +335,18 @@ def parse_args(args):
     parser_upload.add_argument('--rsync',
                                help="Use rsync instead of scp",
                                action='store_true')
+    parser_upload.add_argument(
+        '--sftp',
+        help="Transfer through SFTP of loon's own connection instead of scp",
+        action='store_true')
+    parser_upload.add_argument(
+        '--checksum',
+        help="Skip files with the same sha256 on both sides, implies --sftp",
+        action='store_true')
+    parser_upload.add_argument(
+        '--verify',
+        help="Compare sha256 of both sides after transferring, transfer mismatched files again",
+        action='store_true')
 
     # Create the parser for the "download" command
     parser_download = subparsers.add_parser(
@@ -195,6 +364,133 @@ def parse_args(args):
     parser_download.add_argument('--rsync',
                                  help="Use rsync instead of scp",
                                  action='store_true')
+    parser_download.add_argument(
+        '--sftp',
+        help="Transfer through SFTP of loon's own connection instead of scp",
+        action='store_true')
+    parser_download.add_argument(
+        '--checksum',
+        help="Skip files with the same sha256 on both sides, implies --sftp",
+        action='store_true')
+    parser_download.add_argument(
+        '--verify',
+        help="Compare sha256 of both sides after transferring, transfer mismatched files again",
+        action='store_true')
+
+    # Create the parser for the "watch" command
+    parser_watch = subparsers.add_parser(
+        'watch',
+        help='Push changed files of a local directory to active remote host',
+        parents=[verbose_parser])
+    parser_watch.add_argument('source', help='Local directory to watch')
+    parser_watch.add_argument(
+        'destination',
+        help="Remote directory, contents of source are mirrored into it")
+    parser_watch.add_argument(
+        '-e',
+        '--exclude',
+        action='append',
+        help="Pattern of files and directories to skip, can be given multiple times, editor temporary files and .git are always skipped")
+    parser_watch.add_argument('--delete',
+                              help="Remove remote files deleted locally",
+                              action='store_true')
+    parser_watch.add_argument(
+        '--no-initial',
+        dest='initial',
+        help="Do not upload files which differ from remote ones at start",
+        action='store_false')
+    parser_watch.add_argument(
+        '--debounce',
+        type=float,
+        default=0.3,
+        help="Seconds to wait for more changes before pushing, default is 0.3")
+    parser_watch.add_argument('--poll',
+                              help="Poll for changes instead of using inotify",
+                              action='store_true')
+
+    # Create the parser for the "broadcast" command
+    parser_broadcast = subparsers.add_parser(
+        'broadcast',
+        help='Upload files to many remote hosts, reading them once',
+        parents=[verbose_parser])
+    parser_broadcast.add_argument(
+        '-H',
+        '--hosts',
+        action='append',
+        required=True,
+        help="Host aliases or patterns like 'node*', comma separated or given multiple times")
+    parser_broadcast.add_argument('source',
+                                  nargs='+',
+                                  help='Source files to upload')
+    parser_broadcast.add_argument(
+        'destination', help="Remote destination directory on every host")
+    parser_broadcast.add_argument(
+        '-e',
+        '--exclude',
+        action='append',
+        help="Pattern of files and directories to skip, can be given multiple times")
+    parser_broadcast.add_argument(
+        '--relay',
+        help="Upload to a few hosts and let them copy files to the others with scp",
+        action='store_true')
+    parser_broadcast.add_argument(
+        '--fanout',
+        type=int,
+        default=4,
+        help="Number of hosts to upload to directly with --relay, default is 4")
+
+    # Create the parser for the "gather" command
+    parser_gather = subparsers.add_parser(
+        'gather',
+        help='Download the same files from many remote hosts, one directory per host',
+        parents=[verbose_parser])
+    parser_gather.add_argument(
+        '-H',
+        '--hosts',
+        action='append',
+        required=True,
+        help="Host aliases or patterns like 'node*', comma separated or given multiple times")
+    parser_gather.add_argument('source',
+                               nargs='+',
+                               help='Source files to download from every host')
+    parser_gather.add_argument(
+        'destination',
+        help="Local destination directory, files of each host go to <destination>/<alias>")
+    parser_gather.add_argument(
+        '-j',
+        '--parallel',
+        type=int,
+        default=8,
+        help="Number of hosts to download from at the same time, default is 8")
+    parser_gather.add_argument(
+        '--checksum',
+        help="Skip local files with the same sha256 as remote ones",
+        action='store_true')
+
+    # Create the parser for the "copy" command
+    parser_copy = subparsers.add_parser(
+        'copy',
+        help='Copy files between two remote hosts without storing them locally',
+        parents=[verbose_parser])
+    parser_copy.add_argument(
+        '-f',
+        '--from',
+        dest='source_name',
+        help="Alias of the host to copy from, default is the active host")
+    parser_copy.add_argument('-t',
+                             '--to',
+                             dest='target_name',
+                             required=True,
+                             help="Alias of the host to copy to")
+    parser_copy.add_argument('source',
+                             nargs='+',
+                             help='Source files on the source host')
+    parser_copy.add_argument('destination',
+                             help="Destination directory on the target host")
+    parser_copy.add_argument(
+        '--stream',
+        help="Pipe data through loon instead of letting the source host connect the target host",
+        action='store_true')
 
     # Create the parser for the "gen" command
     parser_gen = subparsers.add_parser(
@@ -294,6 +590,14 @@ def parse_args(args):
         "A csv file containing placeholders and column index (0-based) indicating replacing labels in samplefile"
     )
     parser_pbsgen.add_argument('-o', '--output', help="Output directory")
+    parser_pbsgen.add_argument(
+        '--remote',
+        help="Generate PBS files on the active remote host, output directory is a remote path",
+        action='store_true')
+    parser_pbsgen.add_argument(
+        '--submit',
+        help="Submit generated PBS files at once, only with --remote",
+        action='store_true')
 
     # Create the parser for the "pbsgen_example" command
     parser_genexample = subparsers.add_parser(
@@ -336,6 +640,22 @@ def parse_args(args):
     parser_deploy.add_argument('--rsync',
                                help="Use rsync instead of scp",
                                action='store_true')
+    parser_deploy.add_argument(
+        '--sftp',
+        help="Transfer through SFTP of loon's own connection instead of scp",
+        action='store_true')
+    parser_deploy.add_argument(
+        '--checksum',
+        help="Skip files with the same sha256 on both sides, implies --sftp",
+        action='store_true')
+    parser_deploy.add_argument(
+        '--verify',
+        help="Compare sha256 of both sides after transferring, transfer mismatched files again",
+        action='store_true')
+    parser_deploy.add_argument(
+        '--pipeline',
+        help="Upload through SFTP and submit each PBS file as soon as it and files it references are uploaded",
+        action='store_true')
 
     # Create the parser for the "pbscheck" command
     parser_pbscheck = subparsers.add_parser(
@@ -379,8 +699,39 @@ def main(args):
 
     setup_logging(args.loglevel)
     _logger.info("Starting loon...")
-    host = Host()
-    pbs = PBS()
+    profile_prefix = getattr(args, 'profile_prefix', None)
+    if getattr(args, 'profile', False) or profile_prefix is not None:
+        # Start before importing heavy modules to profile imports too
+        if __package__ == '' or __package__ is None:
+            import profiling
+        else:
+            from loon import profiling
+        profiling.start(profile_prefix or 'loon-profile-%s-%d' %
+                        (args.subparsers_name, os.getpid()))
+    if getattr(args, 'metrics', None) is not None:
+        # Subcommands may exit early, so save metrics at exit
+        metrics.enabled = True
+        atexit.register(metrics.dump, args.metrics, args.metrics_format)
+    # Import heavy modules only when the subcommand needs them
+    # to keep startup fast for lightweight subcommands
+    if args.subparsers_name == 'batch':
+        if __package__ == '' or __package__ is None:
+            from tool import batch
+        else:
+            from loon.tool import batch
+    else:
+        if __package__ == '' or __package__ is None:
+            from classes import Host, PBS
+        else:
+            from loon.classes import Host, PBS
+        host = Host() if args.subparsers_name in HOST_COMMANDS else None
+        pbs = PBS()
+        if args.non_interactive:
+            if __package__ == '' or __package__ is None:
+                from connection import credentials
+            else:
+                from loon.connection import credentials
+            credentials.interactive = False
 
     if hasattr(args, 'rsync') and args.rsync:
         use_rsync = True
@@ -399,6 +750,7 @@ def main(args):
                  username=args.username,
                  host=args.host,
                  port=args.port,
+                 jump=args.jump,
                  dry_run=args.dry)
         if args.switch_active:
             host.switch(name=args.name,
@@ -406,6 +758,15 @@ def main(args):
                         host=args.host,
                         port=args.port,
                         dry_run=args.dry)
+    elif args.subparsers_name == 'config':
+        _logger.info("Config command is detected.")
+        host.config(args.name, args.settings, dry_run=args.dry)
+    elif args.subparsers_name == 'tune':
+        _logger.info("Tune command is detected.")
+        host.tune(args.name, size=args.size, save=args.save, dry_run=args.dry)
+    elif args.subparsers_name == 'import':
+        _logger.info("Import command is detected.")
+        host.import_hosts(args.file, fmt=args.fmt, dry_run=args.dry)
     elif args.subparsers_name == 'delete':
         _logger.info("Delete command is detected.")
         if args.username is None or args.host is None:
@@ -434,6 +795,12 @@ def main(args):
     elif args.subparsers_name == 'rename':
         _logger.info("Rename command is detected.")
         host.rename(args.old, args.new, dry_run=args.dry)
+    elif args.subparsers_name in ('ping', 'health'):
+        _logger.info("Ping command is detected.")
+        host.ping(args.names,
+                  timeout=args.timeout,
+                  thread=args.thread,
+                  dry_run=args.dry)
     elif args.subparsers_name == 'run':
         _logger.info("Run command is detected.")
         if args.run_file:
@@ -447,7 +814,18 @@ def main(args):
                  remote_file=args.remote_file,
                  dir=args.dir,
                  prog=args.prog,
+                 cache=args.cache,
+                 cache_size=args.cache_size,
+                 parallel=args.parallel,
+                 persist=args.persist,
+                 idle=args.idle,
                  dry_run=args.dry)
+    elif args.subparsers_name == 'shell':
+        _logger.info("Shell command is detected.")
+        if args.stop:
+            host.stop_shell(dry_run=args.dry)
+        else:
+            host.list_shells()
     elif args.subparsers_name == 'upload':
         _logger.info("Upload command is detected.")
         #host.connect(open_channel=False)
@@ -455,7 +833,10 @@ def main(args):
                     args.destination,
                     _logger=_logger,
                     use_rsync=use_rsync,
-                    dry_run=args.dry)
+                    dry_run=args.dry,
+                    use_sftp=args.sftp,
+                    checksum=args.checksum,
+                    verify=args.verify)
     elif args.subparsers_name == 'download':
         _logger.info("Download command is detected.")
         #host.connect(open_channel=False)
@@ -463,7 +844,45 @@ def main(args):
                       args.destination,
                       _logger=_logger,
                       use_rsync=use_rsync,
-                      dry_run=args.dry)
+                      dry_run=args.dry,
+                      use_sftp=args.sftp,
+                      checksum=args.checksum,
+                      verify=args.verify)
+    elif args.subparsers_name == 'watch':
+        _logger.info("Watch command is detected.")
+        host.watch(args.source,
+                   args.destination,
+                   exclude=args.exclude,
+                   delete=args.delete,
+                   initial=args.initial,
+                   debounce=args.debounce,
+                   poll=args.poll,
+                   dry_run=args.dry)
+    elif args.subparsers_name == 'broadcast':
+        _logger.info("Broadcast command is detected.")
+        host.broadcast(args.hosts,
+                       args.source,
+                       args.destination,
+                       relay=args.relay,
+                       fanout=max(1, args.fanout),
+                       exclude=args.exclude,
+                       dry_run=args.dry)
+    elif args.subparsers_name == 'gather':
+        _logger.info("Gather command is detected.")
+        host.gather(args.hosts,
+                    args.source,
+                    args.destination,
+                    parallel=max(1, args.parallel),
+                    checksum=args.checksum,
+                    dry_run=args.dry)
+    elif args.subparsers_name == 'copy':
+        _logger.info("Copy command is detected.")
+        host.copy(args.source_name,
+                  args.target_name,
+                  args.source,
+                  args.destination,
+                  use_stream=args.stream,
+                  dry_run=args.dry)
     elif args.subparsers_name == 'batch':
         _logger.info("Batch command is detected.")
         batch(args.file,
@@ -487,12 +906,22 @@ def main(args):
                     dry_run=args.dry)
     elif args.subparsers_name == 'pbsgen':
         _logger.info("pbsgen command is detected.")
-        pbs.gen_pbs(args.template,
-                    args.samplefile,
-                    args.mapfile,
-                    args.output,
-                    _logger=_logger,
-                    dry_run=args.dry)
+        if args.remote:
+            pbs.gen_pbs_remote(Host(),
+                               args.template,
+                               args.samplefile,
+                               args.mapfile,
+                               args.output,
+                               _logger=_logger,
+                               submit=args.submit,
+                               dry_run=args.dry)
+        else:
+            pbs.gen_pbs(args.template,
+                        args.samplefile,
+                        args.mapfile,
+                        args.output,
+                        _logger=_logger,
+                        dry_run=args.dry)
     elif args.subparsers_name == 'pbsgen_example':
         pbs.gen_pbs_example(args.output, _logger=_logger, dry_run=args.dry)
     elif args.subparsers_name == 'pbssub':
@@ -510,7 +939,11 @@ def main(args):
                    args.destination,
                    _logger=_logger,
                    use_rsync=use_rsync,
-                   dry_run=args.dry)
+                   dry_run=args.dry,
+                   use_sftp=args.sftp,
+                   checksum=args.checksum,
+                   verify=args.verify,
+                   pipeline=args.pipeline)
     elif args.subparsers_name == 'pbscheck':
         _logger.info("pbscheck command is detected.")
         pbs.check(host, args.job_id, dry_run=args.dry)
@@ -7,8 +7,8 @@ import sys
 import io
 import re
 from subprocess import run
-from multiprocessing import Pool
 from loon.utils import isfile, isdir, read_csv
+from loon.metrics import metrics
 
 
 def prun(x):
@@ -84,42 +84,45 @@ def batch(input,
         _ = [print("=> Running %s" % cmd) for cmd in cmd_list]
         sys.exit(0)
 
-    # There is a bug when input from stdin I cannot figure out for now
-    if thread > 1:
-        _logger.info("Using %s threads" % str(thread))
-        with Pool(processes=thread) as p:
-            if isinstance(input, io.TextIOWrapper):
-                p.map(prun, cmd_list)
-                sys.exit(0)
-            else:
-                run_res = p.map(prun, cmd_list)
-                for _, res in enumerate(run_res):
-                    if res.returncode != 0:
-                        print("Error: some jobs failed, please take a check!.",
+    # Record total time, commands in the pool run in other processes
+    with metrics.timer('batch', items=len(cmd_list)):
+        # There is a bug when input from stdin I cannot figure out for now
+        if thread > 1:
+            from multiprocessing import Pool
+            _logger.info("Using %s threads" % str(thread))
+            with Pool(processes=thread) as p:
+                if isinstance(input, io.TextIOWrapper):
+                    p.map(prun, cmd_list)
+                    sys.exit(0)
+                else:
+                    run_res = p.map(prun, cmd_list)
+                    for _, res in enumerate(run_res):
+                        if res.returncode != 0:
+                            print("Error: some jobs failed, please take a check!.",
+                                  file=sys.stderr)
+                            sys.exit(res.returncode)
+        else:
+            _logger.info("Using %s threads" % str(thread))
+            for cmd in cmd_list:
+                if isinstance(input, io.TextIOWrapper):
+                    run(cmd, shell=True, stdout=sys.stdout, stderr=sys.stderr)
+                else:
+                    run_res = run(cmd,
+                                  shell=True,
+                                  stdout=sys.stdout,
+                                  stderr=sys.stderr)
+                    _logger.info("Status code: " + str(run_res.returncode))
+                    if run_res.returncode != 0:
+                        print(
+                            "Error: an error detected when running the following command, please take a check!",
+                            file=sys.stderr)
+                        print("\t", cmd, file=sys.stderr)
+                        print("Status code: %s" % str(run_res.returncode),
                               file=sys.stderr)
-                        sys.exit(res.returncode)
-    else:
-        _logger.info("Using %s threads" % str(thread))
-        for cmd in cmd_list:
-            if isinstance(input, io.TextIOWrapper):
-                run(cmd, shell=True, stdout=sys.stdout, stderr=sys.stderr)
-            else:
-                run_res = run(cmd,
-                              shell=True,
-                              stdout=sys.stdout,
-                              stderr=sys.stderr)
-                _logger.info("Status code: " + str(run_res.returncode))
-                if run_res.returncode != 0:
-                    print(
-                        "Error: an error detected when running the following command, please take a check!",
-                        file=sys.stderr)
-                    print("\t", cmd, file=sys.stderr)
-                    print("Status code: %s" % str(run_res.returncode),
-                          file=sys.stderr)
-                    print(
-                        "Please don't run with --verbose, there is a known issue with it.",
-                        file=sys.stderr)
-                    sys.exit(run_res.returncode)
-        sys.exit(0)
+                        print(
+                            "Please don't run with --verbose, there is a known issue with it.",
+                            file=sys.stderr)
+                        sys.exit(run_res.returncode)
+            sys.exit(0)
 
     return
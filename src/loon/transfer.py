@@ -0,0 +1,617 @@
+# -*- coding: utf-8 -*-
+"""Native file transfers through SFTP of an opened SSH session
+
+Files are moved in fixed-size chunks. On upload, large files are
+mapped into memory and each chunk is sliced from the mapping, so every
+byte is copied once on its way to libssh2 (the binding only accepts
+`bytes`, a memoryview cannot be passed through). A background thread
+prepares the next chunk while the current one is being written to the
+network, and on download a background thread writes received chunks to
+disk while the next one is being read. libssh2 releases the GIL, so
+disk and network overlap and throughput is limited by the network.
+"""
+
+import os
+import mmap
+import queue
+import threading
+if __package__ == '' or __package__ is None:    # Use for test
+    from utils import walk_files
+    from remote import RemoteGlob, remote_hashes, _join, S_IFMT, S_IFDIR
+else:
+    from loon.utils import walk_files
+    from loon.remote import RemoteGlob, remote_hashes, _join, S_IFMT, S_IFDIR
+
+CHUNK_SIZE = 1024 * 1024
+# Number of chunks prepared (or waiting to be saved) in background,
+# 2 makes a double buffer
+QUEUE_DEPTH = 2
+# Files not larger than this are read or written at once without a thread
+DIRECT_SIZE = 4 * CHUNK_SIZE
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE, depth=QUEUE_DEPTH):
+    """Read a local file in fixed-size chunks
+
+    Small files are read at once. Larger files are mapped into memory
+    and chunks are sliced by a background thread which keeps at most
+    `depth` chunks ahead of the consumer.
+
+    Args:
+        path: a string representing the local file
+        chunk_size: size of each chunk in bytes, the last one may be shorter
+        depth: number of chunks read ahead
+
+    Returns:
+        a generator of bytes
+    """
+    with open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= DIRECT_SIZE:
+            # Pipes and files under /proc report 0, read until the end
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+            return
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            mm = None
+    if mm is None:
+        with open(path, 'rb', buffering=0) as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+        return
+
+    if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    chunks = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # Give up when the consumer stops early
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for offset in range(0, size, chunk_size):
+                if not put(mm[offset:offset + chunk_size]):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    reader = threading.Thread(target=produce, daemon=True)
+    reader.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+        reader.join()
+        mm.close()
+    return
+
+
+class _Writer:
+    """
+    Write chunks to a local file in a background thread
+    """
+    def __init__(self, path, depth=QUEUE_DEPTH):
+        self.f = open(path, 'wb', buffering=0)
+        self.error = None
+        self._chunks = queue.Queue(maxsize=depth)
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return
+
+    def _loop(self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                return
+            if self.error is not None:
+                # Drain so that the producer never blocks
+                continue
+            try:
+                view = memoryview(chunk)
+                while len(view) > 0:
+                    view = view[self.f.write(view):]
+            except Exception as e:
+                self.error = e
+
+    def write(self, chunk):
+        if self.error is not None:
+            raise self.error
+        self._chunks.put(chunk)
+        return
+
+    def close(self):
+        self._chunks.put(None)
+        self._thread.join()
+        self.f.close()
+        if self.error is not None:
+            raise self.error
+        return
+
+
+def put_file(sftp,
+             local_path,
+             remote_path,
+             chunk_size=CHUNK_SIZE,
+             preserve=True):
+    """Upload a local file, its permission bits are kept
+
+    Args:
+        sftp: an SFTP object of the session
+        local_path: a string representing the local file
+        remote_path: a string representing the remote file
+        chunk_size: size of each write in bytes
+        preserve: if `True`, keep access and modification times too
+
+    Returns:
+        number of bytes uploaded
+    """
+    # Import here, ssh2 is only needed when connecting
+    from ssh2.sftp import LIBSSH2_FXF_WRITE, LIBSSH2_FXF_CREAT, \
+        LIBSSH2_FXF_TRUNC
+
+    st = os.stat(local_path)
+    nbytes = 0
+    with sftp.open(remote_path,
+                   LIBSSH2_FXF_WRITE | LIBSSH2_FXF_CREAT | LIBSSH2_FXF_TRUNC,
+                   st.st_mode & 0o777) as remote_fh:
+        for chunk in read_chunks(local_path, chunk_size):
+            remote_fh.write(chunk)
+            nbytes += len(chunk)
+    if preserve:
+        _set_times(sftp, remote_path, st)
+    return nbytes
+
+
+def get_file(sftp, remote_path, local_path, chunk_size=CHUNK_SIZE, size=None):
+    """Download a remote file
+
+    Args:
+        sftp: an SFTP object of the session
+        remote_path: a string representing the remote file
+        local_path: a string representing the local file
+        chunk_size: size of each read in bytes
+        size: size of the remote file if it is known, small files are
+            saved without a background thread
+
+    Returns:
+        number of bytes downloaded
+    """
+    # Import here, ssh2 is only needed when connecting
+    from ssh2.sftp import LIBSSH2_FXF_READ
+
+    nbytes = 0
+    with sftp.open(remote_path, LIBSSH2_FXF_READ, 0) as remote_fh:
+        if size is not None and size <= DIRECT_SIZE:
+            writer = open(local_path, 'wb')
+        else:
+            writer = _Writer(local_path)
+        try:
+            rc, chunk = remote_fh.read(chunk_size)
+            while rc > 0:
+                writer.write(chunk)
+                nbytes += rc
+                rc, chunk = remote_fh.read(chunk_size)
+        finally:
+            writer.close()
+        if rc < 0:
+            raise IOError("failed to read %s (error %d)" % (remote_path, rc))
+    return nbytes
+
+
+def expand_home(rglob, path):
+    """Replace leading '~' of a remote path, SFTP does not expand it"""
+    if path == '~' or path.startswith('~/'):
+        return rglob.home() + path[1:]
+    return path
+
+
+def plan_local(sources, exclude=None):
+    """List local files and directories to send
+
+    Paths on the receiving side are relative to the destination
+    directory, the layout is the same as `scp -pr sources destination`.
+
+    Args:
+        sources: a list of local files or directories
+        exclude: a list of patterns of files and directories to skip,
+            matched like `exclude` of `walk_files`
+
+    Returns:
+        a tuple (directories, files), directories is a list of tuples
+        (relative path, mode) with parents first, files is a list of
+        tuples (local path, relative path), relative paths use '/'
+    """
+    dirs, files = [], []
+    for source in sources:
+        source = os.path.expanduser(source).rstrip(os.sep) or os.sep
+        target = os.path.basename(source)
+        if os.path.islink(source) and not os.path.exists(source):
+            print("Warning: skip broken symbolic link %s" % source)
+            continue
+        if not os.path.isdir(source):
+            files.append((source, target))
+            continue
+        # Symbolic links are followed like scp does, sorted paths
+        # keep parents before their children
+        tree_dirs = [(target, os.stat(source).st_mode & 0o777)]
+        tree_files = []
+        for entry in walk_files(source,
+                                exclude=exclude,
+                                follow_symlinks=True,
+                                yield_dirs=True):
+            rel = _join(target,
+                        os.path.relpath(entry.path, source).replace(os.sep, '/'))
+            try:
+                st = entry.stat()
+            except OSError:
+                print("Warning: skip broken symbolic link %s" % entry.path)
+                continue
+            if entry.is_dir():
+                tree_dirs.append((rel, st.st_mode & 0o777))
+            else:
+                tree_files.append((entry.path, rel))
+        dirs.extend(sorted(tree_dirs))
+        files.extend(sorted(tree_files, key=lambda x: x[1]))
+    return dirs, files
+
+
+def plan_upload(rglob, sources, destination, exclude=None):
+    """List files to upload and create remote directories
+
+    Layout is the same as `scp -pr sources destination`.
+
+    Args:
+        rglob: a RemoteGlob of the session
+        sources: a list of local files or directories
+        destination: a string representing the remote directory
+        exclude: a list of patterns of files and directories to skip,
+            matched like `exclude` of `walk_files`
+
+    Returns:
+        a list of tuples (local path, remote path)
+    """
+    destination = expand_home(rglob, destination).rstrip('/') or '/'
+    dirs, files = plan_local(sources, exclude)
+    make_tree(rglob.sftp, destination, dirs)
+    return [(local, _join(destination, rel)) for local, rel in files]
+
+
+def plan_download(rglob, sources, destination):
+    """List files to download and create local directories
+
+    Layout is the same as `scp -pr host:sources destination`, remote
+    sources can be glob patterns.
+
+    Args:
+        rglob: a RemoteGlob of the session
+        sources: a list of remote files, directories or patterns
+        destination: a string representing the local directory
+
+    Returns:
+        a list of tuples (RemoteEntry, local path)
+    """
+    destination = os.path.expanduser(destination)
+    if not os.path.isdir(destination):
+        os.makedirs(destination)
+    pairs = []
+    for pattern in sources:
+        entries = rglob.glob(pattern)
+        if len(entries) == 0:
+            raise FileNotFoundError("no such remote file: %s" % pattern)
+        for entry in entries:
+            target = os.path.join(destination, entry.name)
+            if not entry.is_dir:
+                pairs.append((entry, target))
+                continue
+            pending = [(entry.path, target)]
+            while len(pending) > 0:
+                remote_dir, local_dir = pending.pop()
+                if not os.path.isdir(local_dir):
+                    os.makedirs(local_dir)
+                for child in rglob.listdir(remote_dir):
+                    local_path = os.path.join(local_dir, child.name)
+                    if child.is_dir:
+                        if not child.is_link:
+                            pending.append((child.path, local_path))
+                        continue
+                    pairs.append((child, local_path))
+    return pairs
+
+
+def upload(session,
+           sources,
+           destination,
+           chunk_size=CHUNK_SIZE,
+           index=None,
+           checksum=True,
+           verify=False,
+           exclude=None):
+    """Upload local files and directories into a remote directory
+
+    Args:
+        session: an authenticated session
+        sources: a list of local files or directories
+        destination: a string representing the remote directory
+        chunk_size: size of each write in bytes
+        index: a HashIndex, needed by `checksum` and `verify`
+        checksum: if `True` and `index` is given, files whose remote
+            copy has the same content are skipped
+        verify: if `True`, compare hashes of uploaded files and
+            upload mismatched ones again, see `verify_files`
+        exclude: a list of patterns of files and directories to skip
+
+    Returns:
+        a dict containing numbers of 'files' and 'bytes' uploaded,
+        files 'skipped', and if `verify`, pairs 'mismatched' at first
+        check and pairs 'failed' after retries
+    """
+    rglob = RemoteGlob(session)
+    pairs = plan_upload(rglob, sources, destination, exclude)
+    res = {'files': 0, 'bytes': 0, 'skipped': 0}
+    if index is not None and checksum:
+        local = index.hash_files([i[0] for i in pairs])
+        remote = remote_hashes(session, [i[1] for i in pairs],
+                               index.algorithm)
+        todo = [i for i in pairs if local[i[0]] != remote.get(i[1])]
+        res['skipped'] = len(pairs) - len(todo)
+        pairs = todo
+    for local_path, remote_path in pairs:
+        res['bytes'] += put_file(rglob.sftp, local_path, remote_path,
+                                 chunk_size)
+        res['files'] += 1
+    if verify:
+        res['mismatched'], res['failed'] = verify_files(
+            session, pairs, index, 'upload', rglob.sftp, chunk_size)
+    return res
+
+
+def download(session,
+             sources,
+             destination,
+             chunk_size=CHUNK_SIZE,
+             index=None,
+             checksum=True,
+             verify=False,
+             window=None):
+    """Download remote files and directories into a local directory
+
+    Args:
+        session: an authenticated session
+        sources: a list of remote files, directories or patterns
+        destination: a string representing the local directory
+        chunk_size: size of each read in bytes
+        index: a HashIndex, needed by `checksum` and `verify`
+        checksum: if `True` and `index` is given, existing local
+            files with the same content as remote ones are skipped
+        verify: if `True`, compare hashes of downloaded files and
+            download mismatched ones again, see `verify_files`
+        window: receive window size in bytes of the SFTP channel,
+            `None` keeps the default
+
+    Returns:
+        a dict containing numbers of 'files' and 'bytes' downloaded,
+        files 'skipped', and if `verify`, pairs 'mismatched' at first
+        check and pairs 'failed' after retries
+    """
+    rglob = RemoteGlob(session, window)
+    pairs = plan_download(rglob, sources, destination)
+    res = {'files': 0, 'bytes': 0, 'skipped': 0}
+    if index is not None and checksum:
+        # Only files with the same size can be the same
+        same_size = [
+            i for i in pairs if os.path.isfile(i[1])
+            and os.path.getsize(i[1]) == i[0].size
+        ]
+        local = index.hash_files([i[1] for i in same_size])
+        remote = remote_hashes(session, [i[0].path for i in same_size],
+                               index.algorithm)
+        skip = set(i[1] for i in same_size
+                   if local[i[1]] == remote.get(i[0].path))
+        pairs = [i for i in pairs if i[1] not in skip]
+        res['skipped'] = len(skip)
+    for entry, local_path in pairs:
+        res['bytes'] += get_file(rglob.sftp, entry.path, local_path,
+                                 chunk_size, entry.size)
+        os.utime(local_path, (entry.mtime, entry.mtime))
+        res['files'] += 1
+    if verify:
+        res['mismatched'], res['failed'] = verify_files(
+            session, [(i[1], i[0].path) for i in pairs], index, 'download',
+            rglob.sftp, chunk_size)
+    return res
+
+
+def verify_files(session,
+                 pairs,
+                 index,
+                 direction,
+                 sftp=None,
+                 chunk_size=CHUNK_SIZE,
+                 retries=2):
+    """Compare hashes of transferred files and transfer mismatched ones again
+
+    Remote files are hashed with one batched call in a background
+    thread while local files are hashed in the thread pool of `index`.
+
+    Args:
+        session: an authenticated session
+        pairs: a list of tuples (local path, remote path)
+        index: a HashIndex
+        direction: 'upload' or 'download', direction of re-transfers
+        sftp: an SFTP object of the session, a new one is opened if `None`
+        chunk_size: size of each read or write in bytes
+        retries: times to transfer mismatched files again
+
+    Returns:
+        a tuple (pairs mismatched at first check, pairs still
+        mismatched after retries)
+    """
+    # Downloaded files are written in place, never trust their index entries
+    refresh = direction == 'download'
+    bad = mismatched = _compare(session, pairs, index, refresh)
+    for _ in range(retries):
+        if len(bad) == 0:
+            break
+        if sftp is None:
+            sftp = session.sftp_init()
+        for local_path, remote_path in bad:
+            if direction == 'upload':
+                put_file(sftp, local_path, remote_path, chunk_size)
+            else:
+                get_file(sftp, remote_path, local_path, chunk_size)
+                attrs = sftp.stat(remote_path)
+                os.utime(local_path, (attrs.mtime, attrs.mtime))
+        bad = _compare(session, bad, index, refresh)
+    return mismatched, bad
+
+
+def _compare(session, pairs, index, refresh=False):
+    """Pairs (local path, remote path) whose content differs"""
+    remote = {}
+    errors = []
+
+    def hash_remote():
+        try:
+            remote.update(
+                remote_hashes(session, [i[1] for i in pairs],
+                              index.algorithm))
+        except Exception as e:
+            errors.append(e)
+
+    # The session is only used by this thread until it is joined
+    thread = threading.Thread(target=hash_remote, daemon=True)
+    thread.start()
+    try:
+        local = index.hash_files(
+            [i[0] for i in pairs if os.path.isfile(i[0])], refresh)
+    finally:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return [
+        i for i in pairs
+        if i[0] not in local or local[i[0]] != remote.get(i[1])
+    ]
+
+
+def _set_times(sftp, remote_path, st):
+    """Set access and modification times of a remote file like `scp -p`"""
+    from ssh2.sftp import LIBSSH2_SFTP_ATTR_ACMODTIME
+    from ssh2.sftp_handle import SFTPAttributes
+
+    attrs = SFTPAttributes()
+    attrs.flags = LIBSSH2_SFTP_ATTR_ACMODTIME
+    attrs.atime = int(st.st_atime)
+    attrs.mtime = int(st.st_mtime)
+    try:
+        sftp.setstat(remote_path, attrs)
+    except Exception:
+        # Not allowed on some servers, content is what matters
+        pass
+    return
+
+
+def set_mode(sftp, remote_path, mode):
+    """Set permission bits of a remote file, which are masked by the
+    umask of the server when the file is created"""
+    from ssh2.sftp import LIBSSH2_SFTP_ATTR_PERMISSIONS
+    from ssh2.sftp_handle import SFTPAttributes
+
+    attrs = SFTPAttributes()
+    attrs.flags = LIBSSH2_SFTP_ATTR_PERMISSIONS
+    attrs.permissions = mode
+    sftp.setstat(remote_path, attrs)
+    return
+
+
+def _mkdir(sftp, path, mode=0o755):
+    try:
+        sftp.mkdir(path, mode)
+    except Exception:
+        # Exists or no permission, failure comes out when writing files
+        pass
+    return
+
+
+def make_tree(sftp, destination, dirs):
+    """Create the destination and directories listed by `plan_local` under it"""
+    makedirs(sftp, destination)
+    for rel, mode in dirs:
+        _mkdir(sftp, _join(destination, rel), mode)
+    return
+
+
+def makedirs(sftp, path):
+    """Create a remote directory and its parents, errors are ignored"""
+    current = ''
+    for part in path.split('/'):
+        if part == '':
+            current = '/' if current == '' else current
+            continue
+        current = _join(current, part)
+        _mkdir(sftp, current)
+    return
+
+
+def remove_tree(sftp, path):
+    """Remove a remote file or a directory with everything in it
+
+    Symbolic links are removed, not followed. Errors are ignored.
+
+    Args:
+        sftp: an SFTP object of the session
+        path: a string representing the remote path
+
+    Returns:
+        number of removed files and directories
+    """
+    try:
+        sftp.unlink(path)
+        return 1
+    except Exception:
+        # A directory or does not exist
+        pass
+    try:
+        handle = sftp.opendir(path)
+    except Exception:
+        return 0
+    if handle is None or isinstance(handle, int):
+        return 0
+    entries = [(name.decode('utf-8', errors='replace'), attrs)
+               for _, name, attrs in handle.readdir()]
+    handle.close()
+    n = 0
+    for name, attrs in entries:
+        if name in ('.', '..'):
+            continue
+        if attrs.permissions & S_IFMT == S_IFDIR:
+            n += remove_tree(sftp, _join(path, name))
+            continue
+        try:
+            sftp.unlink(_join(path, name))
+            n += 1
+        except Exception:
+            pass
+    try:
+        sftp.rmdir(path)
+        n += 1
+    except Exception:
+        pass
+    return n
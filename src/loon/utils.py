@@ -1,5 +1,12 @@
 import os
 import csv
+import re
+import mmap
+import glob
+import stat
+import fnmatch
+import getpass
+import hashlib
 from os.path import isfile, isdir
 
 
@@ -47,24 +54,245 @@ def pretty_table(title, content):
     return
 
 
+def walk_files(root,
+               include=None,
+               exclude=None,
+               follow_symlinks=False,
+               yield_dirs=False):
+    """Walk a directory tree and yield files lazily
+
+    It is based on `os.scandir`, so no extra stat call is needed to
+    tell files from directories and `entry.stat()` is cached.
+    Patterns are matched (fnmatch style) against both the path
+    relative to root and the base name, excluded directories are
+    not entered.
+
+    Args:
+        root: a string representing the directory
+        include: a list of patterns, only matched files are yielded if set
+        exclude: a list of patterns for files and directories to skip
+        follow_symlinks: if `True`, walk into symbolic links to directories,
+            a link to a directory which is being walked is skipped; if
+            `False`, symbolic links to directories are skipped
+        yield_dirs: if `True`, also yield directories (not matched
+            against `include`), each one before anything in it
+
+    Yields:
+        `os.DirEntry` objects of files
+    """
+    def matched(entry, rel, patterns):
+        return any(
+            fnmatch.fnmatch(rel, p) or fnmatch.fnmatch(entry.name, p)
+            for p in patterns)
+
+    def walk(path, prefix, parents):
+        try:
+            it = os.scandir(path)
+        except OSError:
+            return
+        with it:
+            for entry in it:
+                rel = prefix + entry.name
+                if exclude and matched(entry, rel, exclude):
+                    continue
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=follow_symlinks)
+                    if not follow_symlinks and not is_dir and \
+                            entry.is_symlink() and entry.is_dir():
+                        # A link to a directory is not a file either
+                        continue
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    key = None
+                    if follow_symlinks:
+                        st = entry.stat()
+                        key = (st.st_dev, st.st_ino)
+                        if key in parents:
+                            # A link back to a parent, avoid endless loop
+                            continue
+                    if yield_dirs:
+                        yield entry
+                    yield from walk(entry.path, rel + os.sep, parents | {key})
+                elif not include or matched(entry, rel, include):
+                    yield entry
+
+    parents = set()
+    if follow_symlinks:
+        try:
+            st = os.stat(root)
+            parents.add((st.st_dev, st.st_ino))
+        except OSError:
+            pass
+    return walk(root, '', frozenset(parents))
+
+
+def is_excluded(rel, patterns):
+    """Check whether a relative path or its base name matches a pattern
+
+    The same rule as `exclude` of `walk_files`.
+
+    Args:
+        rel: a string representing the path relative to a root directory
+        patterns: a list of fnmatch style patterns
+
+    Returns:
+        a bool
+    """
+    name = os.path.basename(rel)
+    return any(
+        fnmatch.fnmatch(rel, p) or fnmatch.fnmatch(name, p) for p in patterns)
+
+
 def get_filelist(dirName):
-    """Create a list of file and sub directories names in the given directory.
-    
-    Source code from: https://thispointer.com/python-how-to-get-list-of-files-in-directory-and-sub-directories/
+    """Create a list of files in the given directory and its sub directories.
+
+    Args:
+        dirName: a string representing the directory
+
+    Returns:
+        a list of file paths
     """
-    listOfFile = os.listdir(dirName)
-    allFiles = list()
-    # Iterate over all the entries
-    for entry in listOfFile:
-        # Create full path
-        fullPath = os.path.join(dirName, entry)
-        # If entry is a directory then get the list of files in this directory
-        if isdir(fullPath):
-            allFiles = allFiles + get_filelist(fullPath)
-        else:
-            allFiles.append(fullPath)
+    return [entry.path for entry in walk_files(dirName, follow_symlinks=True)]
+
+
+def expand_paths(patterns):
+    """Expand local glob patterns, each match is stat-ed only once
+
+    Args:
+        patterns: a list of paths, glob pattern is supported
+
+    Yields:
+        tuples (path, is_dir), `is_dir` is `None` if path cannot be stat-ed
+    """
+    for pattern in patterns:
+        for path in glob.iglob(pattern):
+            try:
+                is_dir = stat.S_ISDIR(os.stat(path).st_mode)
+            except OSError:
+                is_dir = None
+            yield path, is_dir
 
-    return allFiles
+
+def file_hash(path, algorithm='sha256', chunk_size=1024 * 1024):
+    """Compute hash of file content
+
+    Args:
+        path: a string representing the path to file
+        algorithm: a hash algorithm supported by hashlib
+        chunk_size: size of each read in bytes
+
+    Returns:
+        a hex string
+    """
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        mm = None
+        if size > chunk_size:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                pass
+        if mm is None:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+            return h.hexdigest()
+    # Hash slices of the mapping, no copy into Python objects
+    with mm, memoryview(mm) as view:
+        for offset in range(0, size, chunk_size):
+            h.update(view[offset:offset + chunk_size])
+    return h.hexdigest()
+
+
+def get_size(paths):
+    """Get total size in bytes of files and directories, missing paths are ignored
+
+    Args:
+        paths: a list of paths to files (directories)
+
+    Returns:
+        an integer
+    """
+    size = 0
+    for path in paths:
+        path = os.path.expanduser(path)
+        if isdir(path):
+            size += sum(
+                entry.stat().st_size
+                for entry in walk_files(path, follow_symlinks=True))
+        elif isfile(path):
+            size += os.path.getsize(path)
+    return size
+
+
+def parse_size(text):
+    """Parse a size like '512K', '4M' or '1G' (powers of 1024) into bytes
+
+    Args:
+        text: a string or an integer
+
+    Returns:
+        an integer
+    """
+    if isinstance(text, int):
+        return text
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kKmMgG]?)[bB]?\s*$', text)
+    if m is None:
+        raise ValueError("bad size %s" % text)
+    unit = {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3}[m.group(2).lower()]
+    return int(float(m.group(1)) * unit)
+
+
+def has_magic(pattern):
+    """Check if a path pattern contains glob wildcards (*, ?, [] or {a,b})"""
+    return re.search(r'[*?[]|{[^{}]*,[^{}]*}', pattern) is not None
+
+
+def expand_braces(pattern):
+    """Expand shell-like braces in a pattern
+
+    For example, 'a{b,c{d,e}}f' is expanded to ['abf', 'acdf', 'acef'],
+    braces without comma are kept as is.
+
+    Args:
+        pattern: a string
+
+    Returns:
+        a list of strings
+    """
+    depth = 0
+    start = None
+    for i, c in enumerate(pattern):
+        if c == '{':
+            if depth == 0:
+                start = i
+            depth += 1
+        elif c == '}' and depth > 0:
+            depth -= 1
+            if depth > 0:
+                continue
+            # Split top-level commas
+            parts = []
+            level = 0
+            last = start + 1
+            for j in range(start + 1, i):
+                if pattern[j] == '{':
+                    level += 1
+                elif pattern[j] == '}':
+                    level -= 1
+                elif pattern[j] == ',' and level == 0:
+                    parts.append(pattern[last:j])
+                    last = j + 1
+            if len(parts) == 0:
+                continue
+            parts.append(pattern[last:i])
+            res = []
+            for part in parts:
+                res.extend(
+                    expand_braces(pattern[:start] + part + pattern[i + 1:]))
+            return res
+    return [pattern]
 
 
 def decomment(csvfile):
@@ -87,6 +315,135 @@ def read_csv(file_path, sep=',', rm_comment=True):
     return res
 
 
+def read_ssh_config(file_path):
+    """Read hosts from an OpenSSH client config file (e.g. ~/.ssh/config)
+
+    Only `Host` blocks with concrete aliases are returned, wildcard
+    patterns (`*`, `?`, `!`) are used as defaults for other blocks.
+    As in ssh, the first obtained value for each keyword wins.
+
+    Args:
+        file_path: a string representing the path to the config file
+
+    Returns:
+        a list of [alias, username, host, port] lists, ProxyJump is
+        appended if it is set
+    """
+    blocks = []
+    patterns = ['*']
+    options = {}
+    with open(os.path.expanduser(file_path), "r", encoding='utf-8') as f:
+        for row in decomment(f):
+            key, value = (re.split(r'\s*=\s*|\s+', row, maxsplit=1) + [''])[:2]
+            key = key.lower()
+            value = value.strip().strip('"')
+            if key in ('host', 'match'):
+                blocks.append((patterns, options))
+                patterns = value.split() if key == 'host' else []
+                options = {}
+            elif key not in options:
+                options[key] = value
+    blocks.append((patterns, options))
+
+    def resolve(alias):
+        res = {}
+        for patterns, options in blocks:
+            positive = [p for p in patterns if not p.startswith('!')]
+            negative = [p[1:] for p in patterns if p.startswith('!')]
+            if any(fnmatch.fnmatchcase(alias, p) for p in negative):
+                continue
+            if any(fnmatch.fnmatchcase(alias, p) for p in positive):
+                for key, value in options.items():
+                    res.setdefault(key, value)
+        return res
+
+    hosts = []
+    for patterns, _ in blocks:
+        for alias in patterns:
+            if any(i in alias for i in '*?!'):
+                continue
+            options = resolve(alias)
+            hosts.append([
+                alias,
+                options.get('user', getpass.getuser()),
+                options.get('hostname', alias),
+                options.get('port', 22)
+            ])
+            if options.get('proxyjump', 'none').lower() != 'none':
+                hosts[-1].append(options['proxyjump'])
+    return hosts
+
+
+def read_inventory(file_path, fmt=None):
+    """Read hosts from an inventory file
+
+    Supported formats are OpenSSH client config ('ssh'), CSV ('csv')
+    with columns alias,username,host[,port[,jump]] and YAML ('yaml') with a
+    list of (or a mapping from alias to) mappings containing
+    username, host and optional port and jump. YAML support needs PyYAML.
+
+    Args:
+        file_path: a string representing the path to the inventory file
+        fmt: inventory format, guessed from file extension if `None`
+
+    Returns:
+        a list of [alias, username, host, port[, jump]] lists, not validated,
+        jump is a string of comma separated jump hosts
+    """
+    if fmt is None:
+        ext = os.path.splitext(file_path)[1].lower()
+        fmt = {'.csv': 'csv', '.yml': 'yaml', '.yaml': 'yaml'}.get(ext, 'ssh')
+
+    if fmt == 'ssh':
+        return read_ssh_config(file_path)
+
+    file_path = os.path.expanduser(file_path)
+    if fmt == 'csv':
+        hosts = read_csv(file_path)
+        if len(hosts) > 0 and hosts[0][0].strip().lower() in ('alias', 'name'):
+            # Remove header
+            _ = hosts.pop(0)
+        return [[i.strip() for i in row] for row in hosts]
+    elif fmt == 'yaml':
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError(
+                "PyYAML is required to read YAML inventory, install it with 'pip install pyyaml'"
+            )
+        try:
+            with open(file_path, "r", encoding='utf-8') as f:
+                data = yaml.safe_load(f) or []
+        except yaml.YAMLError as e:
+            raise ValueError("cannot parse YAML inventory %s\n%s" %
+                             (file_path, e))
+        if isinstance(data, dict):
+            if not all(isinstance(v, dict) for v in data.values()):
+                raise ValueError(
+                    "each host in YAML inventory must be a mapping!")
+            data = [dict(v, name=k) for k, v in data.items()]
+        if not isinstance(data, list):
+            raise ValueError("YAML inventory must be a list of hosts or "
+                             "a mapping from alias to host!")
+        hosts = []
+        for index, item in enumerate(data):
+            if not isinstance(item, dict):
+                raise ValueError("entry %d of YAML inventory is not a mapping!"
+                                 % (index + 1))
+            jump = item.get('jump', item.get('proxyjump'))
+            if isinstance(jump, list):
+                jump = ','.join(jump)
+            hosts.append([
+                item.get('name', item.get('alias')),
+                item.get('username', item.get('user')),
+                item.get('host', item.get('hostname')),
+                item.get('port', 22), jump
+            ])
+        return hosts
+    else:
+        raise ValueError("Unsupported inventory format: %s" % fmt)
+
+
 if __name__ == "__main__":
     # Test pretty_table
     title = ['Alias', 'Username', 'IP address', 'Port']
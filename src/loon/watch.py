@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""Watch a local directory for changes
+
+Changes are reported by inotify on Linux (through ctypes, no extra
+dependency) and by polling modification times and sizes elsewhere or
+when inotify is not available. Events are batched: a batch is yielded
+once no new event arrives for a short debounce window, so saving many
+files at once (or an editor writing a temporary file and renaming it)
+results in one batch of relative paths.
+"""
+
+import os
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+if __package__ == '' or __package__ is None:    # Use for test
+    from utils import is_excluded
+else:
+    from loon.utils import is_excluded
+
+# Editor temporary files and version control directories
+DEFAULT_EXCLUDE = [
+    '.git', '.hg', '.svn', '__pycache__', '*.pyc', '*.swp', '*.swx', '*~',
+    '.#*', '4913', '.DS_Store'
+]
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT = struct.Struct('iIII')
+
+
+class PollingWatcher:
+    """
+    Detect changes by comparing snapshots of modification times and sizes
+    """
+    def __init__(self, root, exclude=DEFAULT_EXCLUDE, interval=1):
+        """
+        Args:
+            root: a string representing the directory to watch
+            exclude: a list of glob patterns of names or relative paths to ignore
+            interval: seconds between two snapshots
+        """
+        self.root = root
+        self.exclude = exclude
+        self.interval = interval
+        self._snapshot = self._scan()
+        self._next = time.time() + interval
+        return
+
+    def _scan(self):
+        res = {}
+        for root, dirs, files in os.walk(self.root):
+            rel_root = os.path.relpath(root, self.root)
+            rel_root = '' if rel_root == '.' else rel_root
+            dirs[:] = [
+                d for d in dirs
+                if not is_excluded(os.path.join(rel_root, d), self.exclude)
+            ]
+            files = [
+                f for f in files
+                if not is_excluded(os.path.join(rel_root, f), self.exclude)
+            ]
+            for name in dirs + files:
+                rel = os.path.join(rel_root, name)
+                try:
+                    st = os.lstat(os.path.join(root, name))
+                except OSError:
+                    continue
+                res[rel] = (st.st_mtime_ns, st.st_size)
+        return res
+
+    def read(self, timeout):
+        """Wait at most `timeout` seconds for changes
+
+        Returns:
+            a tuple (set of changed paths, set of deleted paths), paths
+            are relative to the root
+        """
+        wait = self._next - time.time()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set(), set()
+        if wait > 0:
+            time.sleep(wait)
+        self._next = time.time() + self.interval
+        snapshot = self._scan()
+        changed = set(k for k, v in snapshot.items()
+                      if self._snapshot.get(k) != v)
+        deleted = set(self._snapshot) - set(snapshot)
+        self._snapshot = snapshot
+        return changed, deleted
+
+    def close(self):
+        return
+
+
+class InotifyWatcher:
+    """
+    Detect changes with Linux inotify, every directory is watched
+    """
+    MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | \
+        IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+    def __init__(self, root, exclude=DEFAULT_EXCLUDE):
+        """
+        Args:
+            root: a string representing the directory to watch
+            exclude: a list of glob patterns of names or relative paths to ignore
+
+        Raises:
+            OSError if inotify is not available
+        """
+        self.root = root
+        self.exclude = exclude
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}
+        self._add_tree('')
+        return
+
+    def _add_watch(self, rel):
+        path = os.path.join(self.root, rel)
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                          self.MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if errno == 28:
+                # ENOSPC, fs.inotify.max_user_watches is reached
+                raise OSError(errno, "too many directories to watch")
+            return False
+        self._dirs[wd] = rel
+        return True
+
+    def _remove_tree(self, rel):
+        """Stop watching a directory moved out and directories in it"""
+        prefix = rel + os.sep
+        for wd, path in list(self._dirs.items()):
+            if path == rel or path.startswith(prefix):
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self._dirs[wd]
+        return
+
+    def _add_tree(self, rel):
+        """Watch a directory recursively, return files already in it"""
+        files = set()
+        if not self._add_watch(rel):
+            return files
+        for root, dirs, names in os.walk(os.path.join(self.root, rel)):
+            rel_root = os.path.relpath(root, self.root)
+            rel_root = '' if rel_root == '.' else rel_root
+            dirs[:] = [
+                d for d in dirs
+                if not is_excluded(os.path.join(rel_root, d), self.exclude)
+            ]
+            for d in dirs:
+                self._add_watch(os.path.join(rel_root, d))
+            files.update(
+                os.path.join(rel_root, n) for n in names
+                if not is_excluded(os.path.join(rel_root, n), self.exclude))
+        return files
+
+    def read(self, timeout):
+        """Wait at most `timeout` seconds for changes
+
+        Returns:
+            a tuple (set of changed paths, set of deleted paths), paths
+            are relative to the root
+        """
+        changed, deleted = set(), set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return changed, deleted
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return changed, deleted
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, size = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size:offset + _EVENT.size +
+                        size].rstrip(b'\0')
+            offset += _EVENT.size + size
+            if mask & IN_Q_OVERFLOW:
+                # Events are lost, take everything as changed
+                changed.update(self._add_tree(''))
+                continue
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            if wd not in self._dirs or len(name) == 0:
+                continue
+            rel = os.path.join(self._dirs[wd], os.fsdecode(name))
+            if is_excluded(rel, self.exclude):
+                continue
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                if mask & IN_MOVED_FROM and mask & IN_ISDIR:
+                    # Its watches would go on with the old path
+                    self._remove_tree(rel)
+                deleted.add(rel)
+                changed.discard(rel)
+            elif mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files may be created before the watch is added
+                    changed.add(rel)
+                    changed.update(self._add_tree(rel))
+                    deleted.discard(rel)
+            else:
+                changed.add(rel)
+                deleted.discard(rel)
+        return changed, deleted
+
+    def close(self):
+        os.close(self.fd)
+        return
+
+
+def open_watcher(root, exclude=DEFAULT_EXCLUDE, poll=False):
+    """Watch a directory with inotify if possible, otherwise by polling
+
+    Args:
+        root: a string representing the directory to watch
+        exclude: a list of glob patterns of names or relative paths to ignore
+        poll: if `True`, always poll
+
+    Returns:
+        an InotifyWatcher or PollingWatcher object
+    """
+    if not poll and hasattr(select, 'select') and os.name == 'posix':
+        try:
+            return InotifyWatcher(root, exclude)
+        except (OSError, AttributeError, TypeError):
+            pass
+    return PollingWatcher(root, exclude)
+
+
+def batches(watcher, debounce=0.3, max_delay=3, idle=10):
+    """Group changes into batches
+
+    A batch ends when no event comes in `debounce` seconds, or
+    `max_delay` seconds after its first event. An empty batch is
+    yielded after `idle` seconds without changes, so that callers
+    can keep their connections alive.
+
+    Args:
+        watcher: an object returned by `open_watcher`
+        debounce: seconds to wait for more events
+        max_delay: maximal seconds to delay a batch
+        idle: seconds between empty batches
+
+    Returns:
+        a generator of tuples (set of changed paths, set of deleted paths)
+    """
+    while True:
+        changed, deleted = watcher.read(idle)
+        if len(changed) == 0 and len(deleted) == 0:
+            yield changed, deleted
+            continue
+        end = time.time() + max_delay
+        while time.time() < end:
+            more_changed, more_deleted = watcher.read(
+                min(debounce, max(0, end - time.time())))
+            if len(more_changed) == 0 and len(more_deleted) == 0:
+                break
+            changed -= more_deleted
+            deleted -= more_changed
+            changed |= more_changed
+            deleted |= more_deleted
+        yield changed, deleted
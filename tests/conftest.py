@@ -1,10 +1,193 @@
 # -*- coding: utf-8 -*-
 """
-    Dummy conftest.py for loon.
+    conftest.py for loon.
+
+    `remote_home` gives sessions which work on a local directory standing
+    in for the home directory of a remote host: SFTP calls map to file
+    operations and commands run in a local shell, so code using ssh2
+    sessions can be tested without a server.
 
-    If you don't know what this is for, just leave it empty.
     Read more about conftest.py under:
     https://pytest.org/latest/plugins.html
 """
 
-# import pytest
+import os
+import subprocess
+import pytest
+
+
+class LocalAttrs:
+    def __init__(self, st=None):
+        if st is not None:
+            self.permissions = st.st_mode
+            self.filesize = st.st_size
+            self.atime = int(st.st_atime)
+            self.mtime = int(st.st_mtime)
+
+
+class LocalHandle:
+    def __init__(self, path, flags, mode):
+        from ssh2.sftp import LIBSSH2_FXF_WRITE
+        if flags & LIBSSH2_FXF_WRITE:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+            self.f = os.fdopen(fd, 'wb')
+        else:
+            self.f = open(path, 'rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data):
+        self.f.write(data)
+        return 0, len(data)
+
+    def read(self, size):
+        data = self.f.read(size)
+        return len(data), data
+
+    def close(self):
+        self.f.close()
+
+
+class LocalDir:
+    def __init__(self, path):
+        self.path = path
+
+    def readdir(self):
+        for name in ['.', '..'] + sorted(os.listdir(self.path)):
+            st = os.lstat(os.path.join(self.path, name))
+            yield len(name), name.encode('utf-8'), LocalAttrs(st)
+
+    def close(self):
+        pass
+
+
+class LocalSFTP:
+    """SFTP operations on local files, like an OpenSSH server does them"""
+    def __init__(self, home, windows=None):
+        self.home = home
+        self.windows = windows
+
+    def _path(self, path):
+        return os.path.join(self.home, path)
+
+    def open(self, path, flags, mode):
+        return LocalHandle(self._path(path), flags, mode)
+
+    def opendir(self, path):
+        if not os.path.isdir(self._path(path)):
+            raise OSError("not a directory")
+        return LocalDir(self._path(path))
+
+    def stat(self, path):
+        return LocalAttrs(os.stat(self._path(path)))
+
+    def setstat(self, path, attrs):
+        from ssh2.sftp import LIBSSH2_SFTP_ATTR_ACMODTIME, \
+            LIBSSH2_SFTP_ATTR_PERMISSIONS
+        if attrs.flags & LIBSSH2_SFTP_ATTR_PERMISSIONS:
+            os.chmod(self._path(path), attrs.permissions & 0o7777)
+        if attrs.flags & LIBSSH2_SFTP_ATTR_ACMODTIME:
+            os.utime(self._path(path), (attrs.atime, attrs.mtime))
+
+    def mkdir(self, path, mode):
+        os.mkdir(self._path(path), mode)
+
+    def rmdir(self, path):
+        os.rmdir(self._path(path))
+
+    def unlink(self, path):
+        os.unlink(self._path(path))
+
+    def rename(self, src, dst):
+        os.rename(self._path(src), self._path(dst))
+
+    def realpath(self, path):
+        return os.path.realpath(self._path(path))
+
+    def get_channel(self):
+        return LocalChannel(self.home, self.windows)
+
+
+class LocalChannel:
+    """A channel running its command with sh in the home directory"""
+    def __init__(self, home, windows=None):
+        self.home = home
+        self.windows = windows
+        self.stdin = b''
+        self.out = None
+
+    def execute(self, command):
+        self.command = command
+        return 0
+
+    def write(self, data):
+        self.stdin += data
+        return 0, len(data)
+
+    def send_eof(self):
+        env = dict(os.environ, HOME=self.home)
+        res = subprocess.run(['sh', '-c', self.command],
+                             input=self.stdin,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             cwd=self.home,
+                             env=env)
+        self.out, self.err, self.status = res.stdout, res.stderr, res.returncode
+
+    def read(self, size=32768):
+        if self.out is None:
+            self.send_eof()
+        data, self.out = self.out[:size], self.out[size:]
+        return len(data), data
+
+    def read_stderr(self, size=32768):
+        if self.out is None:
+            self.send_eof()
+        data, self.err = self.err[:size], self.err[size:]
+        return len(data), data
+
+    def receive_window_adjust2(self, size, force):
+        self.windows.append(size)
+
+    def close(self):
+        return 0
+
+    def wait_closed(self):
+        return 0
+
+    def get_exit_status(self):
+        return self.status
+
+
+class LocalSession:
+    def __init__(self, home):
+        self.home = home
+        # Extra receive windows announced by channels of the session
+        self.windows = []
+
+    def sftp_init(self):
+        return LocalSFTP(self.home, self.windows)
+
+    def open_session(self):
+        return LocalChannel(self.home, self.windows)
+
+    def keepalive_send(self):
+        return 10
+
+    def disconnect(self):
+        pass
+
+
+@pytest.fixture
+def remote_home(tmp_path):
+    """A function creating a session whose home is a new local directory"""
+    def make(name='remote'):
+        home = tmp_path / name
+        home.mkdir()
+        return LocalSession(str(home))
+
+    return make
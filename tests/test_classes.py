@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import json
+import pytest
+from loon import classes
+from loon.classes import Host
+from loon.connection import CHANNEL_WINDOW_DEFAULT
+
+
+class FakeChannel:
+    def __init__(self):
+        self.adjusted = []
+
+    def receive_window_adjust2(self, size, force):
+        self.adjusted.append(size)
+
+
+class FakeSession:
+    def __init__(self):
+        self.channels = []
+
+    def open_session(self):
+        self.channels.append(FakeChannel())
+        return self.channels[-1]
+
+    def disconnect(self):
+        pass
+
+
+class FakeSocket:
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def host(tmp_path, monkeypatch):
+    hostfile = tmp_path / 'host.json'
+    hostfile.write_text(
+        json.dumps({
+            'active': ['h1', 'u1', '127.0.0.1', 22],
+            'available': [['h1', 'u1', '127.0.0.1', 22],
+                          ['h2', 'u2', '127.0.0.2', 22]],
+            'options': {
+                'h2': {
+                    'window': 4 * CHANNEL_WINDOW_DEFAULT
+                }
+            }
+        }))
+    sessions = []
+
+    def open_session(host, **kwargs):
+        h.sockopts.append(kwargs.get('sockopts'))
+        sessions.append((host, FakeSession()))
+        return sessions[-1][1], FakeSocket()
+
+    monkeypatch.setattr(classes, 'open_session', open_session)
+    h = Host(hostfile=str(hostfile))
+    h.sessions = sessions
+    h.sockopts = []
+    return h
+
+
+def test_connect_opens_channel(host):
+    host.connect()
+    assert host.sessions[0][0][0] == 'h1'
+    assert host.channel is host.session.channels[0]
+    assert host.channel.adjusted == []
+
+
+def test_connect_without_channel(host):
+    host.connect(open_channel=False)
+    assert host.session.channels == []
+
+
+def test_connect_window(host):
+    host.active_host = ['h2', 'u2', '127.0.0.2', 22]
+    host.connect()
+    assert host.channel.adjusted == [3 * CHANNEL_WINDOW_DEFAULT]
+
+
+def test_reconnect(host):
+    host.connect()
+    first = host.session
+    host.reconnect()
+    assert host.session is not first
+    assert len(host.session.channels) == 1
+
+
+def test_retry_reconnects(host, monkeypatch):
+    from loon import connection
+    monkeypatch.setattr(connection, 'sleep', lambda seconds: None)
+    host.connect(open_channel=False)
+    sessions = []
+
+    def listing():
+        sessions.append(host.session)
+        if len(sessions) == 1:
+            raise ConnectionResetError('reset')
+        return 'listed'
+
+    assert host.retry(listing) == 'listed'
+    # The second call gets the new session
+    assert sessions[0] is not sessions[1]
+    assert len(host.sessions) == 2
+
+
+def test_import_hosts_bad_inventory(host, tmp_path, capsys):
+    pytest.importorskip('yaml')
+    inventory = tmp_path / 'hosts.yaml'
+    inventory.write_text("- name: [h1\n")
+    with pytest.raises(SystemExit) as e:
+        host.import_hosts(str(inventory))
+    assert e.value.code == 1
+    assert capsys.readouterr().out.startswith('Error: cannot parse YAML')
+    assert len(host.available_hosts) == 2
+
+
+def test_socket_options(host):
+    host.options['h2'].update(nodelay=False, sockbuf=1024 * 1024)
+    assert host.socket_options() == {'nodelay': True}
+    h2 = host.available_hosts[1]
+    assert host.socket_options(h2) == {'nodelay': False, 'sockbuf': 1024 * 1024}
+    # Transfers send full packets and keep buffer sizes
+    assert host.socket_options(h2, bulk=True) == {'sockbuf': 1024 * 1024}
+
+
+def test_connect_bulk(host):
+    host.connect(open_channel=False, bulk=True)
+    host.reconnect()
+    assert host.sockopts == [{}, {}]
+    host.connect()
+    assert host.sockopts[-1] == {'nodelay': True}
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+import pytest
+from loon.classes import PBS
+from loon.hashindex import HashIndex
+from loon.transfer import plan_local
+from loon.deploy import job_order, pipeline, render_remote, submit_rendered, \
+    RENDER_HELPER, RENDER_DIR
+
+
+def write(path, text):
+    path = str(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    root = tmp_path / 'jobs'
+    write(root / 'a.pbs', 'cd $PBS_O_WORKDIR\npython run.py data/a.csv\n')
+    write(root / 'b.pbs', 'python ./run.py --input=data/b.csv\n')
+    write(root / 'c.pbs', 'Rscript "${PBS_O_WORKDIR}/ref"\n')
+    write(root / 'run.py', 'print(1)\n')
+    write(root / 'data' / 'a.csv', 'a\n')
+    write(root / 'data' / 'b.csv', 'b\n')
+    write(root / 'ref' / 'genome.fa', '>chr1\n')
+    write(root / 'shared.cfg', 'x=1\n')
+    return str(root)
+
+
+def test_job_order(jobs):
+    order = [(rel, is_job) for _, rel, is_job in
+             job_order(plan_local([jobs])[1])]
+    # Unreferenced files first, then each script after its inputs
+    assert order == [
+        ('jobs/shared.cfg', False),
+        ('jobs/data/a.csv', False),
+        ('jobs/run.py', False),
+        ('jobs/a.pbs', True),
+        ('jobs/data/b.csv', False),
+        ('jobs/b.pbs', True),
+        ('jobs/ref/genome.fa', False),
+        ('jobs/c.pbs', True),
+    ]
+
+
+@pytest.fixture
+def qsub(tmp_path, monkeypatch):
+    """A qsub which fails for scripts named 'bad*'"""
+    bin_dir = tmp_path / 'bin'
+    write(bin_dir / 'qsub', '#!/bin/sh\n'
+          'case "$(basename "$1")" in bad*) echo "qsub: bad job" >&2; exit 1;; esac\n'
+          'echo "$(basename "$1" .pbs).server"\n')
+    os.chmod(str(bin_dir / 'qsub'), 0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+
+
+def test_pipeline(jobs, remote_home, qsub, tmp_path):
+    write(os.path.join(jobs, 'bad.pbs'), 'exit 1\n')
+    session = remote_home()
+    submitted = []
+    res = pipeline(session,
+                   session,
+                   jobs,
+                   '~/deploy',
+                   chunk_size=4,
+                   callback=lambda *args: submitted.append(args))
+    assert res['files'] == 9
+    workdir = os.path.join(session.home, 'deploy', 'jobs')
+    assert open(os.path.join(workdir, 'data', 'b.csv')).read() == 'b\n'
+    jobs_done = dict((os.path.basename(path), (ok, out))
+                     for path, ok, out in res['jobs'])
+    assert jobs_done['a.pbs'] == (True, 'a.server')
+    assert jobs_done['c.pbs'] == (True, 'c.server')
+    assert jobs_done['bad.pbs'] == (False, 'qsub: bad job')
+    assert sorted(submitted) == sorted(res['jobs'])
+
+    # Unchanged files are not uploaded again, jobs are still submitted
+    with HashIndex(str(tmp_path / 'hashes.db')) as index:
+        res = pipeline(session, session, jobs, '~/deploy', index=index,
+                       checksum=True)
+    assert res['files'] == 0
+    assert res['skipped'] == 9
+    assert len(res['jobs']) == 4
+
+
+def render_inputs(tmp_path):
+    write(tmp_path / 'in' / 'template.pbs', '#PBS -N {name}\necho {path} {name}\n')
+    write(tmp_path / 'in' / 'samples.csv',
+          '# sample sheet\ns1,/data/s1.fq\ns2,/data/s2.fq\n')
+    write(tmp_path / 'in' / 'mapping.csv', '{name},0\n{path},1\n')
+    return [str(tmp_path / 'in' / i)
+            for i in ('template.pbs', 'samples.csv', 'mapping.csv')]
+
+
+def test_render_helper_matches_gen_pbs(tmp_path, capsys):
+    # Load the helper like the remote host runs it
+    namespace = {'__name__': 'pbs_render'}
+    with open(RENDER_HELPER) as f:
+        exec(compile(f.read(), RENDER_HELPER, 'exec'), namespace)
+    inputs = render_inputs(tmp_path)
+    assert namespace['main']([''] + inputs + [str(tmp_path / 'remote')]) == 0
+    PBS().gen_pbs(*inputs, str(tmp_path / 'local'), logging.getLogger())
+    names = sorted(os.listdir(str(tmp_path / 'remote')))
+    assert names == ['s1.pbs', 's2.pbs']
+    assert names == sorted(os.listdir(str(tmp_path / 'local')))
+    for name in names:
+        with open(str(tmp_path / 'remote' / name)) as f1, \
+                open(str(tmp_path / 'local' / name)) as f2:
+            assert f1.read() == f2.read()
+
+
+def test_render_remote(tmp_path, remote_home, qsub):
+    session = remote_home()
+    outdir, nfile = render_remote(session, *render_inputs(tmp_path), '~/gen')
+    assert outdir == os.path.join(session.home, 'gen')
+    assert nfile == 2
+    with open(os.path.join(outdir, 's2.pbs')) as f:
+        assert f.read() == '#PBS -N s2\necho /data/s2.fq s2\n'
+    assert sorted(os.listdir(os.path.join(outdir, RENDER_DIR))) == [
+        'mapping.csv', 'pbs-render.py', 'rendered.txt', 'samples.csv',
+        'template.pbs'
+    ]
+    res = submit_rendered(session, outdir)
+    assert res == [(os.path.join(outdir, 's1.pbs'), True, 's1.server'),
+                   (os.path.join(outdir, 's2.pbs'), True, 's2.server')]
+
+
+def test_render_remote_error(tmp_path, remote_home):
+    session = remote_home()
+    inputs = render_inputs(tmp_path)
+    write(inputs[2], '{name},0,extra\n')
+    with pytest.raises(RuntimeError) as e:
+        render_remote(session, *inputs, '~/gen')
+    assert 'only two columns' in str(e.value)
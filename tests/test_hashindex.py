@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import hashlib
+import pytest
+from loon import hashindex
+from loon.hashindex import HashIndex
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def write(path, data, age=60):
+    with open(str(path), 'wb') as f:
+        f.write(data)
+    mtime = time.time() - age
+    os.utime(str(path), (mtime, mtime))
+    return str(path)
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    calls = []
+    file_hash = hashindex.file_hash
+
+    def counted(path, algorithm):
+        calls.append(path)
+        return file_hash(path, algorithm)
+
+    monkeypatch.setattr(hashindex, 'file_hash', counted)
+    with HashIndex(str(tmp_path / 'db' / 'hashes.db'), workers=2) as idx:
+        idx.calls = calls
+        yield idx
+
+
+def test_hash_files_cached(index, tmp_path):
+    a = write(tmp_path / 'a', b'aaa')
+    b = write(tmp_path / 'b', b'bbbb')
+    assert index.hash_files([a, b]) == {a: sha256(b'aaa'), b: sha256(b'bbbb')}
+    assert sorted(index.calls) == [a, b]
+    assert index.lookup(a) == sha256(b'aaa')
+
+    index.calls[:] = []
+    assert index.hash_files([a, b]) == {a: sha256(b'aaa'), b: sha256(b'bbbb')}
+    assert index.calls == []
+
+
+def test_changed_file_invalidated(index, tmp_path):
+    a = write(tmp_path / 'a', b'aaa')
+    index.hash_files([a])
+    # Same size, different modification time
+    write(tmp_path / 'a', b'xyz', age=30)
+    assert index.lookup(a) is None
+    assert index.hash_files([a]) == {a: sha256(b'xyz')}
+    # Different size, same modification time
+    st = os.stat(a)
+    with open(a, 'ab') as f:
+        f.write(b'!')
+    os.utime(a, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert index.lookup(a) is None
+    assert index.hash_files([a]) == {a: sha256(b'xyz!')}
+
+
+def test_recent_file_not_indexed(index, tmp_path):
+    a = write(tmp_path / 'a', b'aaa', age=0)
+    assert index.hash_files([a]) == {a: sha256(b'aaa')}
+    assert index.lookup(a) is None
+
+
+def test_refresh(index, tmp_path):
+    a = write(tmp_path / 'a', b'aaa')
+    index.hash_files([a])
+    # Written in place keeping size and modification time
+    st = os.stat(a)
+    with open(a, 'r+b') as f:
+        f.write(b'bbb')
+    os.utime(a, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert index.hash_files([a]) == {a: sha256(b'aaa')}
+    assert index.hash_files([a], refresh=True) == {a: sha256(b'bbb')}
+    assert index.lookup(a) == sha256(b'bbb')
+
+
+def test_add_and_prune(index, tmp_path):
+    a = write(tmp_path / 'a', b'aaa')
+    index.add(a, 'digest')
+    assert index.lookup(a) == 'digest'
+    assert index.prune() == 0
+    index.max_age = -1
+    assert index.prune() == 1
+    assert index.lookup(a) is None
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import time
+import logging
+import subprocess
+import pytest
+from loon import classes
+from loon.metrics import Metrics, metrics
+from loon.classes import Host
+
+
+def test_record_disabled():
+    m = Metrics()
+    m.record('exec', 1.0)
+    assert m.records == []
+
+
+def test_to_jsonl():
+    m = Metrics()
+    m.enabled = True
+    m.record('upload', 2.0, phase='write', nbytes=100, host='h1')
+    with m.timer('exec', host='h2') as info:
+        info['items'] = 3
+    out = io.StringIO()
+    m.to_jsonl(out)
+    recs = [json.loads(l) for l in out.getvalue().splitlines()]
+    assert len(recs) == 2
+    assert recs[0]['op'] == 'upload'
+    assert recs[0]['phase'] == 'write'
+    assert recs[0]['bytes'] == 100
+    assert recs[0]['throughput'] == 50
+    assert recs[0]['host'] == 'h1'
+    assert recs[1]['op'] == 'exec'
+    assert recs[1]['items'] == 3
+    assert recs[1]['host'] == 'h2'
+
+
+def test_to_prometheus():
+    m = Metrics()
+    m.enabled = True
+    m.record('upload', 1.0, nbytes=10, host='h1')
+    m.record('upload', 2.0, nbytes=30, host='h1')
+    m.record('exec', 0.5, phase='first_byte', items=2, host='a"b')
+    out = io.StringIO()
+    m.to_prometheus(out)
+    lines = out.getvalue().splitlines()
+    assert 'loon_operation_seconds_sum{host="h1",op="upload"} 3.000000' in lines
+    assert 'loon_operation_seconds_count{host="h1",op="upload"} 2' in lines
+    assert 'loon_operation_bytes_total{host="h1",op="upload"} 40' in lines
+    assert ('loon_operation_items_total'
+            '{host="a\\"b",op="exec",phase="first_byte"} 2') in lines
+
+
+class SlowChannel:
+    """Output of a command writing a chunk every `delay` seconds"""
+    def __init__(self, chunks, delay):
+        self.chunks = list(chunks)
+        self.delay = delay
+
+    def read(self):
+        if len(self.chunks) == 0:
+            return 0, b''
+        time.sleep(self.delay)
+        data = self.chunks.pop(0)
+        return len(data), data
+
+    def read_stderr(self):
+        # Blocks until the command has finished
+        while self.chunks:
+            self.read()
+        return 0, b''
+
+
+@pytest.fixture
+def enabled_metrics():
+    metrics.enabled = True
+    metrics.records = []
+    yield metrics
+    metrics.enabled = False
+    metrics.records = []
+
+
+def test_get_result_first_byte(enabled_metrics, capsys):
+    host = Host.__new__(Host)
+    host.active_host = ['h1', 'u', '127.0.0.1', 22]
+    host.channel = SlowChannel([b'a\n', b'b\n', b'c\n', b'd\n'], 0.05)
+    host._exec_time = time.perf_counter()
+    assert host.get_result() == 'a\nb\nc\nd\n'
+    assert capsys.readouterr().out == 'a\nb\nc\nd\n'
+    phases = dict((r['phase'], r) for r in enabled_metrics.records)
+    assert phases['first_byte']['seconds'] < 0.15
+    assert phases['drain']['seconds'] >= 0.15
+    assert phases['drain']['bytes'] == 8
+
+
+def test_get_result_streams(capsys):
+    printed = []
+
+    class Channel(SlowChannel):
+        def read(self):
+            printed.append(capsys.readouterr().out)
+            return SlowChannel.read(self)
+
+    host = Host.__new__(Host)
+    host.active_host = ['h1', 'u', '127.0.0.1', 22]
+    host.channel = Channel([b'a\n', b'b\n', b'c\n'], 0)
+    assert host.get_result() == 'a\nb\nc\n'
+    # Each chunk is printed before the next one is read
+    assert printed == ['', 'a\n', 'b\n', 'c\n']
+
+
+def test_get_result_error(capsys):
+    host = Host.__new__(Host)
+    host.active_host = ['h1', 'u', '127.0.0.1', 22]
+    channel = SlowChannel([b'partial\n'], 0)
+    channel.read_stderr = lambda: (5, b'oops\n')
+    host.channel = channel
+    with pytest.raises(SystemExit):
+        host.get_result()
+    assert 'oops' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('enabled', [False, True])
+def test_upload_size_only_with_metrics(enabled, monkeypatch, capsys):
+    sized = []
+    monkeypatch.setattr(classes, 'run',
+                        lambda cmds, shell: subprocess.CompletedProcess(cmds, 0))
+    monkeypatch.setattr(classes, 'get_size',
+                        lambda paths: sized.append(paths) or 2000000)
+    monkeypatch.setattr(metrics, 'enabled', enabled)
+    monkeypatch.setattr(metrics, 'records', [])
+    host = Host.__new__(Host)
+    host.active_host = ['h1', 'u', '127.0.0.1', 22]
+    host.upload(['data'], '~/dst', logging.getLogger())
+    out = capsys.readouterr().out
+    # The sources are only walked again when metrics are recorded
+    assert sized == ([['data']] if enabled else [])
+    assert ('MB/s' in out) == enabled
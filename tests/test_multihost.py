@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shlex
+import pytest
+from loon import multihost
+from loon.connection import CHANNEL_WINDOW_DEFAULT
+from loon.hashindex import HashIndex
+from loon.multihost import broadcast, relay, gather, push, push_command, \
+    remote_paths, stream
+
+
+def make_files(root, paths):
+    for path in paths:
+        path = os.path.join(str(root), path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(path * 1000)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class BrokenSession:
+    def sftp_init(self):
+        raise ConnectionResetError('reset')
+
+
+def test_broadcast(tmp_path, remote_home):
+    make_files(tmp_path, ['src/a.txt', 'src/sub/b.txt', 'src/skip.log',
+                          'single.txt'])
+    sessions = dict((i, remote_home(i)) for i in ('h1', 'h2', 'h3'))
+    sessions['h4'] = BrokenSession()
+    res = broadcast(sessions,
+                    [str(tmp_path / 'src'), str(tmp_path / 'single.txt')],
+                    '~/dst',
+                    chunk_size=1024,
+                    exclude=['*.log'])
+    size = sum(
+        os.path.getsize(str(tmp_path / i))
+        for i in ('src/a.txt', 'src/sub/b.txt', 'single.txt'))
+    for alias in ('h1', 'h2', 'h3'):
+        assert res[alias] == {'files': 3, 'bytes': size, 'error': None}
+        home = sessions[alias].home
+        for rel in ('src/a.txt', 'src/sub/b.txt', 'single.txt'):
+            assert read(os.path.join(home, 'dst', rel)) == read(
+                str(tmp_path / rel))
+        assert not os.path.exists(os.path.join(home, 'dst', 'src', 'skip.log'))
+    assert res['h4']['files'] == 0
+    assert isinstance(res['h4']['error'], ConnectionResetError)
+
+
+def test_relay_rounds(monkeypatch):
+    pushed = []
+
+    def push(session, paths, destination, host):
+        pushed.append((session, host[0]))
+        return 'refused' if host[0] == 'h4' else None
+
+    monkeypatch.setattr(multihost, 'push', push)
+    hosts = [['h%d' % i, 'u', 'h%d' % i, 22] for i in range(2, 8)]
+    sessions = dict((h[0], h[0]) for h in [['h1']] + hosts)
+    res = relay(sessions, ['h1'], hosts, ['data'], '~/dst')
+    # Served hosts double each round: h1 -> h2, then h1, h2 -> h3, h4
+    assert res['h2'] == {'via': 'h1', 'error': None}
+    assert res['h3']['via'] == 'h1'
+    assert res['h4'] == {'via': 'h2', 'error': 'refused'}
+    # h4 failed, so it never sends
+    assert set(pushed) == set([('h1', 'h2'), ('h1', 'h3'), ('h2', 'h4'),
+                               ('h1', 'h5'), ('h2', 'h6'), ('h3', 'h7')])
+    assert all(res[h[0]]['error'] is None for h in hosts if h[0] != 'h4')
+
+
+def test_relay_failures(monkeypatch):
+    monkeypatch.setattr(multihost, 'push', lambda *args: 'refused')
+    hosts = [['h%d' % i, 'u', 'h%d' % i, 22] for i in range(2, 5)]
+    res = relay({'h1': None}, ['h1'], hosts, ['data'], '~/dst')
+    # Hosts which have the files keep sending to the next ones
+    assert res == dict((h[0], {
+        'via': 'h1',
+        'error': 'refused'
+    }) for h in hosts)
+
+
+class FakeSocket:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_gather(tmp_path, remote_home, monkeypatch):
+    monkeypatch.setattr(multihost, 'HashIndex',
+                        lambda: HashIndex(str(tmp_path / 'hashes.db')))
+    sessions = {}
+    sockets = []
+    for alias in ('h1', 'h2'):
+        sessions[alias] = remote_home(alias)
+        make_files(sessions[alias].home, ['logs/%s.log' % alias, 'out/res.txt'])
+
+    def connect(host):
+        if host[0] == 'h3':
+            raise ConnectionRefusedError('refused')
+        sockets.append(FakeSocket())
+        return sessions[host[0]], sockets[-1]
+
+    hosts = [[i, 'u', i, 22] for i in ('h1', 'h2', 'h3')]
+    done = []
+    res = gather(connect,
+                 hosts, ['~/logs/*.log', '~/out'],
+                 str(tmp_path / 'gathered'),
+                 parallel=2,
+                 callback=lambda alias, r: done.append(alias),
+                 windows={'h2': 4 * CHANNEL_WINDOW_DEFAULT})
+    assert sorted(done) == ['h1', 'h2', 'h3']
+    for alias in ('h1', 'h2'):
+        assert res[alias]['files'] == 2
+        assert res[alias]['error'] is None
+        local = tmp_path / 'gathered' / alias
+        assert read(str(local / ('%s.log' % alias))) == read(
+            os.path.join(sessions[alias].home, 'logs', '%s.log' % alias))
+        assert os.path.isfile(str(local / 'out' / 'res.txt'))
+    assert res['h3']['error'] == 'refused'
+    assert all(i.closed for i in sockets)
+    # Only the SFTP channel of h2 gets a larger window
+    assert sessions['h1'].windows == []
+    assert sessions['h2'].windows == [3 * CHANNEL_WINDOW_DEFAULT]
+
+    # Unchanged files are skipped with checksum
+    res = gather(connect, hosts[:2], ['~/out'], str(tmp_path / 'gathered'),
+                 checksum=True)
+    assert [res[i]['skipped'] for i in ('h1', 'h2')] == [1, 1]
+
+
+def test_push_command():
+    cmd = push_command(['~/data dir', '/abs/file', '~'], '~/dst',
+                       ['h2', 'user', 'node2', '2222'])
+    words = shlex.split(cmd)
+    assert words[:8] == [
+        'ssh', '-p', '2222', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=10',
+        'user@node2'
+    ]
+    # The remote command is quoted once more for the shell of the receiver
+    assert shlex.split(words[8]) == ['mkdir', '-p', 'dst']
+    assert words[9] == '&&'
+    assert words[10:18] == [
+        'scp', '-rp', '-P', '2222', '-o', 'BatchMode=yes', '-o',
+        'ConnectTimeout=10'
+    ]
+    # Commands run in the home directory
+    assert words[18:] == ['data dir', '/abs/file', '.', 'user@node2:dst']
+
+
+def test_push_error(monkeypatch):
+    monkeypatch.setattr(
+        multihost, 'run_command',
+        lambda session, cmd: (255, 'ssh: connect to host node2 port 22: '
+                              'Connection refused\nlost connection\n'))
+    assert push(None, ['x'], '~', ['h2', 'u', 'node2', 22]) == 'lost connection'
+    monkeypatch.setattr(multihost, 'run_command', lambda session, cmd: (0, ''))
+    assert push(None, ['x'], '~', ['h2', 'u', 'node2', 22]) is None
+
+
+def test_remote_paths(remote_home):
+    session = remote_home()
+    make_files(session.home, ['data/a.txt', 'data/b.txt', 'single.txt'])
+    assert remote_paths(session, ['~/data/*.txt', 'single.txt']) == [
+        os.path.join(session.home, 'data', 'a.txt'),
+        os.path.join(session.home, 'data', 'b.txt'),
+        os.path.join(session.home, 'single.txt')
+    ]
+    with pytest.raises(FileNotFoundError):
+        remote_paths(session, ['~/missing*'])
+
+
+def test_stream(remote_home):
+    src, dst = remote_home('src'), remote_home('dst')
+    make_files(src.home, ['data/a.txt', 'data/sub/b.txt', 'single.txt'])
+    os.chmod(os.path.join(src.home, 'data', 'a.txt'), 0o600)
+    paths = remote_paths(src, ['~/data', '~/single.txt'])
+    nbytes = stream(src, dst, paths, '~/copied/x', chunk_size=4096,
+                    window=2 * CHANNEL_WINDOW_DEFAULT)
+    assert nbytes > 0
+    # The window is only for reading from the sending host
+    assert src.windows == [CHANNEL_WINDOW_DEFAULT]
+    assert dst.windows == []
+    copied = os.path.join(dst.home, 'copied', 'x')
+    for rel in ('data/a.txt', 'data/sub/b.txt', 'single.txt'):
+        assert read(os.path.join(copied, rel)) == read(
+            os.path.join(src.home, rel))
+    assert os.stat(os.path.join(copied, 'data', 'a.txt')).st_mode & 0o777 == 0o600
+
+
+def test_stream_error(remote_home):
+    src, dst = remote_home('src'), remote_home('dst')
+    with pytest.raises(RuntimeError):
+        stream(src, dst, [os.path.join(src.home, 'missing')], '~/copied')
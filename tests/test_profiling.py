@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+from loon.profiling import Profiler, peak_rss
+
+
+def busy(seconds):
+    end = time.time() + seconds
+    data = []
+    while time.time() < end:
+        data.append(list(range(100)))
+    return len(data)
+
+
+def test_profiler(tmp_path):
+    prefix = str(tmp_path / 'out' / 'run')
+    profiler = Profiler(prefix, interval=0.001)
+    profiler.start()
+    busy(0.1)
+    res = profiler.stop()
+    assert res['wall'] >= 0.1
+    assert res['peak_traced'] > 0
+    assert res['peak_rss'] >= peak_rss(children=True) >= 0
+    for ext in ('.prof', '.txt', '.collapsed', '.mem.txt'):
+        assert os.path.getsize(prefix + ext) > 0
+    with open(prefix + '.txt') as f:
+        assert 'busy' in f.read()
+    # Stacks start with the thread name and end with a sample count
+    with open(prefix + '.collapsed') as f:
+        lines = f.read().splitlines()
+    assert any(i.startswith('MainThread;') and ';busy (' in i for i in lines)
+    assert all(i.rsplit(' ', 1)[1].isdigit() for i in lines)
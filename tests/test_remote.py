@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import subprocess
+from ssh2.error_codes import LIBSSH2_ERROR_EAGAIN
+from loon import remote
+from loon.hashindex import HashIndex
+from loon.remote import RemoteGlob, ScriptCache, run_parallel
+
+
+def make_files(root, paths):
+    for path in paths:
+        path = os.path.join(str(root), path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(path)
+
+
+def globbed(rglob, pattern):
+    home = rglob.home()
+    return [
+        e.path[len(home) + 1:] if e.path.startswith(home + '/') else e.path
+        for e in rglob.glob(pattern)
+    ]
+
+
+def test_remote_glob(remote_home):
+    session = remote_home()
+    make_files(session.home, [
+        'scripts/a.sh', 'scripts/b.sh', 'scripts/c.py', 'scripts/.hidden.sh',
+        'scripts/sub/d.sh', 'data/x/e.sh'
+    ])
+    rglob = RemoteGlob(session)
+    assert globbed(rglob, '~/scripts/*.sh') == ['scripts/a.sh', 'scripts/b.sh']
+    assert globbed(rglob, '~/scripts/.*.sh') == ['scripts/.hidden.sh']
+    assert globbed(rglob, '~/scripts/{a,c}.*') == ['scripts/a.sh', 'scripts/c.py']
+    assert globbed(rglob, '~/scripts/[bc]*') == ['scripts/b.sh', 'scripts/c.py']
+    assert globbed(rglob, '~/*/') == ['data', 'scripts']
+    assert globbed(rglob, '~/**/*.sh') == [
+        'data/x/e.sh', 'scripts/a.sh', 'scripts/b.sh', 'scripts/sub/d.sh'
+    ]
+    assert globbed(rglob, '~/scripts/a.sh') == ['scripts/a.sh']
+    assert globbed(rglob, '~/scripts/missing*') == []
+    assert globbed(rglob, '~/missing.sh') == []
+
+
+def test_remote_glob_entries(remote_home):
+    session = remote_home()
+    make_files(session.home, ['dir/file.txt'])
+    os.symlink(os.path.join(session.home, 'dir'),
+               os.path.join(session.home, 'link'))
+    rglob = RemoteGlob(session)
+    entries = dict((e.name, e) for e in rglob.glob('~/*'))
+    assert entries['dir'].is_dir and not entries['dir'].is_link
+    # Links are followed like shell does
+    assert entries['link'].is_dir and entries['link'].is_link
+    entry = rglob.glob('~/dir/*.txt')[0]
+    assert not entry.is_dir
+    assert entry.size == len(os.path.join(session.home, 'dir/file.txt'))
+
+
+def test_script_cache_put(remote_home, tmp_path):
+    session = remote_home()
+    make_files(tmp_path, ['local/a.sh', 'local/b.sh'])
+    cache = ScriptCache(session)
+    assert cache.cache_dir == os.path.join(session.home, '.cache/loon/objects')
+    a = str(tmp_path / 'local' / 'a.sh')
+    digest = hashlib.sha256(open(a, 'rb').read()).hexdigest()
+    os.chmod(a, 0o640)
+    obj, nbytes = cache.put(a)
+    assert obj == cache.cache_dir + '/' + digest + '-640'
+    assert nbytes == os.path.getsize(a)
+    assert open(obj).read() == open(a).read()
+    # Same content is not uploaded again
+    assert cache.put(a) == (obj, None)
+    assert os.listdir(cache.cache_dir) == [digest + '-640']
+    # Permission bits are kept and a chmod gives a new object
+    assert os.stat(obj).st_mode & 0o777 == 0o640
+    os.chmod(a, 0o775)
+    obj, nbytes = cache.put(a)
+    assert obj == cache.cache_dir + '/' + digest + '-775'
+    assert nbytes == os.path.getsize(a)
+    assert os.stat(obj).st_mode & 0o777 == 0o775
+
+
+def test_script_cache_sync(remote_home, tmp_path, monkeypatch):
+    monkeypatch.setattr(remote, 'HashIndex',
+                        lambda: HashIndex(str(tmp_path / 'hashes.db')))
+    session = remote_home()
+    make_files(tmp_path, ['local/a.sh', 'local/data.txt'])
+    a = str(tmp_path / 'local' / 'a.sh')
+    data = str(tmp_path / 'local' / 'data.txt')
+    cache = ScriptCache(session)
+    cmds = cache.sync({'run/a.sh': a, 'run/in/data.txt': data, 'run/b.sh': a})
+    assert len(os.listdir(cache.cache_dir)) == 2
+    subprocess.run(['sh', '-c', cmds], cwd=session.home, check=True)
+    run = os.path.join(session.home, 'run')
+    assert open(os.path.join(run, 'a.sh')).read() == open(a).read()
+    assert open(os.path.join(run, 'b.sh')).read() == open(a).read()
+    assert open(os.path.join(run, 'in', 'data.txt')).read() == open(data).read()
+    assert os.path.islink(os.path.join(run, 'a.sh'))
+
+
+def test_script_cache_cleanup(remote_home):
+    session = remote_home()
+    cache = ScriptCache(session, max_size=250)
+    for i, name in enumerate(['old', 'middle', 'new', 'kept']):
+        path = os.path.join(cache.cache_dir, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 100)
+        # 'kept' is the oldest but still needed
+        mtime = 1000 * (i + 1) if name != 'kept' else 1
+        os.utime(path, (mtime, mtime))
+    kept = cache.cache_dir + '/kept'
+    # Least recently used first, until the cache fits
+    assert cache.cleanup(keep={kept}) == 200
+    assert sorted(os.listdir(cache.cache_dir)) == ['kept', 'new']
+
+
+class NonBlockingChannel:
+    """Run `exit N` at once, each call would block once first
+
+    Like libssh2, the exit status is only known after `wait_closed`.
+    """
+    def __init__(self):
+        self.calls = set()
+        self.stdout = []
+        self.status = None
+        self.exit_status = 0
+
+    def _again(self, name):
+        if name not in self.calls:
+            self.calls.add(name)
+            return True
+        return False
+
+    def execute(self, command):
+        if self._again('execute'):
+            return LIBSSH2_ERROR_EAGAIN
+        self.status = int(command.split()[-1])
+        self.stdout = [command.encode('utf-8')]
+        return 0
+
+    def read(self, size):
+        if self._again('read') or len(self.stdout) == 0:
+            return LIBSSH2_ERROR_EAGAIN, b''
+        data = self.stdout.pop(0)
+        return len(data), data
+
+    def read_stderr(self, size):
+        return LIBSSH2_ERROR_EAGAIN, b''
+
+    def eof(self):
+        return self.status is not None and len(self.stdout) == 0
+
+    def close(self):
+        return LIBSSH2_ERROR_EAGAIN if self._again('close') else 0
+
+    def wait_closed(self):
+        if self._again('wait_closed'):
+            return LIBSSH2_ERROR_EAGAIN
+        self.exit_status = self.status
+        return 0
+
+    def get_exit_status(self):
+        return self.exit_status
+
+
+class NonBlockingSession:
+    def __init__(self):
+        self.opened = 0
+
+    def set_blocking(self, blocking):
+        self.blocking = blocking
+
+    def open_session(self):
+        self.opened += 1
+        if self.opened % 2 == 1:
+            return LIBSSH2_ERROR_EAGAIN
+        return NonBlockingChannel()
+
+    def block_directions(self):
+        return 0
+
+
+def test_run_parallel():
+    session = NonBlockingSession()
+    done = []
+    commands = ['exit 0', 'exit 3', 'exit 1']
+    jobs = run_parallel(session,
+                        None,
+                        commands,
+                        parallel=2,
+                        names=['a', 'b', 'c'],
+                        callback=lambda job: done.append(job['name']))
+    # Statuses are read after the remote close
+    assert [job['status'] for job in jobs] == [0, 3, 1]
+    assert [job['stdout'] for job in jobs] == commands
+    assert sorted(done) == ['a', 'b', 'c']
+    assert set(jobs[0]) == {'name', 'command', 'stdout', 'stderr', 'status'}
+    assert session.blocking
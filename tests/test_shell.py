@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import pytest
+from ssh2.error_codes import LIBSSH2_ERROR_EAGAIN
+from loon.shell import RemoteShell
+
+
+class ShellChannel:
+    """A shell channel backed by a local sh, reads never block"""
+    def __init__(self, cwd):
+        self.cwd = cwd
+
+    def shell(self):
+        self.proc = subprocess.Popen(['sh'],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     cwd=self.cwd)
+        for stream in (self.proc.stdout, self.proc.stderr):
+            os.set_blocking(stream.fileno(), False)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+        self.proc.stdin.flush()
+        return 0, len(data)
+
+    def _read(self, stream, size):
+        data = stream.read(size)
+        if data is None:
+            return LIBSSH2_ERROR_EAGAIN, b''
+        return len(data), data
+
+    def read(self, size):
+        return self._read(self.proc.stdout, size)
+
+    def read_stderr(self, size):
+        return self._read(self.proc.stderr, size)
+
+    def eof(self):
+        return self.proc.poll() is not None
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+class ShellSession:
+    def __init__(self, cwd):
+        self.cwd = cwd
+
+    def open_session(self):
+        return ShellChannel(self.cwd)
+
+    def set_blocking(self, blocking):
+        pass
+
+    def block_directions(self):
+        # Never wait on a socket
+        return 0
+
+
+@pytest.fixture
+def remote_shell(tmp_path):
+    shell = RemoteShell(ShellSession(str(tmp_path)), None)
+    yield shell
+    shell.close()
+
+
+def test_environment_kept(remote_shell, tmp_path):
+    os.makedirs(str(tmp_path / 'sub'))
+    assert remote_shell.run('export LOON_X=1; cd sub') == ('', '', 0)
+    out, err, status = remote_shell.run('echo $LOON_X; basename "$PWD"')
+    assert (out, err, status) == ('1\nsub\n', '', 0)
+
+
+def test_output_and_status(remote_shell):
+    out, err, status = remote_shell.run('echo out; echo err >&2; false')
+    assert (out, err, status) == ('out\n', 'err\n', 1)
+    # Output without a trailing newline and commands reading stdin
+    assert remote_shell.run('printf abc; cat') == ('abc', '', 0)
+    assert remote_shell.run('(exit 3)')[2] == 3
+
+
+def test_shell_exited(remote_shell):
+    with pytest.raises(ConnectionError):
+        remote_shell.run('exit 0')
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import pytest
-from loon.skeleton import fib
+from loon.skeleton import parse_args
 
 __author__ = "ShixiangWang"
 __copyright__ = "ShixiangWang"
@@ -14,3 +14,17 @@ __license__ = "mit"
 #     assert fib(7) == 13
 #     with pytest.raises(AssertionError):
 #         fib(-10)
+
+
+@pytest.mark.parametrize('argv, profile, prefix, positional', [
+    (['run', '--profile', 'ls'], True, None, ('commands', ['ls'])),
+    (['run', 'ls'], False, None, ('commands', ['ls'])),
+    (['upload', '--profile-prefix', '/tmp/up', 'src', 'dst'], False, '/tmp/up',
+     ('source', ['src'])),
+])
+def test_profile_options(argv, profile, prefix, positional):
+    # --profile takes no value, so positional arguments after it are kept
+    args, _ = parse_args(argv)
+    assert args.profile is profile
+    assert args.profile_prefix == prefix
+    assert getattr(args, positional[0]) == positional[1]
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+from loon import transfer
+from loon.hashindex import HashIndex
+from loon.transfer import plan_local, remove_tree, upload, download, verify_files
+
+
+def make_files(root, paths):
+    for path in paths:
+        path = os.path.join(str(root), path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(path)
+
+
+def test_plan_local(tmp_path):
+    make_files(tmp_path, ['src/a.txt', 'src/sub/b.txt', 'src/sub/c.log',
+                          'single.txt'])
+    os.makedirs(str(tmp_path / 'src' / 'empty'))
+    os.chmod(str(tmp_path / 'src' / 'sub'), 0o750)
+    dirs, files = plan_local(
+        [str(tmp_path / 'src'), str(tmp_path / 'single.txt')],
+        exclude=['*.log'])
+    assert [d[0] for d in dirs] == ['src', 'src/empty', 'src/sub']
+    assert dirs[2][1] == 0o750
+    assert [f[1] for f in files] == ['src/a.txt', 'src/sub/b.txt', 'single.txt']
+    assert files[1][0] == os.path.join(str(tmp_path), 'src', 'sub', 'b.txt')
+
+
+def test_plan_local_symlinks(tmp_path, capsys):
+    make_files(tmp_path, ['src/a.txt', 'other/b.txt', 'other/deep/c.txt'])
+    os.symlink(os.path.join('..', 'other'), str(tmp_path / 'src' / 'link'))
+    os.symlink(str(tmp_path / 'missing'), str(tmp_path / 'src' / 'broken'))
+    os.symlink(str(tmp_path / 'src'), str(tmp_path / 'src' / 'loop'))
+    os.symlink(str(tmp_path / 'missing'), str(tmp_path / 'gone'))
+    dirs, files = plan_local([str(tmp_path / 'src'), str(tmp_path / 'gone')])
+    assert [d[0] for d in dirs] == ['src', 'src/link', 'src/link/deep']
+    assert [f[1] for f in files] == [
+        'src/a.txt', 'src/link/b.txt', 'src/link/deep/c.txt'
+    ]
+    out = capsys.readouterr().out
+    assert 'broken' in out
+    assert 'gone' in out
+
+
+def test_remove_tree(tmp_path, remote_home):
+    make_files(tmp_path, ['tree/a.txt', 'tree/sub/b.txt', 'tree/sub/deep/c.txt',
+                          'other/d.txt', 'single.txt'])
+    os.symlink(str(tmp_path / 'other'), str(tmp_path / 'tree' / 'sub' / 'link'))
+    sftp = remote_home().sftp_init()
+    # Files, directories and the link, not what the link points to
+    assert remove_tree(sftp, str(tmp_path / 'tree')) == 7
+    assert not os.path.lexists(str(tmp_path / 'tree'))
+    assert os.path.isfile(str(tmp_path / 'other' / 'd.txt'))
+    assert remove_tree(sftp, str(tmp_path / 'single.txt')) == 1
+    assert remove_tree(sftp, str(tmp_path / 'missing')) == 0
+
+
+@pytest.fixture
+def index(tmp_path):
+    with HashIndex(str(tmp_path / 'hashes.db')) as idx:
+        yield idx
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_upload_download(tmp_path, remote_home, index):
+    make_files(tmp_path, ['src/a.txt', 'src/sub/b.txt'])
+    session = remote_home()
+    res = upload(session, [str(tmp_path / 'src')], '~/dst', index=index)
+    assert (res['files'], res['skipped']) == (2, 0)
+    remote_src = os.path.join(session.home, 'dst', 'src')
+    assert read(os.path.join(remote_src, 'sub', 'b.txt')) == read(
+        str(tmp_path / 'src' / 'sub' / 'b.txt'))
+
+    # Same content is skipped
+    res = upload(session, [str(tmp_path / 'src')], '~/dst', index=index)
+    assert (res['files'], res['skipped']) == (0, 2)
+
+    res = download(session, ['~/dst/src/*.txt', '~/dst/src/sub'],
+                   str(tmp_path / 'back'),
+                   index=index)
+    assert res['files'] == 2
+    assert sorted(os.listdir(str(tmp_path / 'back'))) == ['a.txt', 'sub']
+    assert read(str(tmp_path / 'back' / 'sub' / 'b.txt')) == read(
+        str(tmp_path / 'src' / 'sub' / 'b.txt'))
+
+
+def test_verify_files(tmp_path, remote_home, index):
+    make_files(tmp_path, ['src/a.txt', 'src/b.txt'])
+    session = remote_home()
+    upload(session, [str(tmp_path / 'src')], '~/dst', checksum=False)
+    pairs = [(str(tmp_path / 'src' / i),
+              os.path.join(session.home, 'dst', 'src', i))
+             for i in ('a.txt', 'b.txt')]
+    with open(pairs[1][1], 'wb') as f:
+        f.write(b'corrupted')
+    mismatched, failed = verify_files(session, pairs, index, 'upload')
+    assert mismatched == [pairs[1]]
+    assert failed == []
+    assert read(pairs[1][1]) == read(pairs[1][0])
+
+    # Downloads are sent again in the other direction
+    with open(pairs[0][0], 'wb') as f:
+        f.write(b'corrupted')
+    mismatched, failed = verify_files(session, pairs, index, 'download')
+    assert mismatched == [pairs[0]]
+    assert failed == []
+    assert read(pairs[0][0]) == read(pairs[0][1])
+
+
+def test_verify_files_failed(tmp_path, remote_home, index, monkeypatch):
+    make_files(tmp_path, ['src/a.txt'])
+    session = remote_home()
+    pair = (str(tmp_path / 'src' / 'a.txt'),
+            os.path.join(session.home, 'a.txt'))
+    with open(pair[1], 'wb') as f:
+        f.write(b'corrupted')
+    sent = []
+    monkeypatch.setattr(transfer, 'put_file', lambda *args: sent.append(args))
+    mismatched, failed = verify_files(session, [pair], index, 'upload',
+                                      retries=2)
+    assert mismatched == failed == [pair]
+    assert len(sent) == 2
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+from loon.utils import read_ssh_config, read_inventory, has_magic, expand_braces, \
+    walk_files, is_excluded, parse_size
+
+SSH_CONFIG = """
+Host bastion
+    HostName 10.0.0.1
+    User admin
+
+Host node1 node2
+    HostName cluster.example.org
+    Port 2222
+    ProxyJump bastion
+
+Host node2
+    User other
+
+Host *.internal !skip.internal
+    ProxyJump none
+
+Host *
+    User defaultuser
+    ProxyJump bastion
+"""
+
+
+def test_read_ssh_config(tmp_path):
+    config = tmp_path / 'config'
+    config.write_text(SSH_CONFIG)
+    hosts = read_ssh_config(str(config))
+    # The first obtained value wins, wildcard blocks only fill the rest
+    assert hosts[:3] == [
+        ['bastion', 'admin', '10.0.0.1', 22, 'bastion'],
+        ['node1', 'defaultuser', 'cluster.example.org', '2222', 'bastion'],
+        ['node2', 'other', 'cluster.example.org', '2222', 'bastion'],
+    ]
+    assert all(h[0] in ('bastion', 'node1', 'node2') for h in hosts)
+
+
+def test_read_ssh_config_negated_pattern(tmp_path):
+    config = tmp_path / 'config'
+    config.write_text("Host a.internal skip.internal\n" + SSH_CONFIG)
+    hosts = dict((h[0], h) for h in read_ssh_config(str(config)))
+    # 'ProxyJump none' of '*.internal' wins over the jump of '*'
+    assert hosts['a.internal'] == ['a.internal', 'defaultuser', 'a.internal', 22]
+    assert hosts['skip.internal'][4] == 'bastion'
+
+
+def test_read_inventory_csv(tmp_path):
+    inventory = tmp_path / 'hosts.csv'
+    inventory.write_text("alias,username,host,port\n"
+                         "h1, u1, 10.0.0.1, 22\n"
+                         "# comment\n"
+                         "h2,u2,10.0.0.2,2022,h1\n")
+    assert read_inventory(str(inventory)) == [
+        ['h1', 'u1', '10.0.0.1', '22'],
+        ['h2', 'u2', '10.0.0.2', '2022', 'h1'],
+    ]
+
+
+def test_read_inventory_expands_home(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    (tmp_path / 'hosts.csv').write_text("h1,u1,10.0.0.1\n")
+    assert read_inventory('~/hosts.csv') == [['h1', 'u1', '10.0.0.1']]
+
+
+def test_read_inventory_yaml(tmp_path):
+    pytest.importorskip('yaml')
+    inventory = tmp_path / 'hosts.yml'
+    inventory.write_text("- name: h1\n"
+                         "  user: u1\n"
+                         "  host: 10.0.0.1\n"
+                         "- alias: h2\n"
+                         "  username: u2\n"
+                         "  hostname: 10.0.0.2\n"
+                         "  port: 2022\n"
+                         "  jump: [h1, h3]\n")
+    assert read_inventory(str(inventory)) == [
+        ['h1', 'u1', '10.0.0.1', 22, None],
+        ['h2', 'u2', '10.0.0.2', 2022, 'h1,h3'],
+    ]
+
+    inventory.write_text("h1:\n"
+                         "  user: u1\n"
+                         "  host: 10.0.0.1\n"
+                         "  proxyjump: h0\n")
+    assert read_inventory(str(inventory)) == [['h1', 'u1', '10.0.0.1', 22, 'h0']]
+
+
+@pytest.mark.parametrize('text', [
+    "- name: [h1\n",
+    "just a string\n",
+    "- h1\n- h2\n",
+    "h1: u1@10.0.0.1\n",
+])
+def test_read_inventory_bad_yaml(tmp_path, text):
+    pytest.importorskip('yaml')
+    inventory = tmp_path / 'hosts.yaml'
+    inventory.write_text(text)
+    with pytest.raises(ValueError):
+        read_inventory(str(inventory))
+
+
+def test_read_inventory_unsupported(tmp_path):
+    with pytest.raises(ValueError):
+        read_inventory(str(tmp_path / 'hosts'), fmt='toml')
+
+
+@pytest.mark.parametrize('pattern, expected', [
+    ('data/*.csv', True),
+    ('data/file?.csv', True),
+    ('data/[ab].csv', True),
+    ('data/{a,b}.csv', True),
+    ('data/a.csv', False),
+    ('${HOME}/a.csv', False),
+    ('data/{a}.csv', False),
+])
+def test_has_magic(pattern, expected):
+    assert has_magic(pattern) is expected
+
+
+@pytest.mark.parametrize('pattern, expected', [
+    ('a{b,c{d,e}}f', ['abf', 'acdf', 'acef']),
+    ('{a,b}/{c,d}', ['a/c', 'a/d', 'b/c', 'b/d']),
+    ('x{,y}', ['x', 'xy']),
+    ('${HOME}/{a,b}', ['${HOME}/a', '${HOME}/b']),
+    ('plain{text}', ['plain{text}']),
+    ('unclosed{a,b', ['unclosed{a,b']),
+])
+def test_expand_braces(pattern, expected):
+    assert expand_braces(pattern) == expected
+
+
+def make_files(root, paths):
+    for path in paths:
+        path = os.path.join(str(root), path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(path)
+
+
+def walked(root, **kwargs):
+    return sorted(
+        os.path.relpath(e.path, str(root)).replace(os.sep, '/')
+        for e in walk_files(str(root), **kwargs))
+
+
+def test_walk_files_exclude(tmp_path):
+    make_files(tmp_path, [
+        'a.txt', 'b.log', 'sub/c.txt', 'sub/d.log', '.git/config',
+        'sub/.git/HEAD', 'out/e.txt'
+    ])
+    assert walked(tmp_path) == [
+        '.git/config', 'a.txt', 'b.log', 'out/e.txt', 'sub/.git/HEAD',
+        'sub/c.txt', 'sub/d.log'
+    ]
+    # Base names match at any depth, relative paths only from root
+    assert walked(tmp_path, exclude=['.git', '*.log', 'out']) == [
+        'a.txt', 'sub/c.txt'
+    ]
+    assert walked(tmp_path, exclude=['sub/*.txt']) == [
+        '.git/config', 'a.txt', 'b.log', 'out/e.txt', 'sub/.git/HEAD',
+        'sub/d.log'
+    ]
+    assert walked(tmp_path, include=['*.txt'], exclude=['sub']) == [
+        'a.txt', 'out/e.txt'
+    ]
+    assert is_excluded(os.path.join('sub', '.git'), ['.git'])
+    assert not is_excluded('a.txt', ['sub/*'])
+
+
+def test_walk_files_symlinks(tmp_path):
+    make_files(tmp_path, ['root/a.txt', 'other/b.txt'])
+    os.symlink(str(tmp_path / 'other'), str(tmp_path / 'root' / 'link'))
+    os.symlink(str(tmp_path / 'root'), str(tmp_path / 'root' / 'loop'))
+    os.symlink(str(tmp_path / 'other' / 'b.txt'),
+               str(tmp_path / 'root' / 'file_link'))
+    root = tmp_path / 'root'
+    # Links to directories are neither walked nor yielded as files
+    assert walked(root) == ['a.txt', 'file_link']
+    assert walked(root, follow_symlinks=True) == [
+        'a.txt', 'file_link', 'link/b.txt'
+    ]
+
+
+@pytest.mark.parametrize('text, expected', [
+    (4096, 4096),
+    ('4096', 4096),
+    ('512K', 512 * 1024),
+    ('4m', 4 * 1024**2),
+    ('1.5MB', int(1.5 * 1024**2)),
+    (' 2 G ', 2 * 1024**3),
+])
+def test_parse_size(text, expected):
+    assert parse_size(text) == expected
+
+
+@pytest.mark.parametrize('text', ['', 'M', '4T', '-1K', '1 2M'])
+def test_parse_size_bad(text):
+    with pytest.raises(ValueError):
+        parse_size(text)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import pytest
+from loon import watch
+from loon.watch import PollingWatcher, InotifyWatcher, batches
+
+
+def write(path, data='x'):
+    path = str(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+def test_polling_watcher(tmp_path):
+    write(tmp_path / 'a.txt')
+    write(tmp_path / 'sub' / 'b.txt')
+    watcher = PollingWatcher(str(tmp_path), exclude=['*.swp', '.git'],
+                             interval=0)
+    assert watcher.read(0) == (set(), set())
+
+    write(tmp_path / 'sub' / 'b.txt', 'longer')
+    write(tmp_path / 'c.txt')
+    write(tmp_path / 'c.txt.swp')
+    write(tmp_path / '.git' / 'index')
+    os.remove(str(tmp_path / 'a.txt'))
+    changed, deleted = watcher.read(0)
+    assert changed == {os.path.join('sub', 'b.txt'), 'c.txt'}
+    assert deleted == {'a.txt'}
+
+    os.rename(str(tmp_path / 'sub'), str(tmp_path / 'moved'))
+    changed, deleted = watcher.read(0)
+    assert changed == {'moved', os.path.join('moved', 'b.txt')}
+    assert deleted == {'sub', os.path.join('sub', 'b.txt')}
+
+
+def test_polling_watcher_waits(tmp_path):
+    watcher = PollingWatcher(str(tmp_path), interval=10)
+    write(tmp_path / 'a.txt')
+    # Not scanned before the interval passes
+    assert watcher.read(0.01) == (set(), set())
+
+
+class ScriptedWatcher:
+    """Return prepared events, an empty read once they are used up"""
+    def __init__(self, events):
+        self.events = list(events)
+        self.timeouts = []
+
+    def read(self, timeout):
+        self.timeouts.append(timeout)
+        if len(self.events) == 0:
+            return set(), set()
+        return self.events.pop(0)
+
+
+def test_batches_merge():
+    watcher = ScriptedWatcher([
+        ({'a', 'b'}, set()),
+        ({'c'}, {'a'}),
+        ({'a'}, {'b'}),
+    ])
+    it = batches(watcher, debounce=0.1, max_delay=3, idle=5)
+    assert next(it) == ({'a', 'c'}, {'b'})
+    assert watcher.timeouts[0] == 5
+    assert all(t <= 0.1 for t in watcher.timeouts[1:])
+    # Idle, an empty batch keeps the caller alive
+    assert next(it) == (set(), set())
+
+
+def test_batches_max_delay():
+    class Busy:
+        def read(self, timeout):
+            time.sleep(0.01)
+            return {'a'}, set()
+
+    it = batches(Busy(), debounce=1, max_delay=0.05, idle=1)
+    start = time.time()
+    assert next(it) == ({'a'}, set())
+    assert time.time() - start < 0.5
+
+
+def inotify_watcher(root):
+    try:
+        return InotifyWatcher(str(root))
+    except (OSError, AttributeError, TypeError):
+        pytest.skip("inotify is not available")
+
+
+def read_all(watcher, timeout=0.5):
+    changed, deleted = watcher.read(timeout)
+    while True:
+        more = watcher.read(0.05)
+        if more == (set(), set()):
+            return changed, deleted
+        changed |= more[0]
+        deleted |= more[1]
+
+
+def test_inotify_directory_moved_out(tmp_path):
+    root = tmp_path / 'root'
+    write(root / 'keep.txt')
+    write(root / 'a' / 'b' / 'c.txt')
+    watcher = inotify_watcher(root)
+    try:
+        assert sorted(watcher._dirs.values()) == [
+            '', 'a', os.path.join('a', 'b')
+        ]
+        os.rename(str(root / 'a'), str(tmp_path / 'outside'))
+        changed, deleted = read_all(watcher)
+        assert deleted == {'a'}
+        assert sorted(watcher._dirs.values()) == ['']
+
+        # Changes out of the tree are not reported under the old path
+        write(tmp_path / 'outside' / 'b' / 'new.txt')
+        write(root / 'keep.txt', 'changed')
+        changed, deleted = read_all(watcher)
+        assert changed == {'keep.txt'}
+        assert deleted == set()
+    finally:
+        watcher.close()
+
+
+def test_inotify_directory_moved_in(tmp_path):
+    root = tmp_path / 'root'
+    os.makedirs(str(root))
+    write(tmp_path / 'outside' / 'd' / 'e.txt')
+    watcher = inotify_watcher(root)
+    try:
+        os.rename(str(tmp_path / 'outside'), str(root / 'in'))
+        changed, deleted = read_all(watcher)
+        assert os.path.join('in', 'd', 'e.txt') in changed
+        write(root / 'in' / 'd' / 'f.txt')
+        changed, deleted = read_all(watcher)
+        assert changed == {os.path.join('in', 'd', 'f.txt')}
+    finally:
+        watcher.close()
+
+
+def test_open_watcher_poll(tmp_path):
+    watcher = watch.open_watcher(str(tmp_path), poll=True)
+    assert isinstance(watcher, PollingWatcher)
+    watcher.close()